@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+Benchmarks the exporter against a local stand-in for DDF's metrics endpoint.
+
+The stand-in serves a configurable number of endpoints, each with its own latency, payload size and error rate.
+A collection is timed on its own, and then the exporter's HTTP server is put under concurrent scrapes.
+The results are written out as JSON, so they can be compared between commits:
+
+    python bench/ddf_benchmark.py --endpoints 50 --latency 0.05 --output before.json
+
+The exporter is configured through its environment variables as usual, and every one that is set is recorded
+with the results. --runtime picks between the threaded and asyncio runtimes, and defaults to RUNTIME.
+"""
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import List
+from urllib.parse import urlsplit, parse_qs
+
+import argparse, asyncio, contextlib, datetime, json, os, platform, random, re, resource, socket, subprocess, sys
+import threading, time, tracemalloc, urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import ddf_exporter, ddf_exporter_async
+from prometheus_client import CollectorRegistry
+
+METRIC_API_LOCATION = 'services/internal/metrics'
+
+
+class FakeDDFServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves the metrics index, and a .json history for each endpoint in it.
+    """
+    daemon_threads = True
+    # The benchmark's own scrapes can queue up behind slow endpoints
+    request_queue_size = 128
+
+    def __init__(self, endpoints: int, latency: float, jitter: float, points: int, error_rate: float, seed: int):
+        super().__init__(('127.0.0.1', 0), FakeDDFHandler)
+        self.endpoint_names = ['benchMetric{}'.format(i) for i in range(endpoints)]
+        self.latency = latency
+        self.jitter = jitter
+        self.points = points
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.requests = 0
+
+    def next_delay_and_error(self):
+        with self.random_lock:
+            self.requests += 1
+            delay = max(self.latency + self.random.uniform(-self.jitter, self.jitter), 0)
+            return delay, self.random.random() < self.error_rate
+
+
+class FakeDDFHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        # Headers and body go out in separate writes, which would otherwise stall on delayed ACKs over keep-alive.
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path.strip('/')
+        delay, error = self.server.next_delay_and_error()
+        time.sleep(delay)
+
+        if path == METRIC_API_LOCATION:
+            body = {name: {'name': name, 'title': name} for name in self.server.endpoint_names}
+            self._send(200, json.dumps(body).encode('utf-8'))
+            return
+
+        name = path[len(METRIC_API_LOCATION) + 1:-len('.json')] if path.endswith('.json') else None
+        if name not in self.server.endpoint_names:
+            self._send(404, b'Not found')
+            return
+
+        if error:
+            self._send(500, b'Internal Server Error')
+            return
+
+        offset = int(parse_qs(url.query).get('dateOffset', ['120'])[0])
+        points = max(1, self.server.points * offset // 120)
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        data = [{'value': float(i), 'timestamp': (now - datetime.timedelta(seconds=points - i)).strftime('%b %d %Y %H:%M:%S')}
+                for i in range(points)]
+        self._send(200, json.dumps({'title': name, 'data': data, 'totalCount': points}).encode('utf-8'))
+
+    def _send(self, code: int, body: bytes):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """
+    :return: the nearest-rank percentile of the values, or 0 if there aren't any
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def summarize(durations: List[float], elapsed: float) -> dict:
+    return {
+        'count': len(durations),
+        'p50_ms': percentile(durations, 0.50) * 1000,
+        'p99_ms': percentile(durations, 0.99) * 1000,
+        'max_ms': max(durations) * 1000 if durations else 0.0,
+        'mean_ms': sum(durations) / len(durations) * 1000 if durations else 0.0,
+        'throughput_per_second': len(durations) / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def bench_collect(collector: ddf_exporter.DDFCollector, iterations: int) -> dict:
+    """
+    Time DDFCollector.collect() on its own, one call after another.
+    """
+    durations = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        list(collector.collect())
+        durations.append(time.perf_counter() - start)
+    return summarize(durations, time.perf_counter() - started)
+
+
+def bench_collect_async(collector: ddf_exporter_async.AsyncDDFCollector, iterations: int,
+                        loop: asyncio.AbstractEventLoop) -> dict:
+    """
+    Time AsyncDDFCollector.scrape_async() on its own, one call after another.
+    """
+    durations = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        loop.run_until_complete(collector.scrape_async())
+        durations.append(time.perf_counter() - start)
+    return summarize(durations, time.perf_counter() - started)
+
+
+def bench_http(collector: ddf_exporter.DDFCollector, concurrency: int, duration: float, compressed: bool) -> dict:
+    """
+    Scrape the exporter's HTTP server from several threads at once for a fixed amount of time.
+    """
+    registry = CollectorRegistry(auto_describe=False)
+    registry.register(collector)
+    server = ddf_exporter.start_exporter_server(0, ddf_exporter.TargetPool(), registry=registry, addr='127.0.0.1')
+    try:
+        return scrape_concurrently('http://127.0.0.1:{}/metrics'.format(server.server_address[1]),
+                                   concurrency, duration, compressed)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def bench_http_async(collector: ddf_exporter_async.AsyncDDFCollector, concurrency: int, duration: float, compressed: bool,
+                     loop: asyncio.AbstractEventLoop) -> dict:
+    """
+    The same as bench_http, against the asyncio runtime's server, with the event loop running on its own thread.
+    """
+    target_pool = ddf_exporter.TargetPool(collector_class=ddf_exporter_async.AsyncDDFCollector, start_polling=False)
+    exporter = ddf_exporter_async.AsyncExporter(target_pool, [collector], registry=CollectorRegistry(auto_describe=False))
+    server = loop.run_until_complete(exporter.start(0, '127.0.0.1'))
+    loop_thread = threading.Thread(target=loop.run_forever, daemon=True)
+    loop_thread.start()
+    try:
+        return scrape_concurrently('http://127.0.0.1:{}/metrics'.format(server.sockets[0].getsockname()[1]),
+                                   concurrency, duration, compressed)
+    finally:
+        asyncio.run_coroutine_threadsafe(exporter.shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        loop_thread.join()
+
+
+def scrape_concurrently(url: str, concurrency: int, duration: float, compressed: bool) -> dict:
+    headers = {'Accept-Encoding': 'gzip'} if compressed else {}
+
+    durations, errors, response_bytes = [], [0], [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def scrape():
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+                    size = len(response.read())
+            except OSError:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                durations.append(time.perf_counter() - start)
+                response_bytes[0] += size
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=scrape) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    results = summarize(durations, elapsed)
+    results['errors'] = errors[0]
+    results['mean_response_bytes'] = response_bytes[0] / len(durations) if durations else 0
+    return results
+
+
+def exporter_env_names() -> List[str]:
+    """
+    :return: every environment variable the exporter reads, found in its source, so that new settings are
+        recorded without having to be listed here
+    """
+    names = set()
+    for module in (ddf_exporter, ddf_exporter_async):
+        with open(module.__file__) as source:
+            names.update(re.findall(r"os\.getenv\(\s*'([A-Z0-9_]+)'", source.read()))
+    return sorted(names)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--endpoints', type=int, default=40, help='how many metric endpoints to serve')
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds each request to DDF takes')
+    parser.add_argument('--jitter', type=float, default=0.005, help='random +/- seconds added to the latency')
+    parser.add_argument('--points', type=int, default=120, help='datapoints per response for a 120s dateOffset')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail with a 500')
+    parser.add_argument('--iterations', type=int, default=10, help='how many times to time collect()')
+    parser.add_argument('--concurrency', type=int, default=4, help='concurrent scrapers for the HTTP benchmark')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds to run the HTTP benchmark for')
+    parser.add_argument('--gzip', action='store_true', help='request gzipped output in the HTTP benchmark')
+    parser.add_argument('--runtime', choices=('threaded', 'asyncio'), default=os.getenv('RUNTIME', 'threaded'),
+                        help='which of the exporter\'s runtimes to benchmark, defaults to RUNTIME')
+    parser.add_argument('--trace-allocations', action='store_true',
+                        help='track peak allocations with tracemalloc, which slows everything down')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the latency jitter and errors')
+    parser.add_argument('--output', help='file to write the JSON results to, instead of stdout')
+    args = parser.parse_args()
+
+    fake_ddf = FakeDDFServer(args.endpoints, args.latency, args.jitter, args.points, args.error_rate, args.seed)
+    threading.Thread(target=fake_ddf.serve_forever, daemon=True).start()
+
+    if args.trace_allocations:
+        tracemalloc.start()
+
+    # The exporter reports failed endpoints on stdout, which would get mixed in with the results.
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.runtime == 'asyncio':
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            collector = ddf_exporter_async.AsyncDDFCollector(host='http://127.0.0.1', host_port=fake_ddf.server_address[1],
+                                                       site_name='benchmark')
+            collect_results = bench_collect_async(collector, args.iterations, loop)
+            http_results = bench_http_async(collector, args.concurrency, args.duration, args.gzip, loop)
+            loop.close()
+        else:
+            collector = ddf_exporter.DDFCollector(host='http://127.0.0.1', host_port=fake_ddf.server_address[1],
+                                                  site_name='benchmark')
+            collect_results = bench_collect(collector, args.iterations)
+            http_results = bench_http(collector, args.concurrency, args.duration, args.gzip)
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'exporter_env': {key: os.environ[key] for key in exporter_env_names() if key in os.environ},
+        'collect': collect_results,
+        'http': http_results,
+        'ddf_requests': fake_ddf.requests,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if args.trace_allocations:
+        results['peak_traced_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    fake_ddf.shutdown()
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,57 +1,885 @@
 #!/usr/bin/env python
 
-from typing import Optional, Iterator
-from prometheus_client import start_http_server
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Optional, Iterator, Union, NamedTuple, Tuple, List, Callable
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
 from prometheus_client.core import GaugeMetricFamily, REGISTRY
+from prometheus_client.exposition import choose_encoder
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs
 
-import requests, sys, time, os, signal, re
-from requests import Timeout, TooManyRedirects
+import requests, urllib3, sys, time, os, signal, re, threading, functools, math, json, gzip, codecs, collections
+import itertools, contextlib, zlib, atexit, bisect, copy
+from array import array
+from datetime import datetime, timedelta, timezone
+from requests.adapters import HTTPAdapter
 
+# Prefix for the metrics the exporter publishes about itself.
+EXPORTER_METRIC_PREFIX = 'ddf_exporter_'
+
+# The exporter's own metrics. These are only exposed on /metrics, not on /probe.
+_REQUEST_DURATION = Histogram(EXPORTER_METRIC_PREFIX + 'request_duration_seconds',
+                              'Time taken by requests to DDF metric endpoints', ['target', 'endpoint'])
+_RESPONSE_BYTES = Counter(EXPORTER_METRIC_PREFIX + 'response_bytes',
+                          'Bytes received from DDF metric endpoints', ['target', 'endpoint'])
+_RESPONSE_WIRE_BYTES = Counter(EXPORTER_METRIC_PREFIX + 'response_wire_bytes',
+                               'Bytes received from DDF before they were decompressed', ['target'])
+_DATA_POINTS = Counter(EXPORTER_METRIC_PREFIX + 'data_points',
+                       'Datapoints parsed from DDF metric endpoint responses', ['target', 'endpoint'])
+_REQUEST_ERRORS = Counter(EXPORTER_METRIC_PREFIX + 'request_errors',
+                          'Failed requests to DDF metric endpoints, by the type of failure',
+                          ['target', 'endpoint', 'type'])
+# Every type a failed request is recorded under
+_REQUEST_ERROR_TYPES = ('timeout', 'connection', 'request', 'status', 'decode')
+_DISCOVERY_DURATION = Histogram(EXPORTER_METRIC_PREFIX + 'discovery_duration_seconds',
+                                'Time taken to discover the available DDF metric endpoints', ['target'])
+_COLLECT_DURATION = Histogram(EXPORTER_METRIC_PREFIX + 'collect_duration_seconds',
+                              'Time taken to collect every DDF metric endpoint', ['target'])
+_BUDGET_QUEUE_DURATION = Histogram(EXPORTER_METRIC_PREFIX + 'request_queue_seconds',
+                                   'Time requests to DDF waited for the target\'s request budget', ['target'])
+_BUDGET_QUEUED = Gauge(EXPORTER_METRIC_PREFIX + 'requests_queued',
+                       'Requests to DDF waiting for the target\'s request budget', ['target'])
+_BUDGET_IN_FLIGHT = Gauge(EXPORTER_METRIC_PREFIX + 'requests_in_flight',
+                          'Requests to DDF in flight, when the target has a request budget', ['target'])
+_BUDGET_SKIPPED = Counter(EXPORTER_METRIC_PREFIX + 'requests_skipped',
+                          'Requests to DDF skipped because the target\'s request budget was exhausted', ['target'])
+_CACHE_REQUESTS = Counter(EXPORTER_METRIC_PREFIX + 'cache_requests',
+                          'Lookups in the exporter\'s caches, by whether they were served from the cache',
+                          ['cache', 'result'])
+_EXPOSITION_BYTES = Counter(EXPORTER_METRIC_PREFIX + 'exposition_bytes',
+                            'Bytes of metrics output sent to scrapers, by content encoding', ['encoding'])
+_EXPOSITION_UNCOMPRESSED_BYTES = Counter(EXPORTER_METRIC_PREFIX + 'exposition_uncompressed_bytes',
+                                         'Bytes of metrics output sent to scrapers, before compression')
+
+# Per-thread details of the scrape being served, see scrape_deadline
+_scrape_context = threading.local()
+
+# Bumped whenever any collector finishes a poll, whether or not it brought new metrics, so rendered output
+# knows when it is out of date.
+_SNAPSHOT_GENERATIONS = itertools.count(1)
+_snapshot_generation = 0
+
+
+class Snapshot(NamedTuple):
+    """
+    The metrics from a completed background collection, which are served as-is until the next one completes.
+    """
+    metrics: Tuple[GaugeMetricFamily, ...]
+    # When this snapshot was taken, as a unix timestamp
+    created_at: float
+    # When a collection last got data from any of DDF's metric endpoints, as a unix timestamp
+    last_success: Optional[float]
+
+
+class _CollectionOutcome:
+    """
+    What happened to the endpoints in a single collection. Concurrent collections from the same target each
+    keep their own, rather than sharing it on the collector.
+    """
+    __slots__ = ('answered', 'timed_out')
+
+    def __init__(self):
+        # The endpoints that answered with data
+        self.answered = []
+        # The endpoints the collection gave up waiting on, because its deadline passed
+        self.timed_out = []
+
+
+class _HedgedFetch:
+    """
+    Shared by the requests for an endpoint in a single collection, the first one and its hedge, so that only the
+    first response to arrive is recorded.
+    """
+    __slots__ = ('recorded', 'result')
+
+    def __init__(self):
+        self.recorded = False
+        # The datapoints the recorded response brought, which the other request hands back too
+        self.result = None
 
-class DDFCollector:
+
+class EndpointState:
+    """
+    What has been seen so far from a single metric endpoint, so that each request only has to ask for
+    the data that arrived since the previous one.
+    """
+    __slots__ = ('last_fetch', 'high_water', 'last_value', 'last_seen', 'recent_points', 'history',
+                 'last_duration', 'interval', 'next_poll', 'failures', 'lock')
 
     def __init__(self):
+        # When the endpoint last answered a request, from time.monotonic()
+        self.last_fetch = None
+        # The timestamp of the newest datapoint received, as a unix timestamp
+        self.high_water = None
+        # The newest datapoint's value, and when it was received, from time.monotonic()
+        self.last_value = None
+        self.last_seen = None
+        # With BACKFILL_POINTS, the (unix timestamp, value) of each of the newest datapoints, oldest first
+        self.recent_points = ()
+        # With WINDOW_AGGREGATES, a _RingBuffer of the newest datapoints
+        self.history = None
+        # How many seconds the last request took, including unpacking the response
+        self.last_duration = None
+        # With ADAPTIVE_POLLING, how long to leave the endpoint between requests, and when it is next due,
+        # from time.monotonic()
+        self.interval = 0.0
+        self.next_poll = 0.0
+        # How many requests in a row have failed
+        self.failures = 0
+        # Held while a response is recorded, as requests for the same endpoint can finish at the same time
+        self.lock = threading.Lock()
+
+
+class _RingBuffer:
+    """
+    The newest datapoints from an endpoint in a fixed amount of memory, as two arrays of doubles that are written
+    round in a circle once they are full.
+    """
+    __slots__ = ('timestamps', 'values', 'start', 'size')
+
+    def __init__(self, capacity: int):
+        self.timestamps = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        # The index of the oldest datapoint, and how many datapoints are held
+        self.start = 0
+        self.size = 0
+
+    def append(self, timestamp: float, value: float):
+        """
+        Add a datapoint, overwriting the oldest one once the buffer is full. Datapoints have to be added oldest first.
+        """
+        capacity = len(self.values)
+        index = (self.start + self.size) % capacity
+        self.values[index] = value
+        self.timestamps[index] = timestamp
+        if self.size < capacity:
+            self.size += 1
+        else:
+            self.start = (self.start + 1) % capacity
+
+    def window(self, since: float) -> Tuple[array, array]:
+        """
+        :param since: the unix timestamp the window starts at
+        :return: copies of the timestamps and values of the datapoints in the window, oldest first
+        """
+        end = self.start + self.size
+        capacity = len(self.values)
+        if end <= capacity:
+            timestamps, values = self.timestamps[self.start:end], self.values[self.start:end]
+        else:
+            timestamps = self.timestamps[self.start:] + self.timestamps[:end - capacity]
+            values = self.values[self.start:] + self.values[:end - capacity]
+
+        first = bisect.bisect_left(timestamps, since)
+        return timestamps[first:], values[first:]
+
+
+class _EndpointInstruments:
+    """
+    The exporter's own metrics for a single endpoint, looked up once rather than on every request.
+    """
+    __slots__ = ('duration', 'response_bytes', 'data_points')
+
+    def __init__(self, target: str, endpoint: str):
+        self.duration = _REQUEST_DURATION.labels(target, endpoint)
+        self.response_bytes = _RESPONSE_BYTES.labels(target, endpoint)
+        self.data_points = _DATA_POINTS.labels(target, endpoint)
+
+
+class RequestBudgetExhausted(Exception):
+    """
+    A request wasn't made, because the target's RequestBudget didn't allow it in time.
+    """
+
+
+class RequestBudget:
+    """
+    Limits the requests made to a single target, however many collections are running against it: at most
+    REQUEST_RATE requests a second with bursts of up to REQUEST_BURST, and at most MAX_IN_FLIGHT_PER_TARGET
+    requests at once. Requests queue for the budget for up to REQUEST_QUEUE_TIMEOUT seconds, and are then skipped.
+    """
+
+    def __init__(self, target: str, rate: float, burst: float, max_in_flight: int, queue_timeout: float,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep):
+        """
+        :param clock: where the time comes from, in seconds
+        :param sleep: how to wait for a token, in seconds
+        """
+        self.rate = rate
+        self.burst = max(burst, 1.0)
+        self.queue_timeout = queue_timeout
+
+        # The token bucket starts full
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+        self.max_in_flight = max_in_flight
+        self._in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight > 0 else None
+        # Created on first use, on the event loop, see acquire_async
+        self._async_in_flight = None
+
+        self._queue_duration = _BUDGET_QUEUE_DURATION.labels(target)
+        self._queued = _BUDGET_QUEUED.labels(target)
+        self._in_flight_gauge = _BUDGET_IN_FLIGHT.labels(target)
+        self._skipped = _BUDGET_SKIPPED.labels(target)
+
+    def _take_token(self) -> float:
+        """
+        :return: 0 if a token was taken, otherwise how many seconds until there will be one
+        """
+        if self.rate <= 0:
+            return 0.0
+
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self._tokens + (now - self._updated) * self.rate, self.burst)
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self, deadline: Optional[float] = None) -> bool:
+        """
+        Wait for the budget to allow another request. Every successful acquire has to be followed by a release.
+
+        :param deadline: when the collection the request is for has to finish by, from the clock. The request
+            doesn't wait past it, even if REQUEST_QUEUE_TIMEOUT would allow it
+        :return: whether the request can be made, or False if it should be skipped
+        """
+        started = self._clock()
+        deadline = started + self.queue_timeout if deadline is None else min(started + self.queue_timeout, deadline)
+
+        self._queued.inc()
+        try:
+            wait_for_token = self._take_token()
+            while wait_for_token > 0:
+                if self._clock() + wait_for_token > deadline:
+                    self._skipped.inc()
+                    return False
+                self._sleep(wait_for_token)
+                wait_for_token = self._take_token()
+
+            if self._in_flight is not None and \
+                    not self._in_flight.acquire(timeout=max(deadline - self._clock(), 0)):
+                self._skipped.inc()
+                return False
+
+        finally:
+            self._queued.dec()
+
+        self._queue_duration.observe(self._clock() - started)
+        self._in_flight_gauge.inc()
+        return True
+
+    def release(self):
+        self._in_flight_gauge.dec()
+        if self._in_flight is not None:
+            self._in_flight.release()
+
+    async def acquire_async(self, deadline: Optional[float] = None) -> bool:
+        """
+        Wait for the budget on the event loop, see acquire. Has to be followed by release_async.
+        """
+        import asyncio
+
+        started = self._clock()
+        deadline = started + self.queue_timeout if deadline is None else min(started + self.queue_timeout, deadline)
+
+        self._queued.inc()
+        try:
+            wait_for_token = self._take_token()
+            while wait_for_token > 0:
+                if self._clock() + wait_for_token > deadline:
+                    self._skipped.inc()
+                    return False
+                await asyncio.sleep(wait_for_token)
+                wait_for_token = self._take_token()
+
+            if self.max_in_flight > 0:
+                if self._async_in_flight is None:
+                    self._async_in_flight = asyncio.Semaphore(self.max_in_flight)
+                try:
+                    await asyncio.wait_for(self._async_in_flight.acquire(),
+                                           max(deadline - self._clock(), 0))
+                except asyncio.TimeoutError:
+                    self._skipped.inc()
+                    return False
+
+        finally:
+            self._queued.dec()
+
+        self._queue_duration.observe(self._clock() - started)
+        self._in_flight_gauge.inc()
+        return True
+
+    def release_async(self):
+        self._in_flight_gauge.dec()
+        if self._async_in_flight is not None:
+            self._async_in_flight.release()
+
+
+class DDFCollector:
+
+    def __init__(self,
+                 host: Optional[str] = None,
+                 host_port: Optional[Union[int, str]] = None,
+                 site_name: Optional[str] = None,
+                 executor: Optional[ThreadPoolExecutor] = None,
+                 request_slots: Optional[threading.Semaphore] = None,
+                 state_store: Optional['StateStore'] = None,
+                 endpoint_shard: Optional[Tuple[int, int]] = None):
+        """
+        :param host: the address to gather metrics from, defaults to HOST_ADDRESS
+        :param host_port: the port to gather metrics from, defaults to HOST_PORT
+        :param site_name: the name of the DDF instance, defaults to SITE_NAME
+        :param executor: a worker pool shared with other collectors, otherwise the collector creates its own
+        :param request_slots: a semaphore bounding the requests in flight across every collector sharing it
+        :param state_store: where to save what has been collected, and restore it from on startup
+        :param endpoint_shard: this replica's shard index and the number of shards, to only collect the endpoints
+            that fall in its shard, see shard_owner
+        """
 
         self.metric_prefix = os.getenv('METRIC_PREFIX', 'ddf_')
-        self.host = os.getenv('HOST_ADDRESS', 'https://localhost')
+        self.host = host or os.getenv('HOST_ADDRESS', 'https://localhost')
         self.hostname = self.host.split('://')[-1]
-        self.sitename = os.getenv('SITE_NAME', self.hostname)
-        self.host_port = os.getenv('HOST_PORT', 8993)
+        self.sitename = site_name or os.getenv('SITE_NAME', self.hostname)
+        self.host_port = host_port or os.getenv('HOST_PORT', 8993)
         self.metric_api_location = os.getenv('METRIC_API_LOCATION',
                                              'services/internal/metrics')
         self.secure = os.getenv('SECURE', "True")
         self.ca_cert_path = os.getenv('CA_CERT_PATH', '/certs/ca.pem')
 
+        self.fetch_workers = int(os.getenv('FETCH_WORKERS', 8))
+        self.pool_size = int(os.getenv('HTTP_POOL_SIZE', max(self.fetch_workers, 1)))
+        self.keep_alive = os.getenv('HTTP_KEEP_ALIVE', "True")
+        self.http_compression = os.getenv('HTTP_COMPRESSION', "True")
+        self.discovery_ttl = float(os.getenv('DISCOVERY_TTL', 300))
+        self.poll_interval = float(os.getenv('POLL_INTERVAL', 0))
+        self.date_offset = int(os.getenv('DATE_OFFSET', 120))
+        self.fetch_overlap = int(os.getenv('FETCH_OVERLAP', 60))
+        self.stream_json = os.getenv('STREAM_JSON', "False")
+        self.adaptive_polling = os.getenv('ADAPTIVE_POLLING', "False")
+        self.adaptive_min_interval = float(os.getenv('ADAPTIVE_MIN_INTERVAL', 0))
+        self.adaptive_max_interval = float(os.getenv('ADAPTIVE_MAX_INTERVAL', 300))
+        self.adaptive_latency_factor = float(os.getenv('ADAPTIVE_LATENCY_FACTOR', 10))
+        self.breaker_threshold = int(os.getenv('BREAKER_THRESHOLD', 3))
+        self.breaker_backoff = float(os.getenv('BREAKER_BACKOFF', 30))
+        self.breaker_max_backoff = float(os.getenv('BREAKER_MAX_BACKOFF', 600))
+        self.connect_timeout = float(os.getenv('REQUEST_CONNECT_TIMEOUT', 5))
+        self.read_timeout = float(os.getenv('REQUEST_READ_TIMEOUT', 30))
+        self.collect_timeout = float(os.getenv('COLLECT_TIMEOUT', 0))
+        self.hedge_after = float(os.getenv('HEDGE_AFTER', 0))
+        self.request_rate = float(os.getenv('REQUEST_RATE', 0))
+        self.request_burst = float(os.getenv('REQUEST_BURST', max(self.request_rate, 1)))
+        self.max_in_flight_per_target = int(os.getenv('MAX_IN_FLIGHT_PER_TARGET', 0))
+        self.request_queue_timeout = float(os.getenv('REQUEST_QUEUE_TIMEOUT', 30))
+        # "stale" serves a skipped endpoint's last value, "skip" leaves it out of the collection
+        self.budget_exhausted = os.getenv('BUDGET_EXHAUSTED', 'stale')
+        self.slow_collection_threshold = float(os.getenv('SLOW_COLLECTION_THRESHOLD', 0))
+        # The system temp directory when unset, looked up when the first slow collection is written
+        self.slow_collection_dir = os.getenv('SLOW_COLLECTION_DIR')
+        self.expose_timestamps = os.getenv('EXPOSE_TIMESTAMPS', "False")
+        # The timezone DDF formats dates in, which is its JVM's, or None for the exporter's own
+        self.ddf_timezone = _parse_timezone(os.getenv('DDF_TIMEZONE', 'UTC'))
+        self.backfill_points = int(os.getenv('BACKFILL_POINTS', 1))
+        self.window_aggregates = [aggregate.strip() for aggregate in os.getenv('WINDOW_AGGREGATES', '').split(',')
+                                  if aggregate.strip() in _WINDOW_AGGREGATES]
+        self.aggregate_window = float(os.getenv('AGGREGATE_WINDOW', self.date_offset))
+        self.history_points = int(os.getenv('HISTORY_POINTS', 120))
+
+        # Compiled once, and matched against the whole snake_case endpoint name when the endpoints are discovered
+        self.endpoint_include = re.compile(os.getenv('ENDPOINT_INCLUDE', '.*'))
+        endpoint_exclude = os.getenv('ENDPOINT_EXCLUDE')
+        self.endpoint_exclude = re.compile(endpoint_exclude) if endpoint_exclude else None
+        self.endpoint_shard = endpoint_shard
+
         self.file_ext = '.json'
 
+        self.labels = {'host': self.host, 'hostname': self.hostname, 'sitename': self.sitename}
+        # Identifies this collector in the exporter's own metrics
+        self.target = '{}:{}'.format(self.host, self.host_port)
+        # snake_case metric name: _EndpointInstruments, with '' for the endpoint list
+        self._instruments = {}
+        self._wire_bytes = _RESPONSE_WIRE_BYTES.labels(self.target)
+
         self.metric_endpoints = {}
         self.metric_results = {}
+        # snake_case metric name: EndpointState
+        self.endpoint_states = {}
+        # How many of the newest new datapoints to hold on to from each response. Older datapoints can only be
+        # told apart from the newest one by their timestamps.
+        self.points_per_fetch = max(self.backfill_points, 1) if self.expose_timestamps == "True" else 1
+        if self.window_aggregates:
+            self.points_per_fetch = max(self.points_per_fetch, self.history_points)
+        # Only used when POLL_INTERVAL is set, in which case scrapes are answered from the latest snapshot.
+        self.snapshot = None
+        self._first_snapshot = threading.Event()
+        self._stop_polling = threading.Event()
+        self._poll_thread = None
+
+        # When the endpoint list was last successfully discovered, from time.monotonic()
+        self._endpoints_fetched_at = None
+        self._discovery_lock = threading.Lock()
+        self._discovery_in_progress = False
+
+        # Worker threads are only spawned on first use, and are reused across scrapes.
+        self._executor = executor or ThreadPoolExecutor(max_workers=max(self.fetch_workers, 1),
+                                                        thread_name_prefix='ddf-fetch')
+        self._request_slots = request_slots
+
+        # Shared by every collection from this target. Left out entirely unless a limit is set.
+        if self.request_rate > 0 or self.max_in_flight_per_target > 0:
+            self.request_budget = RequestBudget(self.target, self.request_rate, self.request_burst,
+                                                self.max_in_flight_per_target, self.request_queue_timeout)
+        else:
+            self.request_budget = None
+
+        # The TLS settings are worked out once, and the pooled session is kept open between scrapes
+        # so that every request doesn't pay for a fresh TCP and TLS handshake.
+        self._tls_lock = threading.Lock()
+        self._verify = self._resolve_verify()
+        self._cert_mtime = self._get_cert_mtime()
+        self.session = self._new_session()
+
+        self.state_store = state_store
+        if state_store is not None:
+            state_store.restore(self)
+
+    def describe(self):
+        # Without this, registering the collector would run a full collection just to find out the metric names.
+        return []
 
     # The collect method is used whenever a scrape request from prometheus activates this script.
     def collect(self):
-        # get the endpoints
-        self.metric_endpoints = self.fetch_available_endpoints()
+        # When polling in the background, the scrape only has to hand over what was last fetched.
+        if self.poll_interval > 0:
+            yield from self._collect_snapshot(getattr(_scrape_context, 'selection', ()))
+            return
+
+        yield from self.scrape()
+
+    def scrape(self, outcome: Optional[_CollectionOutcome] = None) -> list:
+        """
+        Fetch the current value of every available metric from the host.
+
+        :param outcome: filled in with what happened to each endpoint, if given
+        :return: a list of the metrics, in discovery order
+        """
+        started = time.perf_counter()
+        samples = self._start_slow_capture()
+        if outcome is None:
+            outcome = _CollectionOutcome()
+        # Discovery and the requests to the endpoints share the one deadline
+        deadline = self._collection_deadline()
+
+        try:
+            # pick up a replaced certificate before talking to the host
+            self._reload_tls_if_changed()
+
+            # get the endpoints, narrowed down to those the scrape asked for
+            metric_endpoints = self._selected_endpoints(self.get_available_endpoints(deadline),
+                                                        getattr(_scrape_context, 'selection', ()))
+
+            # fetch data from those endpoints
+            self.metric_results = self.populate_and_fetch_metrics(
+                metric_endpoints,
+                self.metric_prefix,
+                labels=self.labels,
+                outcome=outcome,
+                deadline=deadline)
+
+            return self._scraped_metrics(metric_endpoints, outcome, started, samples)
+
+        finally:
+            if samples is not None:
+                _stack_sampler.unsubscribe(samples)
+
+    def _scraped_metrics(self, metric_endpoints: dict, outcome: _CollectionOutcome, started: float,
+                         samples: Optional[collections.Counter] = None, writes: Optional[list] = None) -> list:
+        """
+        :param metric_endpoints: the endpoints that were scraped
+        :param outcome: what happened to each endpoint in the scrape
+        :param started: when the scrape started, from time.perf_counter()
+        :param samples: the stack samples being taken for SLOW_COLLECTION_THRESHOLD, if any
+        :param writes: if given, the files that are due to be written are added to it, as functions to call,
+            rather than being written straight away
+        :return: the scraped metrics, in discovery order, followed by the exporter's notes on the scrape
+        """
+        duration = time.perf_counter() - started
+        _COLLECT_DURATION.labels(self.target).observe(duration)
+
+        due_writes = []
+        if samples is not None and duration > self.slow_collection_threshold:
+            due_writes.append(functools.partial(self._dump_slow_collection, metric_endpoints, duration,
+                                                _stack_sampler.unsubscribe(samples), outcome.timed_out))
+        if _active_profiles:
+            for profile in list(_active_profiles):
+                profile.collection_finished()
+
+        metrics = [self.metric_results[metric_name] for metric_name in metric_endpoints.keys()]
+        if self.adaptive_polling == "True":
+            metrics.append(self._stale_metric(metric_endpoints))
+        if outcome.timed_out:
+            metrics.append(self._timed_out_metric(outcome.timed_out))
+        if self.window_aggregates:
+            metrics.extend(self._window_metrics(metric_endpoints))
+
+        if self.state_store is not None and self.state_store.record(self):
+            due_writes.append(self.state_store.save)
+
+        if writes is None:
+            for write in due_writes:
+                write()
+        else:
+            writes.extend(due_writes)
+
+        return metrics
+
+    def _start_slow_capture(self) -> Optional[collections.Counter]:
+        """
+        :return: the stack samples taken for the length of the collection, if SLOW_COLLECTION_THRESHOLD is set
+        """
+        if self.slow_collection_threshold <= 0:
+            return None
+
+        return _stack_sampler.subscribe()
+
+    def _dump_slow_collection(self, metric_endpoints: dict, duration: float, samples: collections.Counter,
+                              timed_out: List[str]):
+        """
+        Write out how long each endpoint took, and where the time went, for a collection that took longer than
+        SLOW_COLLECTION_THRESHOLD.
+        """
+        lines = ['# Collection from {} took {:.3f}s, over the {}s threshold'.format(
+            self.target, duration, self.slow_collection_threshold), '', '# Endpoint timings, slowest first']
+
+        def last_duration(metric_name):
+            state = self.endpoint_states.get(metric_name)
+            return -1.0 if state is None or state.last_duration is None else state.last_duration
+
+        for metric_name in sorted(metric_endpoints.keys(), key=last_duration, reverse=True):
+            state = self.endpoint_states.get(metric_name)
+            notes = []
+            if metric_name in timed_out:
+                notes.append('timed out')
+            if state is not None and state.failures:
+                notes.append('{} failures in a row'.format(state.failures))
+            lines.append('{:>10} {} {}'.format('-' if last_duration(metric_name) < 0
+                                               else '{:.3f}s'.format(last_duration(metric_name)),
+                                               metric_name, ', '.join(notes)).rstrip())
+
+        lines += ['', StackSampler.report(samples)]
+
+        if self.slow_collection_dir is None:
+            import tempfile
+            self.slow_collection_dir = tempfile.gettempdir()
+        path = os.path.join(self.slow_collection_dir, 'ddf-slow-collection-{}-{}.txt'.format(
+            re.sub(r'[^A-Za-z0-9.-]+', '_', self.target), time.strftime('%Y%m%dT%H%M%S')))
+        try:
+            with open(path, 'w') as dump_file:
+                dump_file.write('\n'.join(lines))
+            print("Error: collection from " + self.target + " was slow, details written to " + path)
+        except OSError as e:
+            print("Error: could not write slow collection details to " + path + ": " + str(e))
+
+    def saved_state(self) -> dict:
+        """
+        :return: the discovered endpoints, and each endpoint's high-water mark and last value, in a form that can be
+            saved to disk and restored after a restart. Times are saved as unix timestamps.
+        """
+        now, monotonic_now = time.time(), time.monotonic()
+
+        def to_timestamp(monotonic_time):
+            return None if monotonic_time is None else now - (monotonic_now - monotonic_time)
+
+        return {
+            'endpoints': self.metric_endpoints,
+            'discovered_at': to_timestamp(self._endpoints_fetched_at),
+            # snake_case metric name: [last fetch, high-water mark, last value, last seen]
+            'states': {metric_name: [to_timestamp(state.last_fetch), state.high_water, state.last_value,
+                                     to_timestamp(state.last_seen)]
+                       for metric_name, state in list(self.endpoint_states.items())},
+        }
+
+    def restore_state(self, saved: dict):
+        """
+        Pick up where a previous run left off, from what saved_state returned. The restored endpoints are used until
+        DISCOVERY_TTL runs out, and values that are still recent enough are served until the endpoints are next
+        fetched, which only asks for the data since the previous run's last request. When polling, the restored
+        values are served as a snapshot straight away.
 
-        # fetch data from those endpoints
-        self.metric_results = self.populate_and_fetch_metrics(
-            self.metric_endpoints,
-            self.metric_prefix,
-            labels={'host': self.host, 'hostname': self.hostname, 'sitename': self.sitename})
+        :param saved: what saved_state returned
+        """
+        now, monotonic_now = time.time(), time.monotonic()
+
+        def to_monotonic(timestamp):
+            return None if timestamp is None else monotonic_now - (now - timestamp)
+
+        if saved.get('endpoints') and saved.get('discovered_at') is not None:
+            # The filters may have changed since the endpoints were saved.
+            self.metric_endpoints = {metric_name: endpoint for metric_name, endpoint in saved['endpoints'].items()
+                                     if self._wanted(metric_name)}
+            self._endpoints_fetched_at = to_monotonic(saved['discovered_at'])
+
+        for metric_name, (last_fetch, high_water, last_value, last_seen) in saved.get('states', {}).items():
+            state = self._state_for(metric_name)
+            state.last_fetch = to_monotonic(last_fetch)
+            state.high_water = high_water
+            state.last_value = last_value
+            state.last_seen = to_monotonic(last_seen)
+
+        if self.poll_interval > 0 and self.metric_endpoints:
+            metrics = []
+            for metric_name in self.metric_endpoints.keys():
+                metric = GaugeMetricFamily(self.metric_prefix + metric_name, metric_name, labels=self.labels.keys())
+                self._add_current_value(metric, metric_name, self.labels)
+                metrics.append(metric)
+
+            last_seen = [state[3] for state in saved.get('states', {}).values() if state[3] is not None]
+            self.snapshot = Snapshot(metrics=tuple(metrics), created_at=saved.get('saved_at', now),
+                                     last_success=max(last_seen) if last_seen else None)
+
+    def refresh_snapshot(self) -> Snapshot:
+        """
+        Scrape the host and publish the results as the new snapshot. If none of the endpoints answered with data,
+        the previous snapshot's metrics are kept, and only age.
+
+        :return: the current snapshot
+        """
+        outcome = _CollectionOutcome()
+        try:
+            metrics = tuple(self.scrape(outcome))
+        except Exception as e:
+            print("Error: background collection failed: " + str(e))
+            metrics = ()
+
+        return self._publish_snapshot(metrics, succeeded=bool(outcome.answered))
+
+    def _publish_snapshot(self, metrics: Tuple[GaugeMetricFamily, ...], succeeded: bool) -> Snapshot:
+        """
+        :param metrics: the collection's metrics
+        :param succeeded: whether any of the endpoints answered with data. The exporter's notes on the collection,
+            and the last values carried over from earlier collections, don't count
+        """
+        previous = self.snapshot
+        now = time.time()
+
+        if succeeded:
+            self.snapshot = Snapshot(metrics=metrics, created_at=now, last_success=now)
+        elif previous is None:
+            self.snapshot = Snapshot(metrics=metrics, created_at=now, last_success=None)
+
+        # Even when the snapshot is kept, its age and the exporter's own metrics have moved on.
+        global _snapshot_generation
+        _snapshot_generation = next(_SNAPSHOT_GENERATIONS)
+
+        self._first_snapshot.set()
+        return self.snapshot
+
+    def warm_up(self):
+        """
+        Discover the endpoints and run a first collection, so that the first scrape doesn't have to set up the
+        connections and fetch every endpoint's full history. When polling, this waits for the first snapshot.
+        """
+        if self.poll_interval > 0 and self._poll_thread is not None:
+            # The poller's first run is already underway.
+            self._first_snapshot.wait()
+        elif self.poll_interval > 0:
+            self.refresh_snapshot()
+        else:
+            self.scrape()
+
+    def start_polling(self):
+        """
+        Start refreshing the snapshot every POLL_INTERVAL seconds on a background thread.
+        """
+        if self._poll_thread is not None:
+            return
+
+        self._stop_polling.clear()
+        self._poll_thread = threading.Thread(target=self._poll_loop, name='ddf-poller', daemon=True)
+        self._poll_thread.start()
+
+    def stop_polling(self):
+        self._stop_polling.set()
+        if self._poll_thread is not None:
+            self._poll_thread.join()
+            self._poll_thread = None
+
+    def close(self):
+        """
+        Stop polling, without waiting for a poll in progress to finish, and close the connections to the host.
+        """
+        self._stop_polling.set()
+        self.session.close()
+
+    def remove_exporter_metrics(self):
+        """
+        Drop the exporter's own metrics about this target, once it is no longer collected from.
+        """
+        children = [(family, (self.target,)) for family in (
+            _RESPONSE_WIRE_BYTES, _DISCOVERY_DURATION, _COLLECT_DURATION,
+            _BUDGET_QUEUE_DURATION, _BUDGET_QUEUED, _BUDGET_IN_FLIGHT, _BUDGET_SKIPPED)]
+        # Every request, including discovery's, is instrumented before it is made
+        for metric_name in list(self._instruments.keys()):
+            children += [(family, (self.target, metric_name)) for family in (
+                _REQUEST_DURATION, _RESPONSE_BYTES, _DATA_POINTS)]
+            children += [(_REQUEST_ERRORS, (self.target, metric_name, error_type))
+                         for error_type in _REQUEST_ERROR_TYPES]
+
+        for family, labels in children:
+            try:
+                family.remove(*labels)
+            except KeyError:
+                # Older versions of prometheus_client raise for children that were never created
+                pass
+
+    def _poll_loop(self):
+        next_run = time.monotonic()
+        while not self._stop_polling.is_set():
+            self.refresh_snapshot()
+
+            # Schedule from when the last run was due rather than when it finished, so slow
+            # collections don't make the interval drift. Missed runs are skipped, not queued up.
+            next_run += self.poll_interval
+            next_run = max(next_run, time.monotonic())
+            self._stop_polling.wait(next_run - time.monotonic())
+
+    def _collect_snapshot(self, selection: Tuple[str, ...] = ()) -> Iterator[GaugeMetricFamily]:
+        # Take a single reference, the poller may swap in a new snapshot at any time.
+        snapshot = self.snapshot
+        if snapshot is None:
+            return
 
-        # yield the data as metrics
-        for metric_name in self.metric_endpoints.keys():
-            yield self.metric_results[metric_name]
+        if selection:
+            selected = self._selected_endpoints(self.metric_endpoints, selection)
+            left_out = {metric_name for metric_name in self.metric_endpoints.keys() if metric_name not in selected}
+            left_out_families = {self.metric_prefix + metric_name for metric_name in left_out}
+            # The exporter's notes on the endpoints have a series per endpoint, rather than a family each
+            per_endpoint = {EXPORTER_METRIC_PREFIX + 'endpoint_stale', EXPORTER_METRIC_PREFIX + 'endpoint_timed_out'}
+            per_endpoint.update(self.metric_prefix + 'window_' + aggregate for aggregate in self.window_aggregates)
+
+            for metric in snapshot.metrics:
+                if metric.name in left_out_families:
+                    continue
+                if metric.name in per_endpoint:
+                    metric = copy.copy(metric)
+                    metric.samples = [sample for sample in metric.samples
+                                      if sample.labels.get('endpoint') not in left_out]
+                yield metric
+        else:
+            yield from snapshot.metrics
+
+        age = GaugeMetricFamily(EXPORTER_METRIC_PREFIX + 'snapshot_age_seconds',
+                                'Seconds since the served DDF metrics were collected', labels=self.labels.keys())
+        age.add_metric(labels=list(self.labels.values()), value=time.time() - snapshot.created_at)
+        yield age
+
+        if snapshot.last_success is not None:
+            last_success = GaugeMetricFamily(EXPORTER_METRIC_PREFIX + 'last_success_timestamp_seconds',
+                                             'When DDF metrics were last collected successfully, as a unix timestamp',
+                                             labels=self.labels.keys())
+            last_success.add_metric(labels=list(self.labels.values()), value=snapshot.last_success)
+            yield last_success
 
     # If offset is less than 120, then there may be no record, as the server may still be collecting that info.
-    def _make_request(self, metric_name: str, offset: Optional[int] = 120) -> dict:
+    def _make_request(self, metric_name: str, offset: Optional[int] = 120, deadline: Optional[float] = None,
+                      finish_by_deadline: bool = False) -> dict:
         """
         Sends a get request based on a specified metric, and then returns the json.
 
         :param metric_name: The name of the metric, which will be used to lookup the corresponding endpoint
         :param offset: From the present, how many seconds into the past to fetch data for that metric
+        :param deadline: when the collection has to finish by, from time.monotonic(), which caps how long the
+            request waits for the request budget and a request slot
+        :param finish_by_deadline: whether the connect and read timeouts are capped at the time left until the
+            deadline too, for requests the collection waits on rather than leaving to finish in the background
         :return: The dict/json representing the response
         """
 
+        query_url = self._query_url(metric_name, offset)
+        self._check_verify()
+
+        instruments = self._instruments_for(metric_name)
+
+        budget = self.request_budget
+        if budget is not None and not budget.acquire(deadline):
+            raise RequestBudgetExhausted('Skipped a request to ' + self.target + ', its request budget is exhausted')
+
+        if self._request_slots is not None:
+            if deadline is None:
+                self._request_slots.acquire()
+            elif not self._request_slots.acquire(timeout=max(deadline - time.monotonic(), 0)):
+                if budget is not None:
+                    budget.release()
+                raise RequestBudgetExhausted('Skipped a request to ' + self.target +
+                                             ', no request slot was free before the deadline')
+
+        def release():
+            if self._request_slots is not None:
+                self._request_slots.release()
+            if budget is not None:
+                budget.release()
+
+        started = time.perf_counter()
+        download = None
+        try:
+            # verify is False when operating insecurely, which shows a warning if using HTTPS,
+            # does not do so if using http.
+            timeout = (self.connect_timeout, self.read_timeout)
+            if finish_by_deadline and deadline is not None:
+                # A timeout of 0 isn't allowed, one that has already run out times out straight away anyway
+                remaining = max(deadline - time.monotonic(), 0.001)
+                timeout = (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+            if self.stream_json == "True":
+                download = self.session.get(query_url, verify=self._verify, timeout=timeout, stream=True)
+            else:
+                download = self.session.get(query_url, verify=self._verify, timeout=timeout)
+
+        except requests.RequestException as e:
+            # DNS failure, refused connection, etc
+            print("Error: " + str(e))
+            _REQUEST_ERRORS.labels(self.target, metric_name, _request_error_type(e)).inc()
+            return {}
+
+        finally:
+            # A streamed body is still to be read, which the request holds on to its slot for, see _HeldStream.
+            if download is None or self.stream_json != "True":
+                release()
+
+        if download.status_code >= 400:
+            _REQUEST_ERRORS.labels(self.target, metric_name, 'status').inc()
+
+        if self.stream_json == "True":
+            # The datapoints are decoded as the body is read, rather than all at once up front,
+            # so the request is only timed once the body has been read.
+            def finished():
+                release()
+                instruments.duration.observe(time.perf_counter() - started)
+
+            return {'data': _HeldStream(download, instruments.response_bytes, finished)}
+
+        try:
+            instruments.response_bytes.inc(len(download.content))
+            return download.json()
+        except ValueError:
+            _REQUEST_ERRORS.labels(self.target, metric_name, 'decode').inc()
+            raise
+        finally:
+            instruments.duration.observe(time.perf_counter() - started)
+
+    def _query_url(self, metric_name: str, offset: Optional[int]) -> str:
+        """
+        :param metric_name: The name of the metric, which will be used to lookup the corresponding endpoint
+        :param offset: From the present, how many seconds into the past to fetch data for that metric
+        :return: the url to request the metric from, or the base url if there is no offset
+        """
         query_url = '{host}:{host_port}/{api_location}/'.format(
             **{
                 'host': self.host,
@@ -68,88 +896,802 @@ class DDFCollector:
                     'offset': str(offset)
                 })
 
-        download = None
-        with requests.Session() as session:
-            try:
-                # User wants to operate insecurely, or the host is not an https request.
-                # Have to hardcode strings because dockerfiles cannot handle booleans
-                if self.secure == "False" or not query_url.startswith("https://"):
-                    download = session.get(query_url, verify=False)
-                    # shows a warning if using HTTPS, does not do so if using http.
+        return query_url
 
-                # If user wants to operate securely and they provided a certificate in the certs directory.
-                elif self.secure == "True" and os.path.isfile(self.ca_cert_path):
-                    download = session.get(query_url, verify=self.ca_cert_path)
+    def _check_verify(self):
+        # If the user wants to operate securely but didn't provide a certificate, we can't get metrics.
+        if self._verify is None:
+            raise FileNotFoundError(
+                'Secure metric connections are enabled but could not locate cert.pem inside of cacerts directory. '
+                'Either set environment variable SECURE to \"False\", or place a certificate at the path listed in the CA_CERT_PATH env variable.'
+                'See readme for more details.'
+            )
 
-                # If the user wants to operate securely but didn't provide a certificate, we can't get metrics.
-                else:
-                    raise FileNotFoundError(
-                        'Secure metric connections are enabled but could not locate cert.pem inside of cacerts directory. '
-                        'Either set environment variable SECURE to \"False\", or place a certificate at the path listed in the CA_CERT_PATH env variable.'
-                        'See readme for more details.'
-                    )
-
-            except requests.RequestException as e:
-                # DNS failure, refused connection, etc
-                print("Error: " + str(e))
-                return {}
+    def _instruments_for(self, metric_name: str) -> _EndpointInstruments:
+        instruments = self._instruments.get(metric_name)
+        if instruments is None:
+            instruments = self._instruments.setdefault(metric_name, _EndpointInstruments(self.target, metric_name))
+        return instruments
+
+    def _resolve_verify(self) -> Union[bool, str, None]:
+        """
+        Work out how the connection to the host should be verified.
+
+        :return: False to operate insecurely, the path to the ca cert to operate securely,
+            or None if a secure connection was requested but no cert could be found
+        """
+        # User wants to operate insecurely, or the host is not an https request.
+        # Have to hardcode strings because dockerfiles cannot handle booleans
+        if self.secure == "False" or not self.host.startswith("https://"):
+            return False
 
-        return download.json()
+        # If user wants to operate securely and they provided a certificate in the certs directory.
+        if self.secure == "True" and os.path.isfile(self.ca_cert_path):
+            return self.ca_cert_path
 
-    def fetch_available_endpoints(self) -> dict:
+        return None
+
+    def _get_cert_mtime(self) -> Optional[float]:
+        """
+        :return: the modification time of the ca cert, or None if it can't be read
+        """
+        try:
+            return os.stat(self.ca_cert_path).st_mtime
+        except OSError:
+            return None
+
+    def _new_session(self) -> requests.Session:
+        """
+        Build a connection-pooled session to be shared by every request made to the host.
+
+        :return: the new session
+        """
+        session = requests.Session()
+        adapter = _WireCountingAdapter(self._wire_bytes, pool_connections=1, pool_maxsize=self.pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+
+        # Spelled out, as requests would otherwise also offer br and zstd when their packages happen to be installed,
+        # and _Decompressor only handles gzip and deflate.
+        session.headers['Accept-Encoding'] = 'gzip, deflate' if self.http_compression != "False" else 'identity'
+
+        if self.keep_alive == "False":
+            session.headers['Connection'] = 'close'
+
+        return session
+
+    def _reload_tls_if_changed(self):
+        """
+        Re-resolve the TLS settings and start a fresh session if the ca cert has been added,
+        removed or replaced since it was last loaded.
+        """
+        if self._verify is False:
+            return
+
+        cert_mtime = self._get_cert_mtime()
+        if cert_mtime == self._cert_mtime:
+            return
+
+        with self._tls_lock:
+            if cert_mtime == self._cert_mtime:
+                return
+
+            old_session = self.session
+            self._verify = self._resolve_verify()
+            self._cert_mtime = cert_mtime
+            self.session = self._new_session()
+
+        # Pooled connections were set up against the old cert, so they shouldn't be reused.
+        old_session.close()
+
+    def fetch_available_endpoints(self, deadline: Optional[float] = None) -> dict:
         """
         Query the metrics endpoint to get available metrics, then process the result into a snake_case: camelCase
         dictionary.
 
+        :param deadline: when the collection has to finish by, from time.monotonic(), or None to use
+            COLLECT_TIMEOUT
         :return: a dict representing the snake_case: camelCase available endpoints
         """
-        endpoints = list(self._make_request('', offset=None).keys())
+        started = time.perf_counter()
+
+        if deadline is None:
+            deadline = self._collection_deadline()
+        # The scrape waits on discovery, so it can't be left to finish after the deadline.
+        available_endpoints = self._endpoints_from_index(
+            self._make_request('', offset=None, deadline=deadline, finish_by_deadline=True))
+
+        _DISCOVERY_DURATION.labels(self.target).observe(time.perf_counter() - started)
+
+        return available_endpoints
+
+    def _endpoints_from_index(self, index: dict) -> dict:
+        """
+        :param index: the response from the metrics endpoint, keyed by camelCase endpoint
+        :return: a dict representing the snake_case: camelCase available endpoints, leaving out those that
+            ENDPOINT_INCLUDE and ENDPOINT_EXCLUDE filter out, and those in other replicas' shards
+        """
+        endpoints = list(index.keys())
 
         available_endpoints = {}
         for endpoint in endpoints:
-            available_endpoints[_camel_to_snake_case(endpoint)] = endpoint
+            metric_name = _camel_to_snake_case(endpoint)
+            if self._wanted(metric_name):
+                available_endpoints[metric_name] = endpoint
 
         return available_endpoints
 
+    def _wanted(self, metric_name: str) -> bool:
+        """
+        :return: whether the endpoint passes the ENDPOINT_INCLUDE and ENDPOINT_EXCLUDE filters,
+            and falls in this replica's shard when the endpoints are sharded
+        """
+        if not self.endpoint_include.fullmatch(metric_name):
+            return False
+        if self.endpoint_exclude is not None and self.endpoint_exclude.fullmatch(metric_name):
+            return False
+        if self.endpoint_shard is not None:
+            shard_index, shard_count = self.endpoint_shard
+            # Keyed by the target too, so that the same endpoint on several targets is spread out
+            return shard_owner(self.target + '/' + metric_name, shard_count) == shard_index
+        return True
+
+    @staticmethod
+    def _selected_endpoints(available_endpoints: dict, selection: Tuple[str, ...]) -> dict:
+        """
+        :param available_endpoints: dictionary of snake_case: camelCase strings representing metric endpoints
+        :param selection: the collect[] patterns the scrape asked for, or () for every endpoint
+        :return: the endpoints whose names match any of the patterns in full, in discovery order
+        """
+        if not selection:
+            return available_endpoints
+
+        pattern = _selection_pattern(selection)
+        return {metric_name: endpoint for metric_name, endpoint in available_endpoints.items()
+                if pattern.fullmatch(metric_name)}
+
+    def get_available_endpoints(self, deadline: Optional[float] = None) -> dict:
+        """
+        Return the cached snake_case: camelCase available endpoints. The list is only discovered up front on the
+        first call; after that, once it is older than DISCOVERY_TTL it is refreshed in the background while the
+        current list keeps being served.
+
+        :param deadline: when the collection has to finish by, from time.monotonic(), or None to use
+            COLLECT_TIMEOUT
+        :return: a dict representing the snake_case: camelCase available endpoints
+        """
+        if self._endpoints_fetched_at is None or self.discovery_ttl <= 0:
+            # Nothing to serve yet, so this scrape has to wait for discovery.
+            _CACHE_REQUESTS.labels('discovery', 'miss').inc()
+            try:
+                return self.refresh_available_endpoints(deadline)
+            except RequestBudgetExhausted as e:
+                # Like a skipped fetch, the scrape carries on with what it has until the budget allows another try.
+                print("Error: " + str(e))
+                return self.metric_endpoints
+
+        _CACHE_REQUESTS.labels('discovery', 'hit').inc()
+
+        if time.monotonic() - self._endpoints_fetched_at >= self.discovery_ttl:
+            with self._discovery_lock:
+                start_refresh = not self._discovery_in_progress
+                self._discovery_in_progress = True
+
+            if start_refresh:
+                threading.Thread(target=self._background_refresh, name='ddf-discovery', daemon=True).start()
+
+        return self.metric_endpoints
+
+    def refresh_available_endpoints(self, deadline: Optional[float] = None) -> dict:
+        """
+        Rediscover the available endpoints. If the host doesn't return any, the last good list is kept.
+
+        :param deadline: when the collection has to finish by, from time.monotonic(), or None to use
+            COLLECT_TIMEOUT
+        :return: a dict representing the snake_case: camelCase available endpoints
+        """
+        return self._store_endpoints(self.fetch_available_endpoints(deadline))
+
+    def _store_endpoints(self, available_endpoints: dict) -> dict:
+        with self._discovery_lock:
+            if available_endpoints:
+                # Swap in a whole new dict, so scrapes already iterating over the old one are unaffected.
+                self.metric_endpoints = available_endpoints
+                self._endpoints_fetched_at = time.monotonic()
+            elif self.metric_endpoints:
+                print("Error: endpoint discovery returned nothing, keeping the last known endpoints")
+
+            return self.metric_endpoints
+
+    def _background_refresh(self):
+        try:
+            self.refresh_available_endpoints()
+        except Exception as e:
+            print("Error: endpoint discovery failed: " + str(e))
+        finally:
+            with self._discovery_lock:
+                self._discovery_in_progress = False
+
     def populate_and_fetch_metrics(self,
                                    available_endpoints: dict,
                                    prefix: str,
-                                   labels: Optional[dict] = None) -> dict:
+                                   labels: Optional[dict] = None,
+                                   outcome: Optional[_CollectionOutcome] = None,
+                                   deadline: Optional[float] = None) -> dict:
         """
         Query each available endpoint, retrieve it's value/values at that time, and store it into a results dictionary.
 
         :param available_endpoints: dictionary of snake_case: camelCase strings representing metric endpoints
         :param prefix: the prefix to be prepended to all metrics generated by this exporter
         :param labels: an optional set of tags for to include on the metrics
+        :param outcome: filled in with what happened to each endpoint, if given
+        :param deadline: when the collection has to finish by, from time.monotonic(), or None to use the scrape's
+            deadline or COLLECT_TIMEOUT
         :return: a dictionary of metrics with their corresponding values as retrieved from the endpoint
         """
         metric_results = {}
 
         if labels is None:
             labels = {}
+        if outcome is None:
+            outcome = _CollectionOutcome()
 
-        # for every available endpoint
+        due = self._due_endpoints(available_endpoints)
+        if deadline is None:
+            deadline = self._collection_deadline()
+
+        # Fan the requests out to the worker pool. Each worker downloads and unpacks a single endpoint,
+        # so the scrape takes as long as the slowest endpoint rather than the sum of all of them.
+        if self.fetch_workers > 1 and len(due) > 1:
+            fetches = {metric_name: _HedgedFetch() for metric_name in due}
+            pending = {metric_name: [self._executor.submit(self._fetch_data_points, metric_name, fetch, deadline)]
+                       for metric_name, fetch in fetches.items()}
+            if self.hedge_after > 0:
+                self._hedge(pending, fetches, deadline)
+        else:
+            pending = {metric_name: None for metric_name in due}
+
+        # Results are assembled in discovery order so the output is identical to a sequential fetch.
         for metric_name in available_endpoints.keys():
 
             # Create an empty metric for that endpoint to hold its results
             metric_results[metric_name] = GaugeMetricFamily(
                 prefix + metric_name, metric_name, labels=labels.keys())
 
-            # Call to that endpoint and add all of its datapoints to the results.
-            # Empty metrics are automatically hidden in prometheus, so an endpoint that responded
-            # without data doesn't present an issue.
-            for data_point in _json_to_metric_generator(self._make_request(metric_name)):
-                metric_results[metric_name].add_metric(labels=list(labels.values()), value=data_point['value'])
+            if metric_name in pending:
+                futures = pending[metric_name]
+                try:
+                    if futures is not None:
+                        finished = _wait_for_any(futures, deadline)
+                        data_points = finished.result() if finished is not None else None
+                    elif deadline is None or time.monotonic() < deadline:
+                        finished = True
+                        data_points = self._fetch_data_points(metric_name, deadline=deadline)
+                    else:
+                        finished = None
+
+                    if finished is None:
+                        # Whatever hasn't finished by the deadline is left out of this collection. Requests that
+                        # are already underway still complete in the background, and update the endpoint's state.
+                        outcome.timed_out.append(metric_name)
+                        for future in futures or ():
+                            future.cancel()
+                    elif data_points is not None:
+                        outcome.answered.append(metric_name)
+
+                except RequestBudgetExhausted:
+                    # With BUDGET_EXHAUSTED set to "skip", the endpoint has no value in this collection.
+                    continue
+                except Exception as e:
+                    # A single misbehaving endpoint shouldn't take the rest of the scrape down with it.
+                    print("Error: could not fetch " + metric_name + ": " + str(e))
+
+            self._add_current_value(metric_results[metric_name], metric_name, labels)
 
         return metric_results
 
+    def _due_endpoints(self, available_endpoints: dict) -> list:
+        """
+        :return: the endpoints to request in this collection. With adaptive polling, endpoints that aren't due
+            yet are left alone, and keep their last value.
+        """
+        if self.adaptive_polling != "True":
+            return list(available_endpoints.keys())
 
-def _json_to_metric_generator(json_response: dict) -> Iterator[dict]:
-    """
-    The returned JSON may or may not have multiple data rows, this helper function makes the results
-    iterable so that these multiple rows can be handled in a loop.
+        now = time.monotonic()
+        return [metric_name for metric_name in available_endpoints.keys()
+                if self._state_for(metric_name).next_poll <= now]
 
-    :param: json_response, a dict object representing the jason file. Its structure is:
+    def _add_current_value(self, metric: GaugeMetricFamily, metric_name: str, labels: dict):
+        # Only the newest datapoint is exposed, the older ones would be duplicates of the same series.
+        # Empty metrics are automatically hidden in prometheus, so an endpoint that hasn't had any
+        # data within the last DATE_OFFSET seconds doesn't present an issue.
+        state = self.endpoint_states.get(metric_name)
+        if state is None or not self._has_current_value(state):
+            return
+
+        if self.expose_timestamps != "True":
+            metric.add_metric(labels=list(labels.values()), value=state.last_value)
+        elif state.recent_points:
+            # With their timestamps, the newest few datapoints are separate samples of the same series. They are
+            # exposed to every scrape until newer datapoints replace them, so that each Prometheus scraping the
+            # exporter gets them. Prometheus drops the samples it has already ingested as duplicates.
+            for timestamp, value in state.recent_points:
+                metric.add_metric(labels=list(labels.values()), value=value, timestamp=timestamp)
+        else:
+            metric.add_metric(labels=list(labels.values()), value=state.last_value, timestamp=state.high_water)
+
+    def _collection_deadline(self) -> Optional[float]:
+        """
+        :return: when the current collection has to finish by, from time.monotonic(), or None if it can take as
+            long as it needs. This comes from the scrape being served, or otherwise from COLLECT_TIMEOUT
+        """
+        deadline = getattr(_scrape_context, 'deadline', None)
+        if deadline is None and self.collect_timeout > 0:
+            deadline = time.monotonic() + self.collect_timeout
+        return deadline
+
+    def _hedge(self, pending: dict, fetches: dict, deadline: Optional[float]):
+        """
+        Give the requests HEDGE_AFTER seconds, and then send a second request to each endpoint that still hasn't
+        answered. Whichever of the two answers first is used.
+
+        :param pending: snake_case metric name: a list of the futures fetching it, which hedges are added to
+        :param fetches: snake_case metric name: the _HedgedFetch its requests share
+        :param deadline: when the collection has to finish by, from time.monotonic()
+        """
+        hedge_at = time.monotonic() + self.hedge_after
+        if deadline is not None and hedge_at >= deadline:
+            return
+
+        wait([futures[0] for futures in pending.values()], timeout=self.hedge_after)
+
+        for metric_name, futures in pending.items():
+            if not futures[0].done():
+                futures.append(self._executor.submit(self._fetch_data_points, metric_name, fetches[metric_name],
+                                                     deadline))
+
+    def _state_for(self, metric_name: str) -> EndpointState:
+        state = self.endpoint_states.get(metric_name)
+        if state is None:
+            state = self.endpoint_states.setdefault(metric_name, EndpointState())
+        return state
+
+    def _has_current_value(self, state: EndpointState) -> bool:
+        """
+        :return: whether the endpoint's last value should still be exposed
+        """
+        if state.last_seen is None:
+            return False
+
+        # An endpoint that keeps failing carries on with its last good value, which is marked as stale.
+        if self.adaptive_polling == "True" and state.failures > 0:
+            return True
+
+        # Endpoints that are polled less often keep their value until they are due again.
+        return time.monotonic() - state.last_seen <= self.date_offset + state.interval
+
+    def _fetch_data_points(self, metric_name: str, fetch: Optional[_HedgedFetch] = None,
+                           deadline: Optional[float] = None) -> Optional[list]:
+        """
+        Download a single endpoint, and record the newest of its datapoints. Runs on the worker pool.
+
+        :param metric_name: The snake_case name of the metric to fetch
+        :param fetch: shared with any other request for the endpoint in the same collection
+        :param deadline: when the collection has to finish by, from time.monotonic()
+        :return: a list of the datapoints that hadn't been seen before, oldest first, or None if the endpoint
+            didn't answer with any data
+        """
+        state = self._state_for(metric_name)
+        started = time.monotonic()
+
+        json_response = None
+        try:
+            json_response = self._make_request(metric_name, self._next_offset(state, started), deadline=deadline)
+            data_points = self._unpack_response(metric_name, state, started, json_response)
+        except RequestBudgetExhausted:
+            if self.budget_exhausted == 'skip':
+                raise
+            # The endpoint carries on with its last value until the budget allows another request.
+            return None
+        except Exception:
+            with state.lock:
+                self._schedule_next_poll(state, started, failed=True)
+            raise
+        finally:
+            # Lets go of a streamed response's request slot even if it wasn't read to the end.
+            if isinstance(json_response, dict) and isinstance(json_response.get('data'), _HeldStream):
+                json_response['data'].close()
+
+        return self._record_once(state, started, data_points, fetch)
+
+    def _record_once(self, state: EndpointState, started: float, data_points: Optional[list],
+                     fetch: Optional[_HedgedFetch]) -> Optional[list]:
+        """
+        Record a response, unless another request for the endpoint in the same collection already has.
+
+        :return: the new datapoints, oldest first, or None if the endpoint didn't answer with any data
+        """
+        with state.lock:
+            if fetch is not None and fetch.recorded:
+                return fetch.result
+
+            result = self._record_data_points(state, started, data_points)
+            if fetch is not None and result is not None:
+                fetch.recorded = True
+                fetch.result = result
+            return result
+
+    def _unpack_response(self, metric_name: str, state: EndpointState, started: float,
+                         json_response: Optional[dict]) -> Optional[list]:
+        """
+        :return: a list of the datapoints in the response that hadn't been seen before, oldest first,
+            or None if the endpoint didn't answer with any data
+        """
+        # Failed requests come back empty, in which case the next request has to cover this one's window too.
+        if not json_response or 'data' not in json_response:
+            return None
+
+        data = json_response['data']
+        if isinstance(data, list):
+            self._instruments_for(metric_name).data_points.inc(len(data))
+        else:
+            json_response = {'data': _counted(data, self._instruments_for(metric_name).data_points)}
+
+        data_points = _new_data_points(_json_to_metric_generator(json_response), state.high_water,
+                                       limit=self.points_per_fetch, tz=self.ddf_timezone)
+        state.last_fetch = started
+
+        return data_points
+
+    def _record_data_points(self, state: EndpointState, started: float,
+                            data_points: Optional[list]) -> Optional[list]:
+        """
+        Schedule the endpoint's next request, and keep its newest datapoint.
+
+        :return: the new datapoints, oldest first, or None if the endpoint didn't answer with any data
+        """
+        self._schedule_next_poll(state, started, failed=data_points is None,
+                                 changed=bool(data_points) and data_points[-1]['value'] != state.last_value)
+
+        if not data_points:
+            return data_points
+
+        newest = data_points[-1]
+        state.high_water = _parse_timestamp(newest.get('timestamp'), self.ddf_timezone)
+        state.last_value = newest['value']
+        state.last_seen = started
+        if self.expose_timestamps == "True" and self.backfill_points > 1:
+            recent_points = tuple((_parse_timestamp(data_point.get('timestamp'), self.ddf_timezone),
+                                   data_point['value']) for data_point in data_points[-self.backfill_points:])
+            # Samples of the same series without timestamps would clash, so then only the newest is exposed.
+            state.recent_points = recent_points if all(point[0] is not None for point in recent_points) else ()
+
+        if self.window_aggregates:
+            self._record_history(state, data_points)
+
+        return data_points
+
+    def _record_history(self, state: EndpointState, data_points: list):
+        """
+        Add the new datapoints to the endpoint's ring buffer. Datapoints without a timestamp are taken to be from
+        when they were received, and those that aren't numbers are skipped.
+        """
+        if state.history is None:
+            state.history = _RingBuffer(max(self.history_points, 1))
+
+        received_at = time.time()
+        for data_point in data_points:
+            timestamp = _parse_timestamp(data_point.get('timestamp'), self.ddf_timezone)
+            try:
+                state.history.append(received_at if timestamp is None else timestamp, float(data_point['value']))
+            except (TypeError, ValueError):
+                continue
+
+    def _schedule_next_poll(self, state: EndpointState, started: float, failed: bool, changed: bool = False):
+        """
+        Work out when an endpoint should next be requested, when ADAPTIVE_POLLING is enabled.
+
+        Endpoints whose value changed are polled again on the next scrape, while each time the value stays the
+        same the interval doubles, up to ADAPTIVE_MAX_INTERVAL. An endpoint is never polled more often than
+        ADAPTIVE_LATENCY_FACTOR times its latency. Once BREAKER_THRESHOLD requests in a row have failed, the
+        endpoint is left alone for BREAKER_BACKOFF seconds, doubling with each further failure.
+
+        :param state: the endpoint's state
+        :param started: when the request was started, from time.monotonic()
+        :param failed: whether the request failed
+        :param changed: whether the endpoint's newest value differs from its last one
+        """
+        now = time.monotonic()
+        state.last_duration = now - started
+
+        if failed:
+            state.failures += 1
+            if state.failures >= self.breaker_threshold:
+                backoff = self.breaker_backoff * 2 ** min(state.failures - self.breaker_threshold, 32)
+                state.next_poll = now + min(backoff, self.breaker_max_backoff)
+            return
+
+        state.failures = 0
+        if self.adaptive_polling != "True":
+            return
+
+        if changed:
+            interval = self.adaptive_min_interval
+        else:
+            interval = max(state.interval * 2, _ADAPTIVE_INITIAL_INTERVAL)
+
+        interval = max(interval, (now - started) * self.adaptive_latency_factor)
+        state.interval = min(interval, self.adaptive_max_interval)
+        state.next_poll = started + state.interval
+
+    def _window_metrics(self, available_endpoints: dict) -> List[GaugeMetricFamily]:
+        """
+        :return: a metric for each of the WINDOW_AGGREGATES, with a series per endpoint summarising its datapoints
+            from the last AGGREGATE_WINDOW seconds
+        """
+        families = {aggregate: GaugeMetricFamily(self.metric_prefix + 'window_' + aggregate,
+                                                 _WINDOW_AGGREGATES[aggregate].format(int(self.aggregate_window)),
+                                                 labels=list(self.labels.keys()) + ['endpoint'])
+                    for aggregate in self.window_aggregates}
+
+        since = time.time() - self.aggregate_window
+        for metric_name in available_endpoints.keys():
+            state = self.endpoint_states.get(metric_name)
+            if state is None or state.history is None:
+                continue
+
+            for aggregate, value in _window_aggregates(*state.history.window(since)).items():
+                if aggregate in families:
+                    families[aggregate].add_metric(list(self.labels.values()) + [metric_name], value)
+
+        return [families[aggregate] for aggregate in self.window_aggregates]
+
+    def _timed_out_metric(self, timed_out_endpoints: list) -> GaugeMetricFamily:
+        """
+        :return: a metric flagging which endpoints the collection gave up waiting on
+        """
+        timed_out = GaugeMetricFamily(EXPORTER_METRIC_PREFIX + 'endpoint_timed_out',
+                                      'Set for DDF metric endpoints that did not answer before the collection deadline',
+                                      labels=list(self.labels.keys()) + ['endpoint'])
+        for metric_name in timed_out_endpoints:
+            timed_out.add_metric(list(self.labels.values()) + [metric_name], 1.0)
+        return timed_out
+
+    def _stale_metric(self, available_endpoints: dict) -> GaugeMetricFamily:
+        """
+        :return: a metric flagging which endpoints' values are being carried over from before their requests failed
+        """
+        stale = GaugeMetricFamily(EXPORTER_METRIC_PREFIX + 'endpoint_stale',
+                                  'Whether the last request to the DDF metric endpoint failed, '
+                                  'and its last good value is being served',
+                                  labels=list(self.labels.keys()) + ['endpoint'])
+        for metric_name in available_endpoints.keys():
+            state = self.endpoint_states.get(metric_name)
+            stale.add_metric(list(self.labels.values()) + [metric_name],
+                             1.0 if state is not None and state.failures > 0 else 0.0)
+        return stale
+
+    def _next_offset(self, state: EndpointState, now: float) -> int:
+        """
+        Work out how far back the next request for an endpoint has to reach. This covers the time since the
+        endpoint last answered, plus FETCH_OVERLAP seconds for data the server was still collecting at the time,
+        and never more than DATE_OFFSET seconds.
+
+        :param state: the endpoint's state
+        :param now: the current time, from time.monotonic()
+        :return: the dateOffset to request, in seconds
+        """
+        if state.last_fetch is None:
+            return self.date_offset
+
+        return min(self.date_offset, int(math.ceil(now - state.last_fetch)) + self.fetch_overlap)
+
+
+# With ADAPTIVE_POLLING, the first interval given to an endpoint whose value isn't changing
+_ADAPTIVE_INITIAL_INTERVAL = 10.0
+
+
+# The aggregates WINDOW_AGGREGATES can ask for, and the description of each
+_WINDOW_AGGREGATES = collections.OrderedDict([
+    ('min', 'The lowest value of each DDF metric endpoint over the last {} seconds'),
+    ('max', 'The highest value of each DDF metric endpoint over the last {} seconds'),
+    ('mean', 'The mean value of each DDF metric endpoint over the last {} seconds'),
+    ('rate', 'The per-second change in value of each DDF metric endpoint over the last {} seconds'),
+])
+
+
+def _window_aggregates(timestamps: array, values: array) -> dict:
+    """
+    :param timestamps: the datapoints' unix timestamps, oldest first
+    :param values: the datapoints' values
+    :return: aggregate name: value. The rate is left out unless the datapoints span some time
+    """
+    if not values:
+        return {}
+
+    # Each of these is a single loop in C over the packed array.
+    aggregates = {'min': min(values), 'max': max(values), 'mean': math.fsum(values) / len(values)}
+
+    span = timestamps[-1] - timestamps[0]
+    if span > 0:
+        aggregates['rate'] = (values[-1] - values[0]) / span
+
+    return aggregates
+
+
+def _wait_for_any(futures: List[Future], deadline: Optional[float]) -> Optional[Future]:
+    """
+    Wait for the first of several requests for the same endpoint to succeed. If they all fail, the last error
+    is raised.
+
+    :param futures: the futures fetching the endpoint
+    :param deadline: when to stop waiting, from time.monotonic(), or None to wait as long as it takes
+    :return: the first to succeed, or None if the deadline passed first
+    """
+    remaining = set(futures)
+    error = None
+    while remaining:
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        done, remaining = wait(remaining, timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            return None
+
+        for future in done:
+            if future.exception() is None:
+                return future
+            error = future.exception()
+
+    raise error
+
+
+@contextlib.contextmanager
+def scrape_deadline(deadline: Optional[float]):
+    """
+    Set when collections on this thread have to finish by, for as long as the context lasts.
+    Collections that are still waiting on endpoints at the deadline return what they have.
+
+    :param deadline: from time.monotonic(), or None for no deadline
+    """
+    previous = getattr(_scrape_context, 'deadline', None)
+    _scrape_context.deadline = deadline
+    try:
+        yield
+    finally:
+        _scrape_context.deadline = previous
+
+
+@contextlib.contextmanager
+def scrape_selection(selection: Tuple[str, ...]):
+    """
+    Limit collections on this thread to some of the endpoints, for as long as the context lasts.
+
+    :param selection: patterns, any of which has to match the whole snake_case endpoint name, or () for every
+        endpoint
+    """
+    previous = getattr(_scrape_context, 'selection', ())
+    _scrape_context.selection = selection
+    try:
+        yield
+    finally:
+        _scrape_context.selection = previous
+
+
+@functools.lru_cache(maxsize=256)
+def _selection_pattern(selection: Tuple[str, ...]):
+    """
+    :return: a single pattern matching what any of the selection's patterns match
+    :raise re.error: if any of the patterns isn't a valid regular expression
+    """
+    return re.compile('|'.join('(?:' + pattern + ')' for pattern in selection))
+
+
+def _counted(items: Iterator, counter: Counter) -> Iterator:
+    """
+    Pass the items through, adding how many there were to the counter once they run out.
+    """
+    count = 0
+    try:
+        for item in items:
+            count += 1
+            yield item
+    finally:
+        counter.inc(count)
+
+
+def _request_error_type(error: requests.RequestException) -> str:
+    """
+    :return: the type of failure to record a failed request under
+    """
+    if isinstance(error, requests.Timeout):
+        return 'timeout'
+    if isinstance(error, requests.ConnectionError):
+        return 'connection'
+    return 'request'
+
+
+def _new_data_points(data_points: Iterator[dict], high_water: Optional[float], limit: Optional[int] = None,
+                     tz: Optional[timezone] = timezone.utc) -> list:
+    """
+    Drop the datapoints that are no newer than the high water mark. The datapoints are consumed one at a time,
+    so when reading from a stream no more than limit of them are held at once.
+
+    :param data_points: the datapoints returned by an endpoint, oldest first
+    :param high_water: the timestamp of the newest datapoint already seen, as a unix timestamp
+    :param limit: how many of the newest new datapoints to keep, or None to keep all of them
+    :param tz: the timezone of formatted dates, see _parse_timestamp
+    :return: a list of the new datapoints, oldest first
+    """
+    new_points = collections.deque(maxlen=limit)
+    for data_point in data_points:
+        if high_water is not None:
+            timestamp = _parse_timestamp(data_point.get('timestamp'), tz)
+            if timestamp is not None and timestamp <= high_water:
+                continue
+        new_points.append(data_point)
+
+    return list(new_points)
+
+
+# The formats the metrics endpoint has been seen to use for its timestamps
+_TIMESTAMP_FORMATS = ('%b %d %Y %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S')
+
+
+def _parse_timezone(name: str) -> Optional[timezone]:
+    """
+    :param name: "UTC", "local", or an offset from UTC such as "+02:00", "-0500" or "+1"
+    :return: the timezone, or None for the exporter's own local timezone
+    """
+    name = name.strip()
+    if name.upper() in ('UTC', 'Z', ''):
+        return timezone.utc
+    if name.lower() == 'local':
+        return None
+
+    match = re.fullmatch(r'(?:UTC)?([+-])(\d{1,2})(?::?(\d{2}))?', name, re.IGNORECASE)
+    if match is None:
+        raise ValueError('DDF_TIMEZONE has to be "UTC", "local" or an offset such as "+02:00", not ' + repr(name))
+    sign, hours, minutes = match.groups()
+    offset = timedelta(hours=int(hours), minutes=int(minutes or 0))
+    return timezone(-offset if sign == '-' else offset)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_timestamp(timestamp, tz: Optional[timezone] = timezone.utc) -> Optional[float]:
+    """
+    Convert a datapoint's timestamp into a unix timestamp. Overlapping requests return the same timestamps again,
+    so conversions are cached.
+
+    :param timestamp: seconds or milliseconds since the epoch, or a formatted date
+    :param tz: the timezone formatted dates are in, which carry none of their own, or None for the local timezone
+    :return: the unix timestamp, or None if it couldn't be parsed
+    """
+    if isinstance(timestamp, str):
+        try:
+            timestamp = float(timestamp)
+        except ValueError:
+            for timestamp_format in _TIMESTAMP_FORMATS:
+                try:
+                    parsed = datetime.strptime(timestamp, timestamp_format)
+                except ValueError:
+                    continue
+                # A naive datetime's timestamp() takes it to be local time
+                return parsed.timestamp() if tz is None else parsed.replace(tzinfo=tz).timestamp()
+            return None
+
+    if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool):
+        # Anything past the year 5000 in seconds is much more likely to be in milliseconds.
+        return timestamp / 1000.0 if timestamp > 1e11 else float(timestamp)
+
+    return None
+
+
+def _json_to_metric_generator(json_response: dict) -> Iterator[dict]:
+    """
+    The returned JSON may or may not have multiple data rows, this helper function makes the results
+    iterable so that these multiple rows can be handled in a loop.
+
+    :param: json_response, a dict object representing the jason file. Its structure is:
     {
        "data":[
           {
@@ -169,36 +1711,1207 @@ def _json_to_metric_generator(json_response: dict) -> Iterator[dict]:
     :rtype: dict
     """
 
-    # see if there are any data tags inside the response
+    # see if there are any data tags inside the response, which may be a list or a stream of datapoints
     data = json_response.get('data')
-    if data is None or len(data) == 0:
+    if data is None:
         return
 
     for data_point in data:
         yield data_point
 
 
+# Chunks are read from the response body in this size when streaming
+_STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class _Decompressor:
+    """
+    Decompresses a response body a chunk at a time, as it is read, for the response's Content-Encoding.
+    Bodies in any other encoding are passed through as they are.
+    """
+
+    def __init__(self, content_encoding: Optional[str]):
+        encoding = (content_encoding or '').strip().lower()
+        if encoding in ('gzip', 'x-gzip'):
+            self._zlib = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._zlib = zlib.decompressobj()
+        else:
+            self._zlib = None
+        self._raw_deflate_allowed = encoding == 'deflate'
+
+    def decompress(self, data: bytes) -> bytes:
+        """
+        :raise zlib.error: if the body isn't validly compressed
+        """
+        if self._zlib is None:
+            return data
+        try:
+            result = self._zlib.decompress(data)
+        except zlib.error:
+            if not self._raw_deflate_allowed:
+                raise
+            # Some servers send a raw deflate stream, without the zlib header
+            self._zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+            result = self._zlib.decompress(data)
+        self._raw_deflate_allowed = False
+        return result
+
+    def flush(self) -> bytes:
+        return self._zlib.flush() if self._zlib is not None else b''
+
+
+class _WireCountedBody:
+    """
+    Stands in for a urllib3 response as a requests.Response's raw body, decompressing it here rather than in urllib3
+    so that the bytes received can be counted before they are decompressed.
+    """
+
+    def __init__(self, raw, wire_bytes: Counter):
+        self._raw = raw
+        self._wire_bytes = wire_bytes
+
+    def stream(self, amt: int = _STREAM_CHUNK_SIZE, decode_content: Optional[bool] = None) -> Iterator[bytes]:
+        decompressor = _Decompressor(self._raw.headers.get('Content-Encoding') if decode_content else None)
+        try:
+            for chunk in self._raw.stream(amt, decode_content=False):
+                self._wire_bytes.inc(len(chunk))
+                data = decompressor.decompress(chunk)
+                if data:
+                    yield data
+            data = decompressor.flush()
+        except zlib.error as e:
+            # Turned into a requests.ContentDecodingError, the same as when urllib3 fails to decompress
+            raise urllib3.exceptions.DecodeError('Could not decompress the response: ' + str(e))
+        if data:
+            yield data
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class _WireCountingAdapter(HTTPAdapter):
+    """
+    A connection-pooled adapter that counts the bytes of every response body received through it,
+    as they arrived over the wire, see _WireCountedBody.
+    """
+
+    def __init__(self, wire_bytes: Counter, **kwargs):
+        self.wire_bytes = wire_bytes
+        super().__init__(**kwargs)
+
+    def build_response(self, req, resp) -> requests.Response:
+        response = super().build_response(req, resp)
+        response.raw = _WireCountedBody(resp, self.wire_bytes)
+        return response
+
+
+_WHITESPACE = ' \t\n\r'
+_JSON_DECODER = json.JSONDecoder()
+
+
+class _JsonStream:
+    """
+    A read buffer over a stream of text chunks, for decoding one JSON value at a time.
+    """
+
+    def __init__(self, chunks: Iterator[str]):
+        self._chunks = chunks
+        self._buffer = ''
+        self._pos = 0
+        self._finished = False
+
+    def _read_more(self) -> bool:
+        for chunk in self._chunks:
+            if chunk:
+                # Drop what has already been consumed, so the buffer only ever holds the value being decoded.
+                self._buffer = self._buffer[self._pos:] + chunk
+                self._pos = 0
+                return True
+        self._finished = True
+        return False
+
+    def peek(self) -> str:
+        """
+        :return: the next character that isn't whitespace, without consuming it, or '' at the end of the stream
+        """
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer) or not self._read_more():
+                return self._buffer[self._pos:self._pos + 1]
+
+    def expect(self, characters: str) -> str:
+        """
+        Consume the next character that isn't whitespace, which has to be one of the given characters.
+        """
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError('Malformed JSON: expected one of {!r} but found {!r}'.format(characters, character))
+        self._pos += 1
+        return character
+
+    def value(self):
+        """
+        Consume and decode the next JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _JSON_DECODER.raw_decode(self._buffer, self._pos)
+                # A number at the very end of the buffer may carry on in the next chunk.
+                if end < len(self._buffer) or self._finished:
+                    self._pos = end
+                    return value
+            except ValueError:
+                if self._finished:
+                    raise
+            self._read_more()
+
+
+def _stream_data_points(download: requests.Response, bytes_read: Optional[Counter] = None) -> Iterator[dict]:
+    """
+    Decode the datapoints in a metric endpoint's response as the body is read, rather than loading the whole
+    document first. Only the value and timestamp of each datapoint are kept, and the other fields of the
+    document are skipped over. See _json_to_metric_generator for the structure of the document.
+
+    :param download: a response that was requested with stream=True
+    :param bytes_read: a counter to add the size of the body to as it is read
+    :rtype: dict
+    """
+    def read_chunks():
+        for chunk in download.iter_content(chunk_size=_STREAM_CHUNK_SIZE):
+            if bytes_read is not None:
+                bytes_read.inc(len(chunk))
+            yield chunk
+
+    decoder = codecs.getincrementaldecoder(download.encoding or 'utf-8')(errors='replace')
+    chunks = (decoder.decode(chunk) for chunk in read_chunks())
+    stream = _JsonStream(chunks)
+
+    try:
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+
+        while True:
+            key = stream.value()
+            stream.expect(':')
+
+            if key == 'data' and stream.peek() == '[':
+                stream.expect('[')
+                if stream.peek() == ']':
+                    stream.expect(']')
+                else:
+                    while True:
+                        data_point = stream.value()
+                        yield {'value': data_point.get('value'), 'timestamp': data_point.get('timestamp')}
+                        if stream.expect(',]') == ']':
+                            break
+            else:
+                stream.value()
+
+            if stream.expect(',}') == '}':
+                return
+    finally:
+        # Hands the connection back to the pool, even if the stream wasn't read to the end.
+        download.close()
+
+
+class _HeldStream:
+    """
+    The datapoints of a streamed response, see _stream_data_points. The request holds on to its slot until the
+    body has been read to the end or the stream is closed, as the connection is in use until then.
+    """
+
+    def __init__(self, download: requests.Response, bytes_read: Counter, on_close: Callable[[], None]):
+        """
+        :param download: a response that was requested with stream=True
+        :param bytes_read: a counter to add the size of the body to as it is read
+        :param on_close: called once, when the body has been read or the stream is closed
+        """
+        self._download = download
+        self._data_points = _stream_data_points(download, bytes_read=bytes_read)
+        self._on_close = on_close
+        self._closed = False
+
+    def __iter__(self) -> Iterator[dict]:
+        try:
+            yield from self._data_points
+        finally:
+            self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        # The generator only closes the response itself if it was started.
+        self._data_points.close()
+        self._download.close()
+        self._on_close()
+
+
+_FIRST_CAP_RE = re.compile('(.)([A-Z][a-z]+)')
+_ALL_CAP_RE = re.compile('([a-z0-9])([A-Z])')
+
+
+@functools.lru_cache(maxsize=4096)
 def _camel_to_snake_case(string: str) -> str:
     """
     converts camelCase to snake_case.
     snake_case is used for metric names.
     camelCase is used for endpoint names.
+    Endpoint names rarely change, so conversions are cached.
 
     :rtype: str
     """
-    s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', string)
-    return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
+    s1 = _FIRST_CAP_RE.sub(r'\1_\2', string)
+    return _ALL_CAP_RE.sub(r'\1_\2', s1).lower()
+
+
+def parse_target(target: str) -> Tuple[str, str]:
+    """
+    Split a target into the host address and port to gather metrics from. Targets without a scheme are
+    taken to be https, and targets without a port use HOST_PORT.
+
+    :param target: a target such as "https://ddf.example.com:8993" or "ddf.example.com"
+    :return: the host address, including the scheme, and the port
+    """
+    if '://' not in target:
+        target = 'https://' + target
+
+    url = urlsplit(target)
+    if not url.hostname:
+        raise ValueError('Invalid target: ' + target)
+
+    hostname = url.hostname
+    if ':' in hostname:
+        # IPv6 addresses have to stay bracketed once the port is appended
+        hostname = '[' + hostname + ']'
+
+    host = url.scheme + '://' + hostname
+    port = str(url.port) if url.port is not None else str(os.getenv('HOST_PORT', 8993))
+
+    return host, port
+
+
+def shard_owner(key: str, shard_count: int) -> int:
+    """
+    Pick which shard a target or endpoint belongs to, by rendezvous hashing: each shard scores the key, and the
+    highest score wins. Every replica comes to the same answer without talking to the others, and when the
+    number of shards changes only the keys won by the shards that were added or removed move.
+
+    :param key: the target, or the target and endpoint
+    :param shard_count: how many shards there are
+    :return: the index of the shard the key belongs to
+    """
+    import hashlib
+
+    return max(range(shard_count),
+               key=lambda shard: hashlib.md5('{}:{}'.format(shard, key).encode('utf-8')).digest())
+
+
+class StateStore:
+    """
+    Saves what each collector has collected to STATE_FILE, so that after a restart the exporter can serve the last
+    known values straight away and carry on fetching incrementally, rather than every target downloading its full
+    history at once.
+
+    The file is rewritten whole at most every STATE_SAVE_INTERVAL seconds, and on exit. Each version is written
+    next to the file and then renamed over it, so a crash part way through leaves the previous version intact.
+    """
+
+    # Bumped whenever the layout of the file changes, files from other versions are ignored.
+    VERSION = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        self.save_interval = float(os.getenv('STATE_SAVE_INTERVAL', 60))
+
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        # When the file was last written, from time.monotonic()
+        self._saved_at = None
+        # target: what its collector last saved
+        self._targets = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path) as state_file:
+                saved = json.load(state_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print("Error: could not read " + self.path + ", starting afresh: " + str(e))
+            return {}
+
+        if not isinstance(saved, dict) or saved.get('version') != self.VERSION:
+            return {}
+
+        return saved.get('targets', {})
+
+    def restore(self, collector: DDFCollector):
+        """
+        Hand a newly created collector whatever was saved for its target.
+        """
+        with self._lock:
+            saved = self._targets.get(collector.target)
+
+        if saved is None:
+            return
+
+        try:
+            collector.restore_state(saved)
+        except (KeyError, TypeError, ValueError) as e:
+            print("Error: could not restore the saved state of " + collector.target + ": " + str(e))
+
+    def record(self, collector: DDFCollector) -> bool:
+        """
+        Take a copy of the collector's state.
+
+        :return: whether the file is due to be saved, which is left to the caller
+        """
+        saved = collector.saved_state()
+        saved['saved_at'] = time.time()
+
+        with self._lock:
+            self._targets[collector.target] = saved
+            return self._saved_at is None or time.monotonic() - self._saved_at >= self.save_interval
+
+    def save(self):
+        """
+        Write out everything recorded so far.
+        """
+        with self._save_lock:
+            with self._lock:
+                output = json.dumps({'version': self.VERSION, 'targets': self._targets}, separators=(',', ':'))
+                self._saved_at = time.monotonic()
+
+            temp_path = self.path + '.tmp'
+            try:
+                with open(temp_path, 'w') as state_file:
+                    state_file.write(output)
+                    state_file.flush()
+                    os.fsync(state_file.fileno())
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                print("Error: could not save state to " + self.path + ": " + str(e))
+
+
+class TargetPool:
+    """
+    The DDF instances this process gathers metrics from. Each target keeps its own collector, and with it its own
+    endpoint cache and connection pool, while the worker threads and the limit on requests in flight are shared.
+    """
+
+    def __init__(self, collector_class: type = DDFCollector, start_polling: bool = True):
+        """
+        :param collector_class: the class of collector to create for each target
+        :param start_polling: whether to start each collector's polling thread when POLL_INTERVAL is set,
+            rather than leaving polling to the caller
+        """
+        self.collector_class = collector_class
+        self.start_polling = start_polling
+        self.max_concurrent_requests = int(os.getenv('MAX_CONCURRENT_REQUESTS', os.getenv('FETCH_WORKERS', 8)))
+        self.shard_count = int(os.getenv('SHARD_COUNT', 1))
+        self.shard_index = int(os.getenv('SHARD_INDEX', 0))
+        self.shard_endpoints = os.getenv('SHARD_ENDPOINTS', "False")
+        if self.shard_count < 1 or not 0 <= self.shard_index < self.shard_count:
+            raise ValueError('SHARD_INDEX must be from 0 to SHARD_COUNT - 1, but is {} of {}'.format(
+                self.shard_index, self.shard_count))
+
+        self.executor = ThreadPoolExecutor(max_workers=max(self.max_concurrent_requests, 1),
+                                           thread_name_prefix='ddf-fetch')
+        self.request_slots = threading.BoundedSemaphore(max(self.max_concurrent_requests, 1))
+
+        state_file = os.getenv('STATE_FILE')
+        self.state_store = StateStore(state_file) if state_file else None
+        if self.state_store is not None:
+            atexit.register(self.state_store.save)
+
+        # Targets only asked for on /probe are dropped again once they've gone unused, see probe()
+        self.probe_max_targets = max(int(os.getenv('PROBE_MAX_TARGETS', 100)), 1)
+        self.probe_idle_timeout = float(os.getenv('PROBE_IDLE_TIMEOUT', 3600))
+        probe_targets = os.getenv('PROBE_TARGETS')
+        self.probe_targets = re.compile(probe_targets) if probe_targets else None
+
+        self._collectors = {}
+        # The keys of the probed targets, least recently probed first, with when each was last probed
+        self._probed = collections.OrderedDict()
+        self._eviction_listeners = []
+        self._lock = threading.Lock()
+
+    def get(self, target: Optional[str] = None, site_name: Optional[str] = None,
+            shard_endpoints: bool = False) -> DDFCollector:
+        """
+        Look up the collector for a target, creating it on first use.
+
+        :param target: the target to gather metrics from, defaults to HOST_ADDRESS and HOST_PORT
+        :param site_name: the name of the DDF instance, only used when the collector is created
+        :param shard_endpoints: whether to only collect this replica's shard of the target's endpoints,
+            only used when the collector is created. The HOST_ADDRESS target's endpoints are always sharded,
+            as there is nothing else to split between replicas.
+        :return: the target's collector
+        """
+        if target is None:
+            host, port = os.getenv('HOST_ADDRESS', 'https://localhost'), str(os.getenv('HOST_PORT', 8993))
+            shard_endpoints = True
+        else:
+            host, port = parse_target(target)
+
+        with self._lock:
+            # Kept for good from now on, even if it was probed first
+            self._probed.pop(host + ':' + port, None)
+            return self._collector(host, port, site_name, shard_endpoints)
+
+    def probe(self, target: str, site_name: Optional[str] = None) -> DDFCollector:
+        """
+        Look up the collector for a target asked for on /probe, creating it on first use. Unlike the targets
+        from get(), at most PROBE_MAX_TARGETS of these are kept, and each is dropped once it hasn't been probed
+        for PROBE_IDLE_TIMEOUT seconds, so that arbitrary targets can't pile up.
+
+        :param target: the target to gather metrics from, which has to match PROBE_TARGETS if it is set
+        :param site_name: the name of the DDF instance, only used when the collector is created
+        :return: the target's collector
+        :raises ValueError: if the target is invalid or not allowed
+        """
+        host, port = parse_target(target)
+        key = host + ':' + port
+        if self.probe_targets is not None and not self.probe_targets.fullmatch(key):
+            raise ValueError('Target is not allowed: ' + target)
+
+        now = time.monotonic()
+        with self._lock:
+            if key not in self._collectors or key in self._probed:
+                self._probed[key] = now
+                self._probed.move_to_end(key)
+            collector = self._collector(host, port, site_name, shard_endpoints=False)
+            evicted = self._evict_probed(now)
+
+        self._close_evicted(evicted)
+        return collector
+
+    def evict_idle(self):
+        """
+        Drop the probed targets that haven't been probed for PROBE_IDLE_TIMEOUT seconds.
+        """
+        with self._lock:
+            evicted = self._evict_probed(time.monotonic())
+        self._close_evicted(evicted)
+
+    def add_eviction_listener(self, listener: Callable[[DDFCollector], None]):
+        """
+        :param listener: called with each probed target's collector that is dropped, before it is closed
+        """
+        self._eviction_listeners.append(listener)
+
+    def _collector(self, host: str, port: str, site_name: Optional[str], shard_endpoints: bool) -> DDFCollector:
+        # Called with the lock held
+        key = host + ':' + port
+        collector = self._collectors.get(key)
+        if collector is None:
+            endpoint_shard = (self.shard_index, self.shard_count) if shard_endpoints and self.shard_count > 1 \
+                else None
+            collector = self.collector_class(host=host, host_port=port, site_name=site_name,
+                                             executor=self.executor, request_slots=self.request_slots,
+                                             state_store=self.state_store, endpoint_shard=endpoint_shard)
+            self._collectors[key] = collector
+
+            if collector.poll_interval > 0 and self.start_polling:
+                collector.start_polling()
+
+        return collector
+
+    def _evict_probed(self, now: float) -> List[DDFCollector]:
+        # Called with the lock held
+        evicted = []
+        while self._probed:
+            key, last_probed = next(iter(self._probed.items()))
+            if len(self._probed) <= self.probe_max_targets and now - last_probed < self.probe_idle_timeout:
+                break
+            del self._probed[key]
+            evicted.append(self._collectors.pop(key))
+        return evicted
+
+    def _close_evicted(self, evicted: List[DDFCollector]):
+        for collector in evicted:
+            for listener in self._eviction_listeners:
+                listener(collector)
+            collector.close()
+            # Otherwise every target ever probed would stay on /metrics
+            collector.remove_exporter_metrics()
+
+    def load_targets(self, path: str) -> List[DDFCollector]:
+        """
+        Read a static list of targets from a JSON file. Each entry is either a target string,
+        or an object with a "target" and optionally a "site_name" and "shard_endpoints":
+
+            ["https://ddf-a:8993", {"target": "https://ddf-b:8993", "site_name": "Site B", "shard_endpoints": true}]
+
+        When SHARD_COUNT is set, only the targets in this replica's shard are kept. Targets with shard_endpoints,
+        which defaults to SHARD_ENDPOINTS, are kept by every replica, which each collect a shard of their endpoints.
+
+        :param path: the path to the targets file
+        :return: the collectors for each of the targets kept, in the order they are listed
+        """
+        with open(path) as targets_file:
+            entries = json.load(targets_file)
+
+        collectors = []
+        for entry in entries:
+            if isinstance(entry, str):
+                entry = {'target': entry}
+
+            shard_endpoints = entry.get('shard_endpoints', self.shard_endpoints == "True")
+            if shard_endpoints or self.owns(entry['target']):
+                collectors.append(self.get(entry['target'], site_name=entry.get('site_name'),
+                                           shard_endpoints=shard_endpoints))
+
+        return collectors
+
+    def owns(self, target: str) -> bool:
+        """
+        :return: whether the target falls in this replica's shard, which it always does without SHARD_COUNT
+        """
+        host, port = parse_target(target)
+        return self.shard_count == 1 or shard_owner(host + ':' + port, self.shard_count) == self.shard_index
+
+    def shutdown(self):
+        """
+        Stop polling, save the state, and let go of the worker threads without waiting for them, as a request
+        stuck on an unresponsive target could otherwise hold up the exit for as long as its timeout.
+        """
+        with self._lock:
+            collectors = list(self._collectors.values())
+        for collector in collectors:
+            collector._stop_polling.set()
+
+        if self.state_store is not None:
+            self.state_store.save()
+
+        try:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+        except TypeError:
+            # Python < 3.9 can't cancel the queued requests, which are dropped on exit all the same
+            self.executor.shutdown(wait=False)
+
+
+def _merge_metrics(results: List[list]) -> list:
+    """
+    Merge the metrics collected from several targets, so that each metric name is only exposed once.
+
+    :param results: the metrics from each target, in target order
+    :return: the merged metrics
+    """
+    merged = {}
+    for metrics in results:
+        for metric in metrics:
+            if metric.name not in merged:
+                merged[metric.name] = GaugeMetricFamily(metric.name, metric.documentation)
+            merged[metric.name].samples.extend(metric.samples)
+
+    return list(merged.values())
+
+
+class FleetCollector:
+    """
+    Collects from several targets at once and merges their metrics, so that each metric name is only
+    exposed once, with a series per target.
+    """
+
+    def __init__(self, collectors: List[DDFCollector], max_workers: int = 32):
+        self.collectors = collectors
+        # Each target's collection mostly waits on its own fetches, which run on the shared pool.
+        self._executor = ThreadPoolExecutor(max_workers=max(min(len(collectors), max_workers), 1),
+                                            thread_name_prefix='ddf-target')
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        # The targets are collected on other threads, which have to be handed this scrape's deadline and selection.
+        deadline = getattr(_scrape_context, 'deadline', None)
+        selection = getattr(_scrape_context, 'selection', ())
+        pending = [self._executor.submit(self._collect_target, collector, deadline, selection)
+                   for collector in self.collectors]
+
+        results = []
+        for collector, future in zip(self.collectors, pending):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                print("Error: could not collect from " + collector.host + ": " + str(e))
+                results.append([])
+
+        yield from _merge_metrics(results)
+
+    @staticmethod
+    def _collect_target(collector: DDFCollector, deadline: Optional[float], selection: Tuple[str, ...]) -> list:
+        with scrape_deadline(deadline), scrape_selection(selection):
+            return list(collector.collect())
+
+
+class RenderedExposition(NamedTuple):
+    """
+    A registry's output, rendered once and kept ready to send both as-is and gzipped.
+    """
+    content_type: str
+    plain: bytes
+    gzipped: bytes
+    # When it was rendered, from time.monotonic()
+    rendered_at: float
+    # The snapshot generation it was rendered from
+    generation: int
+
+    def output_for(self, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+        """
+        Pick which of the rendered outputs to send, and count the bytes it saved.
+
+        :param accept_encoding: the scraper's Accept-Encoding header
+        :return: the output, and its Content-Encoding or None if it isn't compressed
+        """
+        if _accepts_gzip(accept_encoding):
+            output, encoding = self.gzipped, 'gzip'
+        else:
+            output, encoding = self.plain, None
+        _EXPOSITION_BYTES.labels(encoding or 'identity').inc(len(output))
+        _EXPOSITION_UNCOMPRESSED_BYTES.inc(len(self.plain))
+        return output, encoding
+
+
+def _accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    """
+    :return: whether an Accept-Encoding header allows a gzipped response, so not when it is given a q of 0
+    """
+    for coding in (accept_encoding or '').split(','):
+        name, _, params = coding.partition(';')
+        if name.strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+class _Render:
+    """
+    A render in progress, which concurrent requests for the same output wait on instead of starting their own.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ExpositionCache:
+    """
+    Renders a registry's output once, and serves the same bytes to every scraper until it is out of date.
+    Scrapes that arrive while the output is being rendered wait for that render rather than starting another.
+
+    Rendered output is out of date once EXPOSITION_CACHE_TTL seconds have passed. When polling in the background,
+    it is also out of date once a poll finishes, or once POLL_INTERVAL seconds have passed in case a poll is stuck,
+    and with no EXPOSITION_CACHE_TTL it is kept until then. Output that can't be reused isn't kept at all, and only
+    the most recently used renders are kept, since scrapers pick the selections.
+    """
+    # The most renders kept, one for each content type and selection
+    max_rendered = 32
+
+    def __init__(self, registry: CollectorRegistry):
+        self.registry = registry
+        self.ttl = float(os.getenv('EXPOSITION_CACHE_TTL', 0))
+        self.poll_interval = float(os.getenv('POLL_INTERVAL', 0))
+
+        # (content type, selection): RenderedExposition, least recently used first
+        self._rendered = collections.OrderedDict()
+        # (content type, selection): _Render
+        self._renders = {}
+        self._lock = threading.Lock()
+
+    def get(self, accept_header: Optional[str] = None, selection: Tuple[str, ...] = ()) -> RenderedExposition:
+        """
+        :param accept_header: the scraper's Accept header, which picks between the text and OpenMetrics formats
+        :param selection: the collect[] patterns the scrape asked for, each of which is rendered separately.
+            The collection itself has to be limited to them with scrape_selection
+        :return: the rendered output
+        """
+        encoder, content_type = choose_encoder(accept_header)
+        key = (content_type, selection)
+
+        with self._lock:
+            rendered = self._rendered.get(key)
+            if rendered is not None and self._is_current(rendered):
+                self._rendered.move_to_end(key)
+                _CACHE_REQUESTS.labels('exposition', 'hit').inc()
+                return rendered
+
+            render = self._renders.get(key)
+            leader = render is None
+            if leader:
+                render = self._renders[key] = _Render()
+
+        # Waiting on another scrape's render still saves a collection.
+        _CACHE_REQUESTS.labels('exposition', 'miss' if leader else 'hit').inc()
+
+        if not leader:
+            render.done.wait()
+            if render.error is not None:
+                raise render.error
+            return render.result
+
+        try:
+            generation = _snapshot_generation
+            plain = encoder(self.registry)
+            render.result = RenderedExposition(content_type=content_type, plain=plain, gzipped=gzip.compress(plain),
+                                               rendered_at=time.monotonic(), generation=generation)
+        except Exception as e:
+            render.error = e
+            raise
+        finally:
+            with self._lock:
+                if render.result is not None:
+                    self._keep(key, render.result)
+                del self._renders[key]
+            render.done.set()
+
+        return render.result
+
+    def _keep(self, key: tuple, rendered: RenderedExposition):
+        # With neither a TTL nor polling, nothing rendered is ever current again.
+        if self.ttl <= 0 and self.poll_interval <= 0:
+            return
+        self._rendered[key] = rendered
+        self._rendered.move_to_end(key)
+        while len(self._rendered) > self.max_rendered:
+            self._rendered.popitem(last=False)
+
+    def _is_current(self, rendered: RenderedExposition) -> bool:
+        if self.ttl > 0 and time.monotonic() - rendered.rendered_at >= self.ttl:
+            return False
+
+        if self.poll_interval > 0:
+            return rendered.generation == _snapshot_generation and \
+                time.monotonic() - rendered.rendered_at < self.poll_interval
+
+        return self.ttl > 0
+
+
+class StackSampler:
+    """
+    Samples the stack of every thread at a fixed interval. Unlike cProfile, this covers the worker pool, the
+    pollers and the event loop as well as the thread that started it.
+
+    There is one sampler for the process, see _stack_sampler. Every collection or profile that wants samples
+    subscribes to it, so concurrent collections share one thread walking the stacks rather than starting one
+    each, and the thread only runs while something is subscribed.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stop = None
+        self._thread = None
+
+    def subscribe(self) -> collections.Counter:
+        """
+        :return: the counter the samples are added to until unsubscribe() is called with it: each stack seen, as a
+            string of frames from the root down separated by semicolons, and how often
+        """
+        samples = collections.Counter()
+        with self._lock:
+            self._subscribers.append(samples)
+            if self._thread is None:
+                self._stop = threading.Event()
+                self._thread = threading.Thread(target=self._run, args=(self._stop,), name='ddf-sampler', daemon=True)
+                self._thread.start()
+        return samples
+
+    def unsubscribe(self, samples: collections.Counter) -> collections.Counter:
+        """
+        Stop adding to the samples, and stop the sampling thread if nothing else is subscribed. Unsubscribing
+        more than once is fine.
+
+        :param samples: the counter returned by subscribe()
+        :return: the samples
+        """
+        thread = None
+        with self._lock:
+            self._subscribers = [subscriber for subscriber in self._subscribers if subscriber is not samples]
+            if not self._subscribers and self._thread is not None:
+                self._stop.set()
+                thread, self._thread = self._thread, None
+
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        return samples
+
+    def _run(self, stop: threading.Event):
+        own_id = threading.get_ident()
+        while not stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            samples = collections.Counter()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    stack.append(frame.f_code.co_name + ' (' + os.path.basename(frame.f_code.co_filename) + ')')
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+
+                samples[';'.join(reversed(stack))] += 1
+
+            with self._lock:
+                for subscriber in self._subscribers:
+                    subscriber.update(samples)
+
+    @staticmethod
+    def report(samples: collections.Counter) -> str:
+        """
+        :return: the samples as collapsed stacks, most frequent first, which flamegraph.pl and speedscope can read
+        """
+        lines = ['# {} samples, as collapsed stacks'.format(sum(samples.values()))]
+        lines += ['{} {}'.format(stack, count) for stack, count in samples.most_common()]
+        return '\n'.join(lines)
+
+
+class CollectionProfile:
+    """
+    Samples every thread until the next few collections have finished, see /debug/profile.
+    """
+
+    def __init__(self, collections: int):
+        self.remaining = max(collections, 1)
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def collection_finished(self):
+        with self._lock:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.done.set()
+
+    def run(self, timeout: float) -> str:
+        """
+        :param timeout: the most seconds to wait for the collections
+        :return: the report
+        """
+        started = time.monotonic()
+        samples = _stack_sampler.subscribe()
+        _active_profiles.append(self)
+        try:
+            finished = self.done.wait(timeout)
+        finally:
+            _active_profiles.remove(self)
+            _stack_sampler.unsubscribe(samples)
+
+        header = '# Sampled for {:.1f}s{}\n'.format(time.monotonic() - started,
+                                                  '' if finished else ', the collections didn\'t finish in time')
+        return header + StackSampler.report(samples)
+
+
+# The sampler shared by SLOW_COLLECTION_THRESHOLD and /debug/profile, which has no thread until one of them subscribes
+_stack_sampler = StackSampler()
+
+# The profiles waiting on collections to finish, which is empty unless /debug/profile is being used
+_active_profiles = []
+
+
+def heap_report(limit: int = 50) -> str:
+    """
+    Report where the memory that is currently allocated was allocated, and what has changed since the previous
+    report. Allocations are only traced from the first report on, see /debug/heap.
+
+    :param limit: how many lines to report
+    :return: the report
+    """
+    global _previous_heap_snapshot
+    import tracemalloc
+
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(int(os.getenv('TRACEMALLOC_FRAMES', 1)))
+        return '# Started tracing allocations, ask again to see where memory is being allocated'
+
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+
+    lines = ['# {} bytes traced, {} at peak'.format(current, peak), '', '# Largest allocations by line']
+    lines += [str(stat) for stat in snapshot.statistics('lineno')[:limit]]
+
+    if _previous_heap_snapshot is not None:
+        lines += ['', '# Largest changes since the previous report']
+        lines += [str(stat) for stat in snapshot.compare_to(_previous_heap_snapshot, 'lineno')[:limit]]
+
+    _previous_heap_snapshot = snapshot
+    return '\n'.join(lines)
+
+
+_previous_heap_snapshot = None
+
+
+def debug_response(path: str, params: dict) -> Tuple[int, str]:
+    """
+    Answer a request to one of the /debug/ endpoints. /debug/profile?collections=N&timeout=T samples every thread
+    until the next N collections have finished, and /debug/heap reports where memory is allocated.
+
+    :return: the status code, and the report
+    :raise ValueError: if the parameters aren't numbers
+    """
+    if path == '/debug/profile':
+        collections = int(params.get('collections', ['1'])[0])
+        timeout = float(params.get('timeout', ['60'])[0])
+        return 200, CollectionProfile(collections).run(timeout)
+
+    if path == '/debug/heap':
+        return 200, heap_report()
+
+    return 404, 'Not found'
+
+
+# Seconds taken off Prometheus' scrape timeout to get the collection's deadline
+SCRAPE_TIMEOUT_OFFSET = float(os.getenv('SCRAPE_TIMEOUT_OFFSET', 0.5))
+
+
+def scrape_timeout_deadline(scrape_timeout: Optional[str]) -> Optional[float]:
+    """
+    :param scrape_timeout: the X-Prometheus-Scrape-Timeout-Seconds header sent with the scrape
+    :return: when the collection has to finish for the response to reach Prometheus before it gives up,
+        from time.monotonic(), or None if Prometheus didn't send its scrape timeout
+    """
+    try:
+        scrape_timeout = float(scrape_timeout)
+    except (TypeError, ValueError):
+        return None
+
+    # Leave some of the timeout for rendering and sending the response.
+    return time.monotonic() + max(scrape_timeout - SCRAPE_TIMEOUT_OFFSET, 0)
+
+
+def parse_selection(params: dict) -> Tuple[str, ...]:
+    """
+    :param params: the scrape's query parameters, from parse_qs
+    :return: the collect[] patterns the scrape asked for, in a consistent order, or () for every endpoint
+    :raise ValueError: if any of the patterns isn't a valid regular expression
+    """
+    selection = tuple(sorted(set(params.get('collect[]', []))))
+    try:
+        _selection_pattern(selection)
+    except re.error as e:
+        raise ValueError('Invalid collect[] pattern: ' + str(e))
+    return selection
+
+
+class ExporterRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves /metrics from the default registry, and /probe?target=... for a single target, blackbox exporter style.
+    /-/healthy answers as long as the process is serving, and /-/ready once the warm-up has finished.
+    """
+    # Set by start_exporter_server
+    metrics_cache = None
+    target_pool = None
+    probe_caches = None
+    probe_caches_lock = None
+    ready = None
+    debug_endpoints = "False"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+        self.target_pool.evict_idle()
+
+        if url.path == '/-/healthy':
+            self._send_text(200, 'Healthy')
+
+        elif url.path == '/-/ready':
+            if self.ready is None or self.ready.is_set():
+                self._send_text(200, 'Ready')
+            else:
+                self._send_text(503, 'Warming up')
+
+        elif url.path in ('/', '/metrics'):
+            try:
+                selection = parse_selection(params)
+            except ValueError as e:
+                self._send_text(400, str(e))
+                return
+
+            self._send_metrics(self.metrics_cache, selection)
+
+        elif url.path.startswith('/debug/') and self.debug_endpoints == "True":
+            try:
+                self._send_text(*debug_response(url.path, params))
+            except ValueError as e:
+                self._send_text(400, str(e))
+
+        elif url.path == '/probe':
+            target = params.get('target', [None])[0]
+            if not target:
+                self._send_text(400, 'Missing target parameter')
+                return
+
+            try:
+                selection = parse_selection(params)
+                collector = self.target_pool.probe(target, site_name=params.get('site_name', [None])[0])
+            except ValueError as e:
+                self._send_text(400, str(e))
+                return
+
+            self._send_metrics(self._probe_cache(collector), selection)
+
+        else:
+            self._send_text(404, 'Not found')
+
+    def _probe_cache(self, collector: DDFCollector) -> ExpositionCache:
+        with self.probe_caches_lock:
+            cache = self.probe_caches.get(collector)
+            if cache is None:
+                registry = CollectorRegistry(auto_describe=False)
+                registry.register(collector)
+                cache = self.probe_caches[collector] = ExpositionCache(registry)
+        return cache
+
+    def _send_metrics(self, cache: ExpositionCache, selection: Tuple[str, ...]):
+        try:
+            with scrape_deadline(scrape_timeout_deadline(self.headers.get('X-Prometheus-Scrape-Timeout-Seconds'))), \
+                    scrape_selection(selection):
+                rendered = cache.get(self.headers.get('Accept'), selection)
+        except Exception as e:
+            print("Error: could not generate metric output: " + str(e))
+            self._send_text(500, 'Error generating metric output: ' + str(e))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', rendered.content_type)
+        output, encoding = rendered.output_for(self.headers.get('Accept-Encoding'))
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def _send_text(self, code: int, message: str):
+        output = (message + '\n').encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+
+    def log_message(self, format, *args):
+        # Scrapes are far too frequent to log.
+        pass
+
+
+class ExporterHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_exporter_server(port: int, target_pool: TargetPool, registry: CollectorRegistry = REGISTRY,
+                          addr: str = '', ready: Optional[threading.Event] = None) -> ExporterHTTPServer:
+    """
+    Start serving the exporter's endpoints on a background thread.
+
+    :param ready: set once the exporter is ready to be scraped, see /-/ready. If None, it is ready straight away
+    :return: the running server
+    """
+    probe_caches, probe_caches_lock = {}, threading.Lock()
+
+    def forget_probe_cache(collector):
+        with probe_caches_lock:
+            probe_caches.pop(collector, None)
+
+    target_pool.add_eviction_listener(forget_probe_cache)
+    handler = type('Handler', (ExporterRequestHandler,), {
+        'metrics_cache': ExpositionCache(registry),
+        'target_pool': target_pool,
+        'probe_caches': probe_caches,
+        'probe_caches_lock': probe_caches_lock,
+        'ready': ready,
+        # Have to hardcode strings because dockerfiles cannot handle booleans
+        'debug_endpoints': os.getenv('DEBUG_ENDPOINTS', "False"),
+    })
+    server = ExporterHTTPServer((addr, port), handler)
+    threading.Thread(target=server.serve_forever, name='ddf-http', daemon=True).start()
+    return server
+
+
+def warm_up(collectors: List[DDFCollector], ready: threading.Event, max_workers: int = 32):
+    """
+    Warm up every collector at once, and then mark the exporter as ready. It is marked as ready even if
+    some of the targets couldn't be reached, since scrapes can still be answered.
+
+    :param collectors: the collectors to warm up
+    :param ready: set once every collector has been warmed up
+    :param max_workers: the most collectors to warm up at the same time
+    """
+    def warm_up_collector(collector):
+        try:
+            collector.warm_up()
+        except Exception as e:
+            print("Error: could not warm up " + collector.host + ": " + str(e))
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(min(len(collectors), max_workers), 1),
+                                thread_name_prefix='ddf-warm-up') as executor:
+            list(executor.map(warm_up_collector, collectors))
+    finally:
+        ready.set()
 
 
 def sigterm_handler(_signo, _stack_frame):
     sys.exit(0)
 
 
-if __name__ == '__main__':
+def main():
+    signal.signal(signal.SIGTERM, sigterm_handler)
+
+    # /metrics covers either the static target list, or the single target from the environment.
+    targets_file = os.getenv('TARGETS_FILE')
+
+    if os.getenv('RUNTIME', 'threaded') == 'asyncio':
+        from ddf_exporter_async import run_async_exporter
+        run_async_exporter(int(os.getenv('BIND_PORT', 9170)), targets_file)
+        return
+
+    target_pool = TargetPool()
+    ready = threading.Event()
+
     # Ensure we have something to export
-    start_http_server(int(os.getenv('BIND_PORT', 9170)))
-    REGISTRY.register(DDFCollector())
+    start_exporter_server(int(os.getenv('BIND_PORT', 9170)), target_pool, ready=ready)
 
-    signal.signal(signal.SIGTERM, sigterm_handler)
-    while True:
-        time.sleep(1)
+    collectors = target_pool.load_targets(targets_file) if targets_file else [target_pool.get()]
+    if targets_file:
+        REGISTRY.register(FleetCollector(collectors, max_workers=target_pool.max_concurrent_requests))
+    else:
+        REGISTRY.register(collectors[0])
+
+    # Have to hardcode strings because dockerfiles cannot handle booleans
+    if os.getenv('WARM_UP', "False") == "True":
+        threading.Thread(target=warm_up, args=(collectors, ready), name='ddf-warm-up', daemon=True).start()
+    else:
+        ready.set()
+
+    try:
+        while True:
+            time.sleep(1)
+    finally:
+        target_pool.shutdown()
+        # The interpreter joins every worker thread on the way out, including any stuck on a request to DDF,
+        # and only runs the atexit handlers after that. The state has been saved, so leave straight away.
+        sys.stdout.flush()
+        os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,988 @@
+# The exporter's asyncio runtime, see RUNTIME=asyncio. It lives apart from ddf_exporter so that the threaded
+# runtime doesn't pay for importing asyncio and ssl at startup.
+
+from typing import Optional, Union, NamedTuple, Tuple, List
+from prometheus_client import CollectorRegistry
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+from prometheus_client.exposition import choose_encoder
+from http import HTTPStatus
+from urllib.parse import urlsplit, urljoin, parse_qs
+
+import requests, time, os, signal, json, gzip, asyncio, ssl, zlib
+import ddf_exporter
+from ddf_exporter import DDFCollector, ExpositionCache, RenderedExposition, RequestBudgetExhausted, Snapshot, \
+    TargetPool, _CACHE_REQUESTS, _CollectionOutcome, _DISCOVERY_DURATION, _Decompressor, _HedgedFetch, \
+    _REQUEST_ERRORS, _STREAM_CHUNK_SIZE, _merge_metrics, _stack_sampler, debug_response, parse_selection, \
+    scrape_selection, scrape_timeout_deadline
+
+
+# The redirects AsyncHTTPClient follows, which are all answered with a GET as only GETs are made
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+# Responses that never have a body, whatever their headers say, along with every 1xx and any answer to a HEAD
+_NO_BODY_CODES = (204, 304)
+
+
+class AsyncHTTPError(Exception):
+    """
+    The host's answer couldn't be read as an HTTP response.
+    """
+
+
+class _ConnectionClosed(AsyncHTTPError):
+    """
+    The host closed the connection before answering.
+    """
+
+
+class AsyncResponse(NamedTuple):
+    """
+    A response read by AsyncHTTPClient, with the body already read in full and decompressed.
+    """
+    status_code: int
+    headers: dict
+    content: bytes
+    # The size of the body as it was received, before it was decompressed
+    wire_bytes: int = 0
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+
+class AsyncHTTPClient:
+    """
+    A minimal HTTP/1.1 client on asyncio streams, for fetching from DDF without a thread per request.
+    Idle connections are kept open between requests, up to pool_size per host. Proxies aren't supported.
+    """
+
+    # The most redirects to follow for a single request, the same as requests
+    max_redirects = 30
+
+    def __init__(self, verify: Union[bool, str], pool_size: int = 10, keep_alive: bool = True,
+                 connect_timeout: float = 5.0, read_timeout: float = 30.0, compression: bool = True):
+        """
+        :param verify: False to operate insecurely, or the path to the ca cert to verify https hosts against
+        :param compression: whether to ask for gzip or deflate compressed responses
+        """
+        self.pool_size = max(pool_size, 1)
+        self.keep_alive = keep_alive
+        self.compression = compression
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        if verify is False:
+            self._ssl = ssl.create_default_context()
+            self._ssl.check_hostname = False
+            self._ssl.verify_mode = ssl.CERT_NONE
+        else:
+            self._ssl = ssl.create_default_context(cafile=verify)
+
+        # (scheme, host, port): a list of idle (reader, writer) pairs
+        self._idle = {}
+
+    async def get(self, url: str) -> AsyncResponse:
+        """
+        :param url: the url to request. Redirects are followed, up to max_redirects of them
+        :return: the response
+        :raise OSError: if the host couldn't be reached
+        :raise asyncio.TimeoutError: if the host took longer than the connect or read timeout
+        :raise AsyncHTTPError: if the host's answer couldn't be read, or it redirected too many times
+        """
+        redirects = 0
+        while True:
+            response = await self._get_once(url)
+            location = response.headers.get('location')
+            if response.status_code not in _REDIRECT_CODES or not location:
+                return response
+
+            if redirects >= self.max_redirects:
+                raise AsyncHTTPError('Exceeded {} redirects'.format(self.max_redirects))
+            redirects += 1
+            url = urljoin(url, location)
+
+    async def _get_once(self, url: str) -> AsyncResponse:
+        url_parts = urlsplit(url)
+        key = (url_parts.scheme, url_parts.hostname, url_parts.port or (443 if url_parts.scheme == 'https' else 80))
+        path = (url_parts.path or '/') + ('?' + url_parts.query if url_parts.query else '')
+        host_header = url_parts.netloc.rpartition('@')[2]
+
+        method = 'GET'
+        request = ('{method} {path} HTTP/1.1\r\n'
+                   'Host: {host}\r\n'
+                   'Accept: application/json\r\n'
+                   'Accept-Encoding: {encoding}\r\n'
+                   'Connection: {connection}\r\n'
+                   '\r\n').format(method=method, path=path, host=host_header,
+                                  encoding='gzip, deflate' if self.compression else 'identity',
+                                  connection='keep-alive' if self.keep_alive else 'close').encode('latin-1')
+
+        while True:
+            reused, reader, writer = await self._connect(key)
+            try:
+                writer.write(request)
+                await writer.drain()
+                response, reusable = await asyncio.wait_for(self._read_response(reader, method), self.read_timeout)
+            except (ConnectionError, asyncio.IncompleteReadError, _ConnectionClosed):
+                writer.close()
+                # The host may have closed an idle connection just as it was picked up, so try again
+                # on a fresh one. A fresh connection failing is a real failure.
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+
+            if reusable and self.keep_alive:
+                self._release(key, reader, writer)
+            else:
+                writer.close()
+
+            return response
+
+    async def _connect(self, key: tuple) -> tuple:
+        """
+        :return: whether the connection was reused, and its reader and writer
+        """
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof():
+                return True, reader, writer
+            writer.close()
+
+        scheme, host, port = key
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=self._ssl if scheme == 'https' else None),
+            self.connect_timeout)
+        return False, reader, writer
+
+    def _release(self, key: tuple, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        idle = self._idle.setdefault(key, [])
+        if len(idle) < self.pool_size:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader, method: str = 'GET') -> tuple:
+        """
+        :param method: the request's method, as the answer to a HEAD has no body
+        :return: the response, and whether the connection can be used for another request
+        """
+        while True:
+            status_line = await reader.readline()
+            if not status_line:
+                raise _ConnectionClosed('Connection closed before the response was received')
+
+            try:
+                version, status, _ = (status_line.decode('latin-1').split(None, 2) + [''])[:3]
+                status_code = int(status)
+            except ValueError:
+                raise AsyncHTTPError('Malformed status line: ' + repr(status_line))
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            # An interim response, such as 100 Continue, is followed by the actual one
+            if not 100 <= status_code < 200 or status_code == 101:
+                break
+
+        # The body is decompressed as each piece of it arrives, rather than all at once at the end.
+        decompressor = _Decompressor(headers.get('content-encoding'))
+        body = bytearray()
+        wire_bytes = 0
+
+        reusable = True
+        try:
+            if method == 'HEAD' or 100 <= status_code < 200 or status_code in _NO_BODY_CODES:
+                # Otherwise a keep-alive response without a length would be read until the read timeout
+                pass
+            elif headers.get('transfer-encoding', '').lower() == 'chunked':
+                while True:
+                    try:
+                        size = int((await reader.readline()).split(b';')[0].strip(), 16)
+                    except ValueError:
+                        raise AsyncHTTPError('Malformed chunk size')
+                    if size == 0:
+                        # Skip any trailers
+                        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                            pass
+                        break
+                    data = await reader.readexactly(size)
+                    await reader.readexactly(2)
+                    wire_bytes += len(data)
+                    body += decompressor.decompress(data)
+            elif 'content-length' in headers:
+                remaining = int(headers['content-length'])
+                while remaining > 0:
+                    data = await reader.readexactly(min(remaining, _STREAM_CHUNK_SIZE))
+                    remaining -= len(data)
+                    wire_bytes += len(data)
+                    body += decompressor.decompress(data)
+            else:
+                # The body runs until the host closes the connection.
+                while True:
+                    data = await reader.read(_STREAM_CHUNK_SIZE)
+                    if not data:
+                        break
+                    wire_bytes += len(data)
+                    body += decompressor.decompress(data)
+                reusable = False
+            body += decompressor.flush()
+        except zlib.error as e:
+            raise AsyncHTTPError('Could not decompress the response: ' + str(e))
+
+        connection = headers.get('connection', '').lower()
+        if connection == 'close' or (version == 'HTTP/1.0' and connection != 'keep-alive'):
+            reusable = False
+
+        return AsyncResponse(status_code=status_code, headers=headers, content=bytes(body),
+                             wire_bytes=wire_bytes), reusable
+
+    def close(self):
+        for idle in self._idle.values():
+            for _, writer in idle:
+                writer.close()
+        self._idle = {}
+
+
+def _async_error_type(error: Exception) -> str:
+    """
+    :return: the type of failure to record a failed request under, matching _request_error_type
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    # The host closing the connection part way through the response is a connection failure for requests too
+    if isinstance(error, (OSError, asyncio.IncompleteReadError, _ConnectionClosed)):
+        return 'connection'
+    return 'request'
+
+
+def _retrieve_exception(task: asyncio.Future):
+    # Requests left behind at the deadline or outrun by a hedge are never awaited, so their errors are
+    # retrieved here to keep them out of the event loop's log. They were already recorded by the request.
+    if not task.cancelled():
+        task.exception()
+
+
+async def _wait_for_any_async(tasks: list, deadline: Optional[float]) -> Optional[asyncio.Future]:
+    """
+    Wait for the first of several requests for the same endpoint to succeed. If they all fail, the last error
+    is raised.
+
+    :param tasks: the tasks fetching the endpoint
+    :param deadline: when to stop waiting, from time.monotonic(), or None to wait as long as it takes
+    :return: the first to succeed, or None if the deadline passed first
+    """
+    remaining = set(tasks)
+    error = None
+    while remaining:
+        timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+        done, remaining = await asyncio.wait(remaining, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            return None
+
+        for task in done:
+            if task.cancelled():
+                error = asyncio.CancelledError()
+            elif task.exception() is None:
+                return task
+            else:
+                error = task.exception()
+
+    raise error
+
+
+class AsyncDDFCollector(DDFCollector):
+    """
+    A collector that fetches from DDF on an asyncio event loop instead of the worker pool, for RUNTIME=asyncio.
+
+    Responses are read in full rather than streamed, so STREAM_JSON doesn't apply. Everything else, from
+    discovery caching to adaptive polling and deadlines, behaves as it does for DDFCollector.
+
+    AsyncHTTPClient doesn't go through proxies, so when HTTPS_PROXY or HTTP_PROXY apply to the host, requests
+    are made with requests on the worker pool instead.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stream_json = "False"
+        self._proxied = bool(requests.utils.get_environ_proxies(self._query_url('', None)))
+
+        # Shared between every target by AsyncExporter, to limit the requests in flight. Proxied requests take
+        # these too, rather than the worker pool's slots, so MAX_CONCURRENT_REQUESTS stays a single limit.
+        self.async_request_slots = None
+        self._request_slots = None
+
+        self._client = None
+        self._client_cert_mtime = None
+
+    def _async_client(self) -> AsyncHTTPClient:
+        # Rebuilt alongside the session whenever the certificate is replaced, see _reload_tls_if_changed
+        if self._client is None or self._client_cert_mtime != self._cert_mtime:
+            if self._client is not None:
+                self._client.close()
+            self._client = AsyncHTTPClient(self._verify, pool_size=self.pool_size,
+                                           keep_alive=self.keep_alive != "False",
+                                           compression=self.http_compression != "False",
+                                           connect_timeout=self.connect_timeout, read_timeout=self.read_timeout)
+            self._client_cert_mtime = self._cert_mtime
+        return self._client
+
+    def close(self):
+        super().close()
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def scrape_async(self, deadline: Optional[float] = None, selection: Tuple[str, ...] = (),
+                           outcome: Optional[_CollectionOutcome] = None) -> list:
+        """
+        Fetch the current value of every available metric from the host.
+
+        :param deadline: when the collection has to finish by, from time.monotonic(), or None to use
+            COLLECT_TIMEOUT
+        :param selection: the collect[] patterns to limit the collection to, or () for every endpoint
+        :param outcome: filled in with what happened to each endpoint, if given
+        :return: a list of the metrics, in discovery order
+        """
+        started = time.perf_counter()
+        samples = self._start_slow_capture()
+        if outcome is None:
+            outcome = _CollectionOutcome()
+        # Discovery and the requests to the endpoints share the one deadline
+        if deadline is None:
+            deadline = self._collection_deadline()
+
+        try:
+            self._reload_tls_if_changed()
+
+            metric_endpoints = self._selected_endpoints(await self.get_available_endpoints_async(deadline), selection)
+
+            self.metric_results = await self.populate_and_fetch_metrics_async(
+                metric_endpoints,
+                self.metric_prefix,
+                labels=self.labels,
+                deadline=deadline,
+                outcome=outcome)
+
+            writes = []
+            metrics = self._scraped_metrics(metric_endpoints, outcome, started, samples, writes=writes)
+
+            # Writing files would hold up every other scrape and request on the event loop.
+            for write in writes:
+                await asyncio.get_event_loop().run_in_executor(self._executor, write)
+
+            return metrics
+
+        finally:
+            if samples is not None:
+                _stack_sampler.unsubscribe(samples)
+
+    async def warm_up_async(self):
+        """
+        Discover the endpoints and run a first collection, see warm_up.
+        """
+        if self.poll_interval > 0:
+            await self.refresh_snapshot_async()
+        else:
+            await self.scrape_async()
+
+    async def refresh_snapshot_async(self) -> Snapshot:
+        """
+        Scrape the host and publish the results as the new snapshot, see refresh_snapshot.
+
+        :return: the current snapshot
+        """
+        outcome = _CollectionOutcome()
+        try:
+            metrics = tuple(await self.scrape_async(outcome=outcome))
+        except Exception as e:
+            print("Error: background collection failed: " + str(e))
+            metrics = ()
+
+        return self._publish_snapshot(metrics, succeeded=bool(outcome.answered))
+
+    async def _make_request_async(self, metric_name: str, offset: Optional[int] = 120,
+                                  deadline: Optional[float] = None, finish_by_deadline: bool = False) -> dict:
+        """
+        Sends a get request based on a specified metric, and then returns the json.
+
+        :param metric_name: The name of the metric, which will be used to lookup the corresponding endpoint
+        :param offset: From the present, how many seconds into the past to fetch data for that metric
+        :param deadline: when the collection has to finish by, from time.monotonic(), which caps how long the
+            request waits for the request budget and a request slot
+        :param finish_by_deadline: whether the request is abandoned at the deadline too, see _make_request
+        :return: The dict/json representing the response
+        """
+        if self._proxied:
+            # The slot is held while the worker waits for the request budget too, as it can't be taken from there.
+            await self._acquire_slot_async(deadline)
+            try:
+                return await asyncio.get_event_loop().run_in_executor(self._executor, self._make_request, metric_name,
+                                                                      offset, deadline, finish_by_deadline)
+            finally:
+                if self.async_request_slots is not None:
+                    self.async_request_slots.release()
+
+        query_url = self._query_url(metric_name, offset)
+        self._check_verify()
+
+        instruments = self._instruments_for(metric_name)
+        client = self._async_client()
+
+        budget = self.request_budget
+        if budget is not None and not await budget.acquire_async(deadline):
+            raise RequestBudgetExhausted('Skipped a request to ' + self.target + ', its request budget is exhausted')
+
+        started = time.perf_counter()
+        try:
+            await self._acquire_slot_async(deadline)
+            try:
+                request = client.get(query_url)
+                if finish_by_deadline and deadline is not None:
+                    request = asyncio.wait_for(request, max(deadline - time.monotonic(), 0))
+                download = await request
+            finally:
+                if self.async_request_slots is not None:
+                    self.async_request_slots.release()
+
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, AsyncHTTPError) as e:
+            # DNS failure, refused connection, etc
+            print("Error: " + (str(e) or type(e).__name__))
+            _REQUEST_ERRORS.labels(self.target, metric_name, _async_error_type(e)).inc()
+            instruments.duration.observe(time.perf_counter() - started)
+            return {}
+
+        finally:
+            if budget is not None:
+                budget.release_async()
+
+        self._wire_bytes.inc(download.wire_bytes)
+        if download.status_code >= 400:
+            _REQUEST_ERRORS.labels(self.target, metric_name, 'status').inc()
+
+        try:
+            instruments.response_bytes.inc(len(download.content))
+            return download.json()
+        except ValueError:
+            _REQUEST_ERRORS.labels(self.target, metric_name, 'decode').inc()
+            raise
+        finally:
+            instruments.duration.observe(time.perf_counter() - started)
+
+    async def _acquire_slot_async(self, deadline: Optional[float]):
+        """
+        Wait for one of the async_request_slots, if they are limited. Has to be followed by releasing it.
+
+        :raise RequestBudgetExhausted: if none was free before the deadline
+        """
+        if self.async_request_slots is None:
+            return
+        try:
+            await asyncio.wait_for(self.async_request_slots.acquire(),
+                                   None if deadline is None else max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            raise RequestBudgetExhausted('Skipped a request to ' + self.target +
+                                         ', no request slot was free before the deadline')
+
+    async def fetch_available_endpoints_async(self, deadline: Optional[float] = None) -> dict:
+        """
+        :param deadline: when the collection has to finish by, from time.monotonic(), or None to use
+            COLLECT_TIMEOUT
+        :return: a dict representing the snake_case: camelCase available endpoints
+        """
+        started = time.perf_counter()
+
+        if deadline is None:
+            deadline = self._collection_deadline()
+        available_endpoints = self._endpoints_from_index(
+            await self._make_request_async('', offset=None, deadline=deadline, finish_by_deadline=True))
+
+        _DISCOVERY_DURATION.labels(self.target).observe(time.perf_counter() - started)
+
+        return available_endpoints
+
+    async def get_available_endpoints_async(self, deadline: Optional[float] = None) -> dict:
+        """
+        Return the cached snake_case: camelCase available endpoints, see get_available_endpoints.
+
+        :param deadline: when the collection has to finish by, from time.monotonic(), or None to use
+            COLLECT_TIMEOUT
+        :return: a dict representing the snake_case: camelCase available endpoints
+        """
+        if self._endpoints_fetched_at is None or self.discovery_ttl <= 0:
+            _CACHE_REQUESTS.labels('discovery', 'miss').inc()
+            try:
+                return self._store_endpoints(await self.fetch_available_endpoints_async(deadline))
+            except RequestBudgetExhausted as e:
+                print("Error: " + str(e))
+                return self.metric_endpoints
+
+        _CACHE_REQUESTS.labels('discovery', 'hit').inc()
+
+        if time.monotonic() - self._endpoints_fetched_at >= self.discovery_ttl and not self._discovery_in_progress:
+            self._discovery_in_progress = True
+            asyncio.ensure_future(self._background_refresh_async())
+
+        return self.metric_endpoints
+
+    async def _background_refresh_async(self):
+        try:
+            self._store_endpoints(await self.fetch_available_endpoints_async())
+        except Exception as e:
+            print("Error: endpoint discovery failed: " + str(e))
+        finally:
+            self._discovery_in_progress = False
+
+    async def populate_and_fetch_metrics_async(self,
+                                               available_endpoints: dict,
+                                               prefix: str,
+                                               labels: Optional[dict] = None,
+                                               deadline: Optional[float] = None,
+                                               outcome: Optional[_CollectionOutcome] = None) -> dict:
+        """
+        Query each available endpoint concurrently, and store their values into a results dictionary.
+
+        :param available_endpoints: dictionary of snake_case: camelCase strings representing metric endpoints
+        :param prefix: the prefix to be prepended to all metrics generated by this exporter
+        :param labels: an optional set of tags for to include on the metrics
+        :param deadline: when the collection has to finish by, from time.monotonic(), or None to use
+            COLLECT_TIMEOUT
+        :param outcome: filled in with what happened to each endpoint, if given
+        :return: a dictionary of metrics with their corresponding values as retrieved from the endpoint
+        """
+        metric_results = {}
+
+        if labels is None:
+            labels = {}
+        if outcome is None:
+            outcome = _CollectionOutcome()
+
+        if deadline is None and self.collect_timeout > 0:
+            deadline = time.monotonic() + self.collect_timeout
+
+        fetches = {metric_name: _HedgedFetch() for metric_name in self._due_endpoints(available_endpoints)}
+        pending = {metric_name: [self._start_fetch(metric_name, fetch, deadline)]
+                   for metric_name, fetch in fetches.items()}
+        if self.hedge_after > 0 and pending:
+            await self._hedge_async(pending, fetches, deadline)
+
+        for metric_name in available_endpoints.keys():
+            metric_results[metric_name] = GaugeMetricFamily(
+                prefix + metric_name, metric_name, labels=labels.keys())
+
+            if metric_name in pending:
+                try:
+                    finished = await _wait_for_any_async(pending[metric_name], deadline)
+                    if finished is None:
+                        # Requests that are already underway still complete, and update the endpoint's state.
+                        outcome.timed_out.append(metric_name)
+                    elif finished.result() is not None:
+                        outcome.answered.append(metric_name)
+                except RequestBudgetExhausted:
+                    continue
+                except Exception as e:
+                    print("Error: could not fetch " + metric_name + ": " + str(e))
+
+            self._add_current_value(metric_results[metric_name], metric_name, labels)
+
+        return metric_results
+
+    def _start_fetch(self, metric_name: str, fetch: _HedgedFetch, deadline: Optional[float]) -> asyncio.Future:
+        task = asyncio.ensure_future(self._fetch_data_points_async(metric_name, fetch, deadline))
+        task.add_done_callback(_retrieve_exception)
+        return task
+
+    async def _hedge_async(self, pending: dict, fetches: dict, deadline: Optional[float]):
+        """
+        Give the requests HEDGE_AFTER seconds, and then send a second request to each endpoint that still hasn't
+        answered, see _hedge.
+        """
+        if deadline is not None and time.monotonic() + self.hedge_after >= deadline:
+            return
+
+        await asyncio.wait([tasks[0] for tasks in pending.values()], timeout=self.hedge_after)
+
+        for metric_name, tasks in pending.items():
+            if not tasks[0].done():
+                tasks.append(self._start_fetch(metric_name, fetches[metric_name], deadline))
+
+    async def _fetch_data_points_async(self, metric_name: str, fetch: Optional[_HedgedFetch] = None,
+                                       deadline: Optional[float] = None) -> Optional[list]:
+        """
+        Download a single endpoint, and record the newest of its datapoints.
+
+        :param metric_name: The snake_case name of the metric to fetch
+        :param fetch: shared with any other request for the endpoint in the same collection
+        :param deadline: when the collection has to finish by, from time.monotonic()
+        :return: a list of the datapoints that hadn't been seen before, oldest first, or None if the endpoint
+            didn't answer with any data
+        """
+        state = self._state_for(metric_name)
+        started = time.monotonic()
+
+        try:
+            json_response = await self._make_request_async(metric_name, self._next_offset(state, started),
+                                                           deadline=deadline)
+            data_points = self._unpack_response(metric_name, state, started, json_response)
+        except RequestBudgetExhausted:
+            if self.budget_exhausted == 'skip':
+                raise
+            return None
+        except Exception:
+            with state.lock:
+                self._schedule_next_poll(state, started, failed=True)
+            raise
+
+        return self._record_once(state, started, data_points, fetch)
+
+
+class _Collected:
+    """
+    Metrics that have already been collected, in the shape prometheus_client's encoders expect.
+    """
+
+    def __init__(self, metrics: list, registry: Optional[CollectorRegistry] = None):
+        self.metrics = metrics
+        self.registry = registry
+
+    def collect(self):
+        yield from self.metrics
+        if self.registry is not None:
+            yield from self.registry.collect()
+
+
+class AsyncExpositionCache(ExpositionCache):
+    """
+    An ExpositionCache for the event loop. Scrapes that arrive while the output is being collected await
+    that collection rather than starting another.
+    """
+
+    def __init__(self, collect):
+        """
+        :param collect: a coroutine function taking the scrape's deadline and selection, which returns an object
+            to render
+        """
+        super().__init__(registry=None)
+        self._collect = collect
+
+    async def get_async(self, accept_header: Optional[str] = None, deadline: Optional[float] = None,
+                        selection: Tuple[str, ...] = ()) -> RenderedExposition:
+        """
+        :param accept_header: the scraper's Accept header, which picks between the text and OpenMetrics formats
+        :param deadline: when the collection has to finish by, from time.monotonic()
+        :param selection: the collect[] patterns the scrape asked for, each of which is rendered separately
+        :return: the rendered output
+        """
+        encoder, content_type = choose_encoder(accept_header)
+        key = (content_type, selection)
+
+        rendered = self._rendered.get(key)
+        if rendered is not None and self._is_current(rendered):
+            self._rendered.move_to_end(key)
+            _CACHE_REQUESTS.labels('exposition', 'hit').inc()
+            return rendered
+
+        render = self._renders.get(key)
+        _CACHE_REQUESTS.labels('exposition', 'miss' if render is None else 'hit').inc()
+        if render is None:
+            render = self._renders[key] = asyncio.ensure_future(
+                self._render(encoder, content_type, deadline, selection))
+
+        # A scraper hanging up shouldn't cancel the render the others are waiting on.
+        return await asyncio.shield(render)
+
+    async def _render(self, encoder, content_type: str, deadline: Optional[float],
+                      selection: Tuple[str, ...]) -> RenderedExposition:
+        key = (content_type, selection)
+        try:
+            generation = ddf_exporter._snapshot_generation
+            plain = encoder(await self._collect(deadline, selection))
+            rendered = RenderedExposition(content_type=content_type, plain=plain, gzipped=gzip.compress(plain),
+                                          rendered_at=time.monotonic(), generation=generation)
+            self._keep(key, rendered)
+            return rendered
+        finally:
+            del self._renders[key]
+
+
+class AsyncExporter:
+    """
+    Serves the exporter's endpoints, and fetches from DDF, on a single asyncio event loop. This replaces the
+    HTTP server thread, the worker pool and the polling threads when RUNTIME=asyncio.
+    """
+
+    def __init__(self, target_pool: TargetPool, collectors: List[AsyncDDFCollector],
+                 registry: CollectorRegistry = REGISTRY):
+        """
+        :param target_pool: where /probe looks up its targets, which has to create AsyncDDFCollectors
+        :param collectors: the targets served on /metrics
+        :param registry: the exporter's own metrics, served on /metrics alongside the targets'
+        """
+        self.target_pool = target_pool
+        self.collectors = collectors
+        self.registry = registry
+
+        # Have to hardcode strings because dockerfiles cannot handle booleans
+        self.warm_up = os.getenv('WARM_UP', "False")
+        self.debug_endpoints = os.getenv('DEBUG_ENDPOINTS', "False")
+        self.ready = False
+
+        self.metrics_cache = AsyncExpositionCache(self._collect_metrics)
+        self.probe_caches = {}
+
+        self._request_slots = None
+        self._poll_tasks = {}
+        self._server = None
+
+        target_pool.add_eviction_listener(self._forget_probe)
+
+    async def start(self, port: int, addr: str = ''):
+        """
+        Start serving the exporter's endpoints, and polling the targets in the background if POLL_INTERVAL is set.
+
+        :return: the running server
+        """
+        self._request_slots = asyncio.Semaphore(max(self.target_pool.max_concurrent_requests, 1))
+
+        if self.warm_up == "True":
+            asyncio.ensure_future(self._warm_up())
+        else:
+            for collector in self.collectors:
+                self._prepare(collector)
+            self.ready = True
+
+        self._server = await asyncio.start_server(self._handle, addr or None, port)
+        return self._server
+
+    async def _warm_up(self):
+        async def warm_up_collector(collector):
+            try:
+                await collector.warm_up_async()
+            except Exception as e:
+                print("Error: could not warm up " + collector.host + ": " + str(e))
+            finally:
+                # The warm-up was the first poll, so the next one isn't due for a while.
+                self._prepare(collector, first_poll=time.monotonic() + collector.poll_interval)
+
+        # The warm-up's requests count against the shared limit too.
+        for collector in self.collectors:
+            collector.async_request_slots = self._request_slots
+
+        try:
+            await asyncio.gather(*(warm_up_collector(collector) for collector in self.collectors))
+        finally:
+            self.ready = True
+
+    async def serve(self, port: int, addr: str = ''):
+        """
+        Serve until SIGTERM or SIGINT, then shut down cleanly.
+        """
+        await self.start(port, addr)
+
+        stopping = asyncio.Event()
+        loop = asyncio.get_event_loop()
+        for signo in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signo, stopping.set)
+
+        await stopping.wait()
+        await self.shutdown()
+
+    async def shutdown(self):
+        """
+        Stop serving, cancel polling and any requests in flight, and close the connections to DDF.
+        """
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+        # asyncio.all_tasks and current_task only arrived in python 3.7
+        all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks
+        current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task
+        current = current_task()
+        tasks = [task for task in all_tasks() if task is not current and not task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._poll_tasks = {}
+
+        for collector in list(self.collectors) + list(self.probe_caches.keys()):
+            collector.close()
+
+    def _prepare(self, collector: AsyncDDFCollector, first_poll: Optional[float] = None):
+        """
+        :param first_poll: when to first poll the collector, from time.monotonic(), or None for straight away
+        """
+        collector.async_request_slots = self._request_slots
+        if collector.poll_interval > 0 and collector not in self._poll_tasks:
+            self._poll_tasks[collector] = asyncio.ensure_future(self._poll(collector, first_poll))
+
+    @staticmethod
+    async def _poll(collector: AsyncDDFCollector, first_poll: Optional[float] = None):
+        next_run = time.monotonic() if first_poll is None else first_poll
+        await asyncio.sleep(max(next_run - time.monotonic(), 0))
+        while True:
+            await collector.refresh_snapshot_async()
+
+            # Scheduled the same way as DDFCollector._poll_loop
+            next_run = max(next_run + collector.poll_interval, time.monotonic())
+            await asyncio.sleep(next_run - time.monotonic())
+
+    @staticmethod
+    async def _collect_target(collector: AsyncDDFCollector, deadline: Optional[float],
+                              selection: Tuple[str, ...]) -> list:
+        if collector.poll_interval > 0:
+            with scrape_selection(selection):
+                return list(collector.collect())
+
+        try:
+            return await collector.scrape_async(deadline, selection)
+        except Exception as e:
+            print("Error: could not collect from " + collector.host + ": " + str(e))
+            return []
+
+    async def _collect_metrics(self, deadline: Optional[float], selection: Tuple[str, ...]) -> _Collected:
+        results = await asyncio.gather(*(self._collect_target(collector, deadline, selection)
+                                         for collector in self.collectors))
+        metrics = results[0] if len(results) == 1 else _merge_metrics(results)
+        return _Collected(metrics, self.registry)
+
+    def _probe_cache(self, collector: AsyncDDFCollector) -> AsyncExpositionCache:
+        cache = self.probe_caches.get(collector)
+        if cache is None:
+            self._prepare(collector)
+
+            async def collect(deadline, selection):
+                return _Collected(await self._collect_target(collector, deadline, selection))
+
+            cache = self.probe_caches[collector] = AsyncExpositionCache(collect)
+        return cache
+
+    def _forget_probe(self, collector: AsyncDDFCollector):
+        self.probe_caches.pop(collector, None)
+        poll_task = self._poll_tasks.pop(collector, None)
+        if poll_task is not None:
+            poll_task.cancel()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 30)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 30)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            try:
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+            except ValueError:
+                code, response_headers, output = self._text(400, 'Bad request')
+            else:
+                if method != 'GET':
+                    code, response_headers, output = self._text(405, 'Method not allowed')
+                else:
+                    code, response_headers, output = await self._route(path, headers)
+
+            status = '{code} {phrase}'.format(code=code, phrase=HTTPStatus(code).phrase)
+            head = 'HTTP/1.1 ' + status + '\r\n'
+            for name, value in response_headers + [('Content-Length', str(len(output))), ('Connection', 'close')]:
+                head += name + ': ' + value + '\r\n'
+            writer.write(head.encode('latin-1') + b'\r\n' + output)
+            await writer.drain()
+
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            print("Error: could not serve request: " + str(e))
+        finally:
+            writer.close()
+
+    async def _route(self, path: str, headers: dict) -> tuple:
+        """
+        :return: the status code, headers and body of the response
+        """
+        url = urlsplit(path)
+        params = parse_qs(url.query)
+        self.target_pool.evict_idle()
+
+        if url.path == '/-/healthy':
+            return self._text(200, 'Healthy')
+
+        if url.path == '/-/ready':
+            return self._text(200, 'Ready') if self.ready else self._text(503, 'Warming up')
+
+        if url.path.startswith('/debug/') and self.debug_endpoints == "True":
+            # Profiling waits on collections that run on this loop, so it has to wait elsewhere.
+            try:
+                return self._text(*await asyncio.get_event_loop().run_in_executor(
+                    None, debug_response, url.path, params))
+            except ValueError as e:
+                return self._text(400, str(e))
+
+        if url.path in ('/', '/metrics'):
+            try:
+                selection = parse_selection(params)
+            except ValueError as e:
+                return self._text(400, str(e))
+
+            return await self._metrics_response(self.metrics_cache, headers, selection)
+
+        if url.path == '/probe':
+            target = params.get('target', [None])[0]
+            if not target:
+                return self._text(400, 'Missing target parameter')
+
+            try:
+                selection = parse_selection(params)
+                collector = self.target_pool.probe(target, site_name=params.get('site_name', [None])[0])
+            except ValueError as e:
+                return self._text(400, str(e))
+
+            return await self._metrics_response(self._probe_cache(collector), headers, selection)
+
+        return self._text(404, 'Not found')
+
+    async def _metrics_response(self, cache: AsyncExpositionCache, headers: dict,
+                                selection: Tuple[str, ...]) -> tuple:
+        deadline = scrape_timeout_deadline(headers.get('x-prometheus-scrape-timeout-seconds'))
+        try:
+            rendered = await cache.get_async(headers.get('accept'), deadline, selection)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print("Error: could not generate metric output: " + str(e))
+            return self._text(500, 'Error generating metric output: ' + str(e))
+
+        response_headers = [('Content-Type', rendered.content_type)]
+        output, encoding = rendered.output_for(headers.get('accept-encoding'))
+        if encoding is not None:
+            response_headers.append(('Content-Encoding', encoding))
+        return 200, response_headers, output
+
+    @staticmethod
+    def _text(code: int, message: str) -> tuple:
+        return code, [('Content-Type', 'text/plain; charset=utf-8')], (message + '\n').encode('utf-8')
+
+
+def run_async_exporter(port: int, targets_file: Optional[str] = None):
+    """
+    Serve the exporter on an asyncio event loop until SIGTERM, see AsyncExporter.
+    """
+    target_pool = TargetPool(collector_class=AsyncDDFCollector, start_polling=False)
+    collectors = target_pool.load_targets(targets_file) if targets_file else [target_pool.get()]
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(AsyncExporter(target_pool, collectors).serve(port))
+    finally:
+        loop.close()
@@ -1,7 +1,18 @@
 import unittest
-from unittest.mock import patch, call
+from unittest.mock import patch, call, Mock
 import os
+import tempfile
+import json
+import urllib.request
+import urllib.error
+import threading
+import gzip
+import time
+import asyncio
+import tracemalloc
+import http.server
 import ddf_exporter
+import ddf_exporter_async
 import prometheus_client
 
 
@@ -17,6 +28,14 @@ class TestDdfExporter(unittest.TestCase):
         else:
             os.environ[var] = previous_value
 
+    def _collector_with_env(self, name: str, value: str) -> ddf_exporter.DDFCollector:
+        old_value = os.getenv(name)
+        self._set_env_var(name, value)
+        try:
+            return ddf_exporter.DDFCollector()
+        finally:
+            self._reset_env_var(name, previous_value=old_value)
+
     def setUp(self):
         # env vars for the test
         self.metric_prefix = 'test_case_'
@@ -45,6 +64,7 @@ class TestDdfExporter(unittest.TestCase):
             def __init__(self, json_data, status_code):
                 self.json_data = json_data
                 self.status_code = status_code
+                self.content = json.dumps(json_data).encode('utf-8')
 
             def json(self):
                 return self.json_data
@@ -128,6 +148,104 @@ class TestDdfExporter(unittest.TestCase):
         self.assertRaises(FileNotFoundError, exp._make_request, 'connection_error')
 
 
+    @patch('requests.Session.get', side_effect=mocked_requests_session_get)
+    def test__make_request_reuses_session(self, mock_get):
+
+        os.environ['SECURE'] = "False"
+
+        exp = ddf_exporter.DDFCollector()
+        session = exp.session
+
+        exp.metric_endpoints['test_metric'] = 'testMetric'
+        exp._make_request('test_metric')
+        exp._make_request('test_metric')
+
+        # both requests went out over the same pooled session
+        self.assertIs(exp.session, session)
+        self.assertEqual(mock_get.call_count, 2)
+        mock_get.assert_called_with('https://localhost:8993/services/internal/metrics/testMetric.json?dateOffset=120',
+                                    verify=False, timeout=(5.0, 30.0))
+
+
+    def test__reload_tls_if_changed(self):
+
+        os.environ['SECURE'] = "True"
+        old_cert_path = os.getenv('CA_CERT_PATH')
+
+        with tempfile.TemporaryDirectory() as cert_dir:
+            cert_path = os.path.join(cert_dir, 'ca.pem')
+            self._set_env_var('CA_CERT_PATH', cert_path)
+
+            try:
+                # no cert yet, so secure requests can't be made
+                exp = ddf_exporter.DDFCollector()
+                session = exp.session
+                self.assertRaises(FileNotFoundError, exp._make_request, 'connection_error')
+
+                # the cert showing up on disk is picked up without restarting
+                with open(cert_path, 'w') as cert_file:
+                    cert_file.write('cert')
+                exp._reload_tls_if_changed()
+                self.assertEqual(exp._verify, cert_path)
+                self.assertIsNot(exp.session, session)
+
+                # nothing changed, so the session is kept
+                session = exp.session
+                exp._reload_tls_if_changed()
+                self.assertIs(exp.session, session)
+
+                # replacing the cert starts a new session
+                os.utime(cert_path, (0, 0))
+                exp._reload_tls_if_changed()
+                self.assertIsNot(exp.session, session)
+
+            finally:
+                self._reset_env_var('CA_CERT_PATH', previous_value=old_cert_path)
+
+    def test__make_request_instrumented(self):
+
+        os.environ['SECURE'] = "False"
+        registry = prometheus_client.REGISTRY
+        exp = ddf_exporter.DDFCollector(host='https://instrumented', host_port=8993)
+        exp.metric_endpoints['test_metric'] = 'testMetric'
+        endpoint_labels = {'target': 'https://instrumented:8993', 'endpoint': 'test_metric'}
+
+        def error_count(error_type):
+            return registry.get_sample_value('ddf_exporter_request_errors_total',
+                                             dict(endpoint_labels, type=error_type)) or 0
+
+        # successful requests record their latency and size
+        response = type(self).mocked_requests_session_get('https://localhost:8993/services/internal/metrics/'
+                                                          'testMetric.json?dateOffset=120')
+        self.assertEqual(response.status_code, 200)
+        with patch('requests.Session.get', return_value=response):
+            exp._make_request('test_metric')
+        self.assertEqual(registry.get_sample_value('ddf_exporter_request_duration_seconds_count', endpoint_labels), 1)
+        self.assertEqual(registry.get_sample_value('ddf_exporter_response_bytes_total', endpoint_labels),
+                         len(response.content))
+
+        # failures are counted by type
+        with patch('requests.Session.get', side_effect=ddf_exporter.requests.ConnectionError('refused')):
+            self.assertDictEqual(exp._make_request('test_metric'), {})
+        self.assertEqual(error_count('connection'), 1)
+
+        with patch('requests.Session.get', side_effect=ddf_exporter.requests.Timeout('timed out')):
+            exp._make_request('test_metric')
+        self.assertEqual(error_count('timeout'), 1)
+
+        response.json = lambda: json.loads('<html>')
+        response.status_code = 500
+        with patch('requests.Session.get', return_value=response):
+            self.assertRaises(ValueError, exp._make_request, 'test_metric')
+        self.assertEqual(error_count('status'), 1)
+        self.assertEqual(error_count('decode'), 1)
+
+        # parsed datapoints are counted too
+        with patch.object(ddf_exporter.DDFCollector, '_make_request',
+                          return_value={'data': [{'value': 1.0}, {'value': 2.0}]}):
+            exp.populate_and_fetch_metrics({'test_metric': 'testMetric'}, self.metric_prefix)
+        self.assertEqual(registry.get_sample_value('ddf_exporter_data_points_total', endpoint_labels), 2)
+
     def test__json_to_metric_generator(self):
 
         # test empty dict
@@ -160,24 +278,145 @@ class TestDdfExporter(unittest.TestCase):
         self.assertRaises(StopIteration, next, gen)
 
 
+    class MockStreamResponse:
+
+        def __init__(self, body: bytes, chunk_size: int):
+            self.body = body
+            self.chunk_size = chunk_size
+            self.encoding = 'utf-8'
+            self.status_code = 200
+            self.closed = False
+
+        def iter_content(self, chunk_size=1):
+            for start in range(0, len(self.body), self.chunk_size):
+                yield self.body[start:start + self.chunk_size]
+
+        def close(self):
+            self.closed = True
+
+
+    def test__stream_data_points(self):
+
+        body = json.dumps({
+            'title': 'Catalog Queries',
+            'data': [{'value': 1.25, 'timestamp': 'Jan 15 2019 12:07:00'},
+                     {'value': 12345, 'timestamp': 'Jan 15 2019 12:08:00'}],
+            'totalCount': 2
+        }, indent=2).encode('utf-8')
+
+        # however the body is split up, the same datapoints come out
+        for chunk_size in (1, 3, 7, len(body)):
+            response = self.MockStreamResponse(body, chunk_size)
+            data_points = list(ddf_exporter._stream_data_points(response))
+            self.assertListEqual(data_points, [{'value': 1.25, 'timestamp': 'Jan 15 2019 12:07:00'},
+                                               {'value': 12345, 'timestamp': 'Jan 15 2019 12:08:00'}])
+            self.assertTrue(response.closed)
+
+        # test with no data
+        for body in (b'{}', b'{"title": "Empty"}', b'{"data": [], "totalCount": 0}'):
+            self.assertListEqual(list(ddf_exporter._stream_data_points(self.MockStreamResponse(body, 2))), [])
+
+        # test malformed responses
+        for body in (b'<html></html>', b'{"data": [{"value": 1.0}', b'{"data": [{"value": 1.0}}'):
+            response = self.MockStreamResponse(body, 4)
+            self.assertRaises(ValueError, list, ddf_exporter._stream_data_points(response))
+            self.assertTrue(response.closed)
+
+
+    def test__make_request_streaming(self):
+
+        os.environ['SECURE'] = "False"
+        old_stream_json = os.getenv('STREAM_JSON')
+        self._set_env_var('STREAM_JSON', 'True')
+
+        body = b'{"data": [{"value": 1.0, "timestamp": "Jan 15 2019 12:07:00"}, ' \
+               b'{"value": 2.0, "timestamp": "Jan 15 2019 12:08:00"}]}'
+
+        try:
+            with patch('requests.Session.get', return_value=self.MockStreamResponse(body, 16)) as mock_get:
+                exp = ddf_exporter.DDFCollector()
+                metrics = exp.populate_and_fetch_metrics({'test_metric': 'testMetric'}, self.metric_prefix)
+
+            self.assertTrue(mock_get.call_args[1]['stream'])
+            self.assertListEqual([sample.value for sample in metrics['test_metric'].samples], [2.0])
+
+            # the request holds on to its slot until the body has been read
+            slots = threading.BoundedSemaphore(1)
+            with patch('requests.Session.get', return_value=self.MockStreamResponse(body, 16)):
+                exp = ddf_exporter.DDFCollector(request_slots=slots)
+                exp.metric_endpoints = {'test_metric': 'testMetric'}
+                response = exp._make_request('test_metric')
+                self.assertFalse(slots.acquire(blocking=False))
+                self.assertEqual(len(list(response['data'])), 2)
+                self.assertTrue(slots.acquire(blocking=False))
+                slots.release()
+
+                # or the stream is closed without being read
+                response = exp._make_request('test_metric')
+                response['data'].close()
+                self.assertTrue(slots.acquire(blocking=False))
+
+        finally:
+            self._reset_env_var('STREAM_JSON', previous_value=old_stream_json)
+
+
     def test_fetch_available_endpoints(self):
 
         # test with no responses
-        with patch.object(ddf_exporter.DDFCollector, '_make_request', return_value={}) as mock_make_request:
+        with patch.object(ddf_exporter.DDFCollector, '_make_request', return_value={}):
             exp = ddf_exporter.DDFCollector()
             self.assertDictEqual(exp.fetch_available_endpoints(), {})
 
         # test with 1 response
-        with patch.object(ddf_exporter.DDFCollector, '_make_request', return_value={'fakeItemA': 'a'}) as mock_make_request:
+        with patch.object(ddf_exporter.DDFCollector, '_make_request', return_value={'fakeItemA': 'a'}):
             exp = ddf_exporter.DDFCollector()
             self.assertDictEqual(exp.fetch_available_endpoints(), {'fake_item_a': 'fakeItemA'})
 
         # Test with multiple responses
-        with patch.object(ddf_exporter.DDFCollector, '_make_request', return_value={'fakeItemA': 'a', 'fakeItemB': 'b'}) as mock_make_request:
+        with patch.object(ddf_exporter.DDFCollector, '_make_request', return_value={'fakeItemA': 'a', 'fakeItemB': 'b'}):
             exp = ddf_exporter.DDFCollector()
             self.assertDictEqual(exp.fetch_available_endpoints(), {'fake_item_a': 'fakeItemA', 'fake_item_b': 'fakeItemB'})
 
 
+    def test_get_available_endpoints(self):
+
+        with patch.object(ddf_exporter.DDFCollector, 'fetch_available_endpoints',
+                          return_value={'fake_item_a': 'fakeItemA'}) as mock_fetch:
+            exp = ddf_exporter.DDFCollector()
+
+            # the first call has to discover the endpoints
+            self.assertDictEqual(exp.get_available_endpoints(), {'fake_item_a': 'fakeItemA'})
+
+            # later calls within the ttl are served from the cache
+            self.assertDictEqual(exp.get_available_endpoints(), {'fake_item_a': 'fakeItemA'})
+            self.assertEqual(mock_fetch.call_count, 1)
+
+            # a refresh that finds nothing keeps the last good endpoints
+            mock_fetch.return_value = {}
+            self.assertDictEqual(exp.refresh_available_endpoints(), {'fake_item_a': 'fakeItemA'})
+
+            # a refresh that finds new endpoints replaces them
+            mock_fetch.return_value = {'fake_item_b': 'fakeItemB'}
+            exp._background_refresh()
+            self.assertDictEqual(exp.get_available_endpoints(), {'fake_item_b': 'fakeItemB'})
+            self.assertFalse(exp._discovery_in_progress)
+
+        # an expired list is still served while it is refreshed in the background
+        with patch.object(ddf_exporter.DDFCollector, 'fetch_available_endpoints',
+                          return_value={'fake_item_a': 'fakeItemA'}):
+            exp = ddf_exporter.DDFCollector()
+            exp.get_available_endpoints()
+            exp._endpoints_fetched_at -= exp.discovery_ttl
+
+            with patch('threading.Thread') as mock_thread:
+                self.assertDictEqual(exp.get_available_endpoints(), {'fake_item_a': 'fakeItemA'})
+                exp.get_available_endpoints()
+
+            # only one refresh is started at a time
+            mock_thread.assert_called_once()
+            mock_thread.return_value.start.assert_called_once()
+
+
     def mocked_make_request(*args, **kwargs):
 
         options = {
@@ -247,8 +486,8 @@ class TestDdfExporter(unittest.TestCase):
                                             self.metric_prefix,
                                             {'host_label': 'machine_1_2'})
 
-        calls = [call(labels=['machine_1_2'], value=1.0), call(labels=['machine_1_2'], value=2.0)]
-        mock_add_metric.assert_has_calls(calls)
+        # only the newest sample is exposed
+        mock_add_metric.assert_called_once_with(labels=['machine_1_2'], value=2.0)
 
         # test multiple metric; 0 sample
         with patch.object(prometheus_client.metrics_core.GaugeMetricFamily, 'add_metric') as mock_add_metric:
@@ -294,34 +533,1339 @@ class TestDdfExporter(unittest.TestCase):
                                                      self.metric_prefix,
                                                      {'host_label': 'machine_2_2'})
 
-        calls = [call(labels=['machine_2_2'], value=1.0),
-                 call(labels=['machine_2_2'], value=2.0),
-                 call(labels=['machine_2_2'], value=1.0),
+        calls = [call(labels=['machine_2_2'], value=2.0),
                  call(labels=['machine_2_2'], value=2.0)]
         mock_add_metric.assert_has_calls(calls)
+        self.assertEqual(mock_add_metric.call_count, 2)
         # {
         # '2_2_metric_1':
         #     Metric(test_case_2_2_metric_1, ...,
         #            [Sample(name='test_case_2_2_metric_1',
         #                    labels={'host_label': 'machine_2_1'},
-        #                    value=1.0),
-        #             Sample(name='test_case_2_2_metric_1',
-        #                    labels={'host_label': 'machine_2_1'},
         #                    value=2.0)
         #             ]
         #     ),
         # '2_2_metric_2':
         #     Metric(test_case_2_2_metric_2, ...,
         #            [Sample(name='test_case_2_2_metric_2',
-        #                    labels={'host_label': 'machine_2_1'},
-        #                    value=1.0),
-        #             Sample(name='test_case_2_2_metric_2',
         #                    labels={'host_label': 'machine_2_1'}
         #                    value = 2.0)
         #             ]
         #     )
         # }
 
+    def mocked_make_request_failing(*args, **kwargs):
+
+        if args[0] == 'broken_metric':
+            raise ValueError('malformed response')
+
+        return {'data': [{'value': 3.0}]}
+
+
+    @patch('ddf_exporter.DDFCollector._make_request', side_effect=mocked_make_request_failing)
+    def test_populate_and_fetch_metrics_concurrent(self, mock_requests):
+
+        exp = ddf_exporter.DDFCollector()
+        endpoints = {'metric_{}'.format(i): 'metric{}'.format(i) for i in range(20)}
+        endpoints['broken_metric'] = 'brokenMetric'
+
+        metrics = exp.populate_and_fetch_metrics(endpoints, self.metric_prefix, {'host_label': 'machine'})
+
+        # results come back in discovery order, regardless of which request finished first
+        self.assertListEqual(list(metrics.keys()), list(endpoints.keys()))
+
+        # the broken endpoint is left empty without affecting the others
+        self.assertListEqual(metrics['broken_metric'].samples, [])
+        for i in range(20):
+            samples = metrics['metric_{}'.format(i)].samples
+            self.assertEqual(len(samples), 1)
+            self.assertEqual(samples[0].value, 3.0)
+            self.assertDictEqual(samples[0].labels, {'host_label': 'machine'})
+
+    def test_collect_snapshot(self):
+
+        old_poll_interval = os.getenv('POLL_INTERVAL')
+        self._set_env_var('POLL_INTERVAL', '30')
+
+        try:
+            exp = ddf_exporter.DDFCollector()
+
+            # nothing has been collected yet
+            self.assertListEqual(list(exp.collect()), [])
+
+            gauge = prometheus_client.core.GaugeMetricFamily('test_case_metric', 'metric', labels=['host'])
+            gauge.add_metric(['localhost'], 1.0)
+
+            def scrape(outcome):
+                outcome.answered.append('metric')
+                return [gauge]
+
+            with patch.object(ddf_exporter.DDFCollector, 'scrape', side_effect=scrape) as mock_scrape:
+                snapshot = exp.refresh_snapshot()
+
+                # scrapes are answered from the snapshot without touching the host
+                metrics = list(exp.collect())
+                mock_scrape.assert_called_once()
+
+            self.assertIs(metrics[0], gauge)
+            self.assertEqual(metrics[1].name, 'ddf_exporter_snapshot_age_seconds')
+            self.assertGreaterEqual(metrics[1].samples[0].value, 0.0)
+            self.assertEqual(metrics[2].name, 'ddf_exporter_last_success_timestamp_seconds')
+            self.assertEqual(metrics[2].samples[0].value, snapshot.last_success)
+
+            # a collection without any samples keeps serving the last good snapshot
+            with patch.object(ddf_exporter.DDFCollector, 'scrape', return_value=[]):
+                self.assertIs(exp.refresh_snapshot(), snapshot)
+
+            # as does one where no endpoint answered, even though the exporter's notes and carried over values
+            # have samples
+            stale = prometheus_client.core.GaugeMetricFamily('ddf_exporter_endpoint_stale', 'stale', labels=['host'])
+            stale.add_metric(['localhost'], 1.0)
+            with patch.object(ddf_exporter.DDFCollector, 'scrape', return_value=[gauge, stale]):
+                self.assertIs(exp.refresh_snapshot(), snapshot)
+
+        finally:
+            self._reset_env_var('POLL_INTERVAL', previous_value=old_poll_interval)
+
+    def test_populate_and_fetch_metrics_incremental(self):
+
+        responses = [
+            {'data': [{'value': 1.0, 'timestamp': 'Jan 15 2019 12:07:00'},
+                      {'value': 2.0, 'timestamp': 'Jan 15 2019 12:08:00'}]},
+            # the overlapping window returns the already seen sample again
+            {'data': [{'value': 2.0, 'timestamp': 'Jan 15 2019 12:08:00'},
+                      {'value': 3.0, 'timestamp': 'Jan 15 2019 12:09:00'}]},
+            # nothing new yet
+            {'data': [{'value': 3.0, 'timestamp': 'Jan 15 2019 12:09:00'}]},
+            # failed request
+            {},
+        ]
+
+        with patch.object(ddf_exporter.DDFCollector, '_make_request', side_effect=responses) as mock_make_request:
+            exp = ddf_exporter.DDFCollector()
+
+            # the first request covers the whole window
+            metrics = exp.populate_and_fetch_metrics({'metric': 'metric'}, self.metric_prefix)
+            self.assertEqual(mock_make_request.call_args[0], ('metric', 120))
+            self.assertListEqual([sample.value for sample in metrics['metric'].samples], [2.0])
+            self.assertEqual(exp.endpoint_states['metric'].high_water, 1547554080.0)
+
+            # later ones only reach back to the previous request, plus the overlap
+            exp.endpoint_states['metric'].last_fetch -= 30.5
+            metrics = exp.populate_and_fetch_metrics({'metric': 'metric'}, self.metric_prefix)
+            self.assertEqual(mock_make_request.call_args[0], ('metric', 91))
+            self.assertListEqual([sample.value for sample in metrics['metric'].samples], [3.0])
+
+            # the last value keeps being exposed while there is nothing newer
+            metrics = exp.populate_and_fetch_metrics({'metric': 'metric'}, self.metric_prefix)
+            self.assertListEqual([sample.value for sample in metrics['metric'].samples], [3.0])
+
+            last_fetch = exp.endpoint_states['metric'].last_fetch
+            metrics = exp.populate_and_fetch_metrics({'metric': 'metric'}, self.metric_prefix)
+            self.assertListEqual([sample.value for sample in metrics['metric'].samples], [3.0])
+            self.assertEqual(exp.endpoint_states['metric'].last_fetch, last_fetch)
+
+            # until it is older than the window
+            exp.endpoint_states['metric'].last_seen -= exp.date_offset + 1
+            exp.endpoint_states['metric'].last_fetch -= 1000
+            with patch.object(ddf_exporter.DDFCollector, '_make_request', return_value={'data': []}) as mock_make_request:
+                metrics = exp.populate_and_fetch_metrics({'metric': 'metric'}, self.metric_prefix)
+            self.assertEqual(mock_make_request.call_args[0], ('metric', 120))
+            self.assertListEqual(metrics['metric'].samples, [])
+
+
+    def test_populate_and_fetch_metrics_backfill(self):
+
+        responses = [
+            {'data': [{'value': 1.0, 'timestamp': 'Jan 15 2019 12:07:00'},
+                      {'value': 2.0, 'timestamp': 'Jan 15 2019 12:08:00'},
+                      {'value': 3.0, 'timestamp': 'Jan 15 2019 12:09:00'},
+                      {'value': 4.0, 'timestamp': 'Jan 15 2019 12:10:00'}]},
+            {'data': [{'value': 4.0, 'timestamp': 'Jan 15 2019 12:10:00'}]},
+            {'data': [{'value': 4.0, 'timestamp': 'Jan 15 2019 12:10:00'},
+                      {'value': 5.0, 'timestamp': 'Jan 15 2019 12:11:00'},
+                      {'value': 6.0, 'timestamp': 'Jan 15 2019 12:12:00'}]},
+        ]
+
+        old_values = {var: os.getenv(var) for var in ('EXPOSE_TIMESTAMPS', 'BACKFILL_POINTS')}
+        self._set_env_var('EXPOSE_TIMESTAMPS', 'True')
+        self._set_env_var('BACKFILL_POINTS', '3')
+        try:
+            exp = ddf_exporter.DDFCollector()
+        finally:
+            for var, value in old_values.items():
+                self._reset_env_var(var, previous_value=value)
+
+        registry = prometheus_client.CollectorRegistry()
+        registry.register(exp)
+
+        def scrape():
+            output = prometheus_client.openmetrics.exposition.generate_latest(registry).decode('utf-8')
+            return [line.split('} ')[1] for line in output.splitlines() if line.startswith('test_case_metric{')]
+
+        with patch.object(ddf_exporter.DDFCollector, 'get_available_endpoints', return_value={'metric': 'metric'}), \
+                patch.object(ddf_exporter.DDFCollector, '_make_request', side_effect=responses + [responses[1]]):
+            # the newest few datapoints are exposed with their timestamps
+            self.assertListEqual(scrape(), ['2.0 1547554080.0', '3.0 1547554140.0', '4.0 1547554200.0'])
+
+            # with nothing new, every scrape gets them again, so that a second Prometheus doesn't miss them.
+            # Prometheus drops the ones it has already ingested.
+            self.assertListEqual(scrape(), ['2.0 1547554080.0', '3.0 1547554140.0', '4.0 1547554200.0'])
+
+            # until newer datapoints replace them
+            self.assertListEqual(scrape(), ['5.0 1547554260.0', '6.0 1547554320.0'])
+            self.assertListEqual(scrape(), ['5.0 1547554260.0', '6.0 1547554320.0'])
+
+        # when polling, serving the snapshot leaves it as it was
+        exp.poll_interval = 30
+        exp._publish_snapshot(tuple(exp.metric_results.values()), succeeded=True)
+        snapshot, generation = exp.snapshot, ddf_exporter._snapshot_generation
+        self.assertListEqual(scrape(), ['5.0 1547554260.0', '6.0 1547554320.0'])
+        self.assertListEqual(scrape(), ['5.0 1547554260.0', '6.0 1547554320.0'])
+        self.assertIs(exp.snapshot, snapshot)
+        self.assertEqual(ddf_exporter._snapshot_generation, generation)
+        self.assertEqual(len(exp.endpoint_states['metric'].recent_points), 2)
+
+    def test_window_aggregates(self):
+
+        # the ring buffer keeps the newest datapoints once it wraps around
+        ring = ddf_exporter._RingBuffer(3)
+        for i in range(5):
+            ring.append(100.0 + i, float(i))
+        timestamps, values = ring.window(0)
+        self.assertListEqual(list(timestamps), [102.0, 103.0, 104.0])
+        self.assertListEqual(list(values), [2.0, 3.0, 4.0])
+        self.assertListEqual(list(ring.window(103.0)[1]), [3.0, 4.0])
+
+        self.assertDictEqual(ddf_exporter._window_aggregates(timestamps, values),
+                             {'min': 2.0, 'max': 4.0, 'mean': 3.0, 'rate': 1.0})
+        self.assertDictEqual(ddf_exporter._window_aggregates(timestamps[:1], values[:1]),
+                             {'min': 2.0, 'max': 2.0, 'mean': 2.0})
+
+        now = time.time()
+        response = {'data': [{'value': 1.0, 'timestamp': now - 60},
+                             {'value': 5.0, 'timestamp': now - 30},
+                             {'value': 3.0, 'timestamp': now}]}
+
+        old_aggregates = os.getenv('WINDOW_AGGREGATES')
+        self._set_env_var('WINDOW_AGGREGATES', 'max,rate,unknown')
+        try:
+            exp = ddf_exporter.DDFCollector()
+        finally:
+            self._reset_env_var('WINDOW_AGGREGATES', previous_value=old_aggregates)
+
+        with patch.object(ddf_exporter.DDFCollector, 'get_available_endpoints', return_value={'metric': 'metric'}), \
+                patch.object(ddf_exporter.DDFCollector, '_make_request', return_value=response):
+            metrics = {metric.name: metric for metric in exp.scrape()}
+
+        # only the newest value is exposed as the endpoint's own series
+        self.assertListEqual([sample.value for sample in metrics['test_case_metric'].samples], [3.0])
+        self.assertEqual(metrics['test_case_window_max'].samples[0].value, 5.0)
+        self.assertEqual(metrics['test_case_window_max'].samples[0].labels['endpoint'], 'metric')
+        self.assertAlmostEqual(metrics['test_case_window_rate'].samples[0].value, 2.0 / 60)
+        self.assertNotIn('test_case_window_min', metrics)
+
+    def test_populate_and_fetch_metrics_adaptive(self):
+
+        old_adaptive_polling = os.getenv('ADAPTIVE_POLLING')
+        self._set_env_var('ADAPTIVE_POLLING', 'True')
+
+        try:
+            exp = ddf_exporter.DDFCollector()
+            endpoints = {'metric': 'metric'}
+
+            def values(metrics):
+                return [sample.value for sample in metrics['metric'].samples]
+
+            # a changing value is polled again on the next scrape
+            with patch.object(ddf_exporter.DDFCollector, '_make_request',
+                              return_value={'data': [{'value': 1.0, 'timestamp': 'Jan 15 2019 12:07:00'}]}):
+                self.assertListEqual(values(exp.populate_and_fetch_metrics(endpoints, self.metric_prefix)), [1.0])
+            state = exp.endpoint_states['metric']
+            self.assertLess(state.interval, 1.0)
+
+            # one that stays the same is backed off
+            state.next_poll = 0.0
+            with patch.object(ddf_exporter.DDFCollector, '_make_request',
+                              return_value={'data': [{'value': 1.0, 'timestamp': 'Jan 15 2019 12:07:00'}]}):
+                exp.populate_and_fetch_metrics(endpoints, self.metric_prefix)
+            self.assertEqual(state.interval, 10.0)
+
+            # and isn't requested until it is due, while its value is still exposed
+            with patch.object(ddf_exporter.DDFCollector, '_make_request') as mock_make_request:
+                self.assertListEqual(values(exp.populate_and_fetch_metrics(endpoints, self.metric_prefix)), [1.0])
+            mock_make_request.assert_not_called()
+
+            # repeated failures trip the breaker, and the last good value is served as stale
+            with patch.object(ddf_exporter.DDFCollector, '_make_request', return_value={}) as mock_make_request:
+                for i in range(exp.breaker_threshold):
+                    state.next_poll = 0.0
+                    metrics = exp.populate_and_fetch_metrics(endpoints, self.metric_prefix)
+
+                self.assertListEqual(values(metrics), [1.0])
+                self.assertGreater(state.next_poll - time.monotonic(), exp.breaker_backoff - 1)
+
+                exp.populate_and_fetch_metrics(endpoints, self.metric_prefix)
+            self.assertEqual(mock_make_request.call_count, exp.breaker_threshold)
+            self.assertEqual(exp._stale_metric(endpoints).samples[0].value, 1.0)
+
+            # each further failure doubles the backoff
+            state.next_poll = 0.0
+            with patch.object(ddf_exporter.DDFCollector, '_make_request', side_effect=ValueError('malformed')):
+                exp.populate_and_fetch_metrics(endpoints, self.metric_prefix)
+            self.assertGreater(state.next_poll - time.monotonic(), 2 * exp.breaker_backoff - 1)
+
+            # and the breaker closes once the endpoint recovers
+            state.next_poll = 0.0
+            with patch.object(ddf_exporter.DDFCollector, '_make_request',
+                              return_value={'data': [{'value': 2.0, 'timestamp': 'Jan 15 2019 12:09:00'}]}):
+                self.assertListEqual(values(exp.populate_and_fetch_metrics(endpoints, self.metric_prefix)), [2.0])
+            self.assertEqual(state.failures, 0)
+            self.assertEqual(exp._stale_metric(endpoints).samples[0].value, 0.0)
+
+        finally:
+            self._reset_env_var('ADAPTIVE_POLLING', previous_value=old_adaptive_polling)
+
+    def test_refresh_snapshot_timed_out(self):
+
+        old_poll_interval = os.getenv('POLL_INTERVAL')
+        self._set_env_var('POLL_INTERVAL', '30')
+        try:
+            exp = ddf_exporter.DDFCollector()
+        finally:
+            self._reset_env_var('POLL_INTERVAL', previous_value=old_poll_interval)
+
+        endpoints = {'metric_a': 'metricA', 'metric_b': 'metricB'}
+        responses = {'data': [{'value': 1.0, 'timestamp': int(time.time() * 1000)}]}
+        with patch.object(ddf_exporter.DDFCollector, 'get_available_endpoints', return_value=endpoints), \
+                patch.object(ddf_exporter.DDFCollector, '_make_request', return_value=responses):
+            snapshot = exp.refresh_snapshot()
+        self.assertIsNotNone(snapshot.last_success)
+
+        # when every endpoint times out, only the timeout markers have samples, which isn't a success
+        stuck = threading.Event()
+        self.addCleanup(stuck.set)
+        exp.collect_timeout = 0.1
+        with patch.object(ddf_exporter.DDFCollector, 'get_available_endpoints', return_value=endpoints), \
+                patch.object(ddf_exporter.DDFCollector, '_make_request', side_effect=lambda *args: stuck.wait(5)):
+            self.assertIs(exp.refresh_snapshot(), snapshot)
+
+    def test_populate_and_fetch_metrics_deadline(self):
+
+        def slow_make_request(metric_name, offset=120, deadline=None):
+            if metric_name == 'slow_metric':
+                time.sleep(1)
+            return {'data': [{'value': 1.0}]}
+
+        exp = ddf_exporter.DDFCollector()
+        endpoints = {'fast_metric': 'fastMetric', 'slow_metric': 'slowMetric'}
+
+        with patch.object(ddf_exporter.DDFCollector, '_make_request', side_effect=slow_make_request):
+            started = time.monotonic()
+            outcome = ddf_exporter._CollectionOutcome()
+            with ddf_exporter.scrape_deadline(time.monotonic() + 0.2):
+                metrics = exp.populate_and_fetch_metrics(endpoints, self.metric_prefix, outcome=outcome)
+
+        # the collection returns at the deadline with whatever finished in time
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertEqual(len(metrics['fast_metric'].samples), 1)
+        self.assertListEqual(metrics['slow_metric'].samples, [])
+        self.assertListEqual(outcome.timed_out, ['slow_metric'])
+        self.assertListEqual(outcome.answered, ['fast_metric'])
+
+        timed_out = exp._timed_out_metric(outcome.timed_out)
+        self.assertEqual(timed_out.name, 'ddf_exporter_endpoint_timed_out')
+        self.assertEqual(timed_out.samples[0].labels['endpoint'], 'slow_metric')
+
+        # without a deadline, everything is waited for
+        outcome = ddf_exporter._CollectionOutcome()
+        with patch.object(ddf_exporter.DDFCollector, '_make_request', side_effect=slow_make_request):
+            exp.populate_and_fetch_metrics(endpoints, self.metric_prefix, outcome=outcome)
+        self.assertListEqual(outcome.timed_out, [])
+
+        # discovery and the endpoints share COLLECT_TIMEOUT, rather than each getting the whole of it
+        stuck = threading.Event()
+        self.addCleanup(stuck.set)
+        timeouts = []
+
+        def slow_get(url, **kwargs):
+            timeouts.append(kwargs['timeout'])
+            if url.endswith('/metrics/'):
+                time.sleep(0.25)
+                return Mock(status_code=200, content=b'{}', **{'json.return_value': {'fastMetric': {},
+                                                                                      'slowMetric': {}}})
+            if 'slowMetric' in url:
+                stuck.wait(5)
+            return Mock(status_code=200, content=b'{}', **{'json.return_value': {'data': [{'value': 1.0}]}})
+
+        os.environ['SECURE'] = "False"
+        exp = ddf_exporter.DDFCollector()
+        exp.collect_timeout = 0.4
+        outcome = ddf_exporter._CollectionOutcome()
+        with patch('requests.Session.get', side_effect=slow_get):
+            started = time.monotonic()
+            exp.scrape(outcome)
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertListEqual(outcome.timed_out, ['slow_metric'])
+        # the scrape waits on discovery, so its request can't outlast the deadline either
+        self.assertLessEqual(max(timeouts[0]), 0.4)
+
+        # a request that can't get a request slot before the deadline is skipped
+        exp._request_slots = threading.Semaphore(0)
+        with self.assertRaises(ddf_exporter.RequestBudgetExhausted):
+            exp._make_request('fast_metric', deadline=time.monotonic() + 0.05)
+
+
+    def test_populate_and_fetch_metrics_hedged(self):
+
+        calls = []
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def make_request(metric_name, offset=120, deadline=None):
+            calls.append(metric_name)
+            # only the first request to the slow endpoint hangs
+            if metric_name == 'slow_metric' and calls.count(metric_name) == 1:
+                release.wait(5)
+            return {'data': [{'value': 1.0}]}
+
+        exp = ddf_exporter.DDFCollector()
+        exp.hedge_after = 0.1
+        exp.window_aggregates = ['mean']
+
+        with patch.object(ddf_exporter.DDFCollector, '_make_request', side_effect=make_request):
+            started = time.monotonic()
+            metrics = exp.populate_and_fetch_metrics({'fast_metric': 'fastMetric', 'slow_metric': 'slowMetric'},
+                                                     self.metric_prefix)
+
+        # the hedged request answered first
+        self.assertLess(time.monotonic() - started, 0.9)
+        self.assertEqual(calls.count('slow_metric'), 2)
+        self.assertEqual(calls.count('fast_metric'), 1)
+        self.assertEqual(len(metrics['slow_metric'].samples), 1)
+
+        # once the first request finishes too, its response isn't recorded a second time
+        release.set()
+        exp._executor.shutdown(wait=True)
+        self.assertEqual(exp.endpoint_states['slow_metric'].history.size, 1)
+
+    def test_endpoint_selection(self):
+
+        old_exclude = os.getenv('ENDPOINT_EXCLUDE')
+        self._set_env_var('ENDPOINT_EXCLUDE', 'solr_.*')
+        try:
+            exp = ddf_exporter.DDFCollector()
+        finally:
+            self._reset_env_var('ENDPOINT_EXCLUDE', previous_value=old_exclude)
+
+        # filtered endpoints are left out when they are discovered
+        available_endpoints = exp._endpoints_from_index({'catalogQueries': {}, 'solrQueries': {}, 'catalogLatency': {}})
+        self.assertDictEqual(available_endpoints, {'catalog_queries': 'catalogQueries',
+                                                   'catalog_latency': 'catalogLatency'})
+
+        # a scrape's selection limits what is fetched and exposed
+        with patch.object(ddf_exporter.DDFCollector, 'get_available_endpoints', return_value=available_endpoints), \
+                patch.object(ddf_exporter.DDFCollector, '_fetch_data_points') as mock_fetch:
+            with ddf_exporter.scrape_selection(('.*_queries',)):
+                metrics = list(exp.collect())
+
+        self.assertEqual([metric.name for metric in metrics], ['test_case_catalog_queries'])
+        mock_fetch.assert_called_once_with('catalog_queries', deadline=None)
+
+        # when polling, the selection also narrows the exporter's per-endpoint series in the snapshot
+        exp.metric_endpoints = available_endpoints
+        exp.window_aggregates = ['max']
+        stale = exp._stale_metric(available_endpoints)
+        timed_out = exp._timed_out_metric(['catalog_queries', 'catalog_latency'])
+        window = prometheus_client.core.GaugeMetricFamily('test_case_window_max', 'max', labels=['endpoint'])
+        window.add_metric(['catalog_queries'], 1.0)
+        window.add_metric(['catalog_latency'], 2.0)
+        queries = prometheus_client.core.GaugeMetricFamily('test_case_catalog_queries', 'queries', value=1.0)
+        latency = prometheus_client.core.GaugeMetricFamily('test_case_catalog_latency', 'latency', value=2.0)
+        exp.snapshot = ddf_exporter.Snapshot((queries, latency, stale, timed_out, window), time.time(), None)
+
+        metrics = [metric for metric in exp._collect_snapshot(('.*_queries',))
+                   if not metric.name.startswith('ddf_exporter_snapshot')]
+        self.assertEqual([metric.name for metric in metrics],
+                         ['test_case_catalog_queries', 'ddf_exporter_endpoint_stale', 'ddf_exporter_endpoint_timed_out',
+                          'test_case_window_max'])
+        for metric in metrics[1:]:
+            self.assertEqual([sample.labels['endpoint'] for sample in metric.samples], ['catalog_queries'])
+
+        # the snapshot itself is left as it was
+        self.assertEqual(len(timed_out.samples), 2)
+
+        self.assertEqual(ddf_exporter.parse_selection({'collect[]': ['b', 'a', 'b']}), ('a', 'b'))
+        self.assertEqual(ddf_exporter.parse_selection({}), ())
+        with self.assertRaises(ValueError):
+            ddf_exporter.parse_selection({'collect[]': ['(']})
+
+    class FakeClock:
+
+        def __init__(self):
+            self.now = 1000.0
+            self.slept = []
+
+        def __call__(self):
+            return self.now
+
+        def sleep(self, seconds):
+            self.slept.append(seconds)
+            self.now += seconds
+
+    def test_request_budget(self):
+
+        # the token bucket allows a burst, and then REQUEST_RATE requests a second
+        clock = self.FakeClock()
+        budget = ddf_exporter.RequestBudget('test', rate=4, burst=2, max_in_flight=0, queue_timeout=0,
+                                            clock=clock, sleep=clock.sleep)
+        self.assertTrue(budget.acquire())
+        self.assertTrue(budget.acquire())
+        self.assertFalse(budget.acquire())
+        budget.release()
+        budget.release()
+        clock.now += 0.25
+        self.assertTrue(budget.acquire())
+        budget.release()
+        self.assertListEqual(clock.slept, [])
+
+        # requests queue for a token until the queue timeout
+        budget.queue_timeout = 1
+        self.assertTrue(budget.acquire())
+        self.assertEqual(len(clock.slept), 1)
+        self.assertEqual(clock.slept[0], 0.25)
+        budget.release()
+
+        # and are skipped when the token wouldn't arrive in time
+        budget.queue_timeout = 0.05
+        self.assertFalse(budget.acquire())
+        self.assertEqual(len(clock.slept), 1)
+
+        # or past the collection's deadline, however long the queue timeout
+        budget.queue_timeout = 30
+        self.assertFalse(budget.acquire(deadline=clock.now + 0.05))
+        self.assertEqual(len(clock.slept), 1)
+        self.assertTrue(budget.acquire(deadline=clock.now + 1))
+        self.assertEqual(len(clock.slept), 2)
+        budget.release()
+
+        # and for a slot when too many are in flight
+        budget = ddf_exporter.RequestBudget('test', rate=0, burst=1, max_in_flight=1, queue_timeout=0)
+        self.assertTrue(budget.acquire())
+        self.assertFalse(budget.acquire())
+        budget.release()
+        self.assertTrue(budget.acquire())
+        budget.release()
+
+        # an endpoint whose request is skipped keeps its last value, without counting as a failure
+        old_rate = os.getenv('REQUEST_RATE')
+        self._set_env_var('REQUEST_RATE', '0.001')
+        try:
+            exp = ddf_exporter.DDFCollector()
+        finally:
+            self._reset_env_var('REQUEST_RATE', previous_value=old_rate)
+        exp.request_budget.queue_timeout = 0
+
+        with patch.object(ddf_exporter.DDFCollector, 'get_available_endpoints', return_value={'metric': 'metric'}), \
+                patch('requests.Session.get', return_value=Mock(status_code=200, content=b'{}', **{
+                    'json.return_value': {'data': [{'value': 1.0}]}})) as mock_get:
+            first = {metric.name: metric for metric in exp.scrape()}
+            second = {metric.name: metric for metric in exp.scrape()}
+
+        self.assertEqual(mock_get.call_count, 1)
+        self.assertEqual(first['test_case_metric'].samples[0].value, 1.0)
+        self.assertEqual(second['test_case_metric'].samples[0].value, 1.0)
+        self.assertEqual(exp.endpoint_states['metric'].failures, 0)
+
+        # or with BUDGET_EXHAUSTED set to "skip", is left out of the collection instead
+        exp.budget_exhausted = 'skip'
+        with patch.object(ddf_exporter.DDFCollector, 'get_available_endpoints', return_value={'metric': 'metric'}), \
+                patch('requests.Session.get') as mock_get, patch('builtins.print') as mock_print:
+            skipped = {metric.name: metric for metric in exp.scrape()}
+        mock_get.assert_not_called()
+        mock_print.assert_not_called()
+        self.assertListEqual(skipped['test_case_metric'].samples, [])
+        self.assertEqual(exp.endpoint_states['metric'].failures, 0)
+        exp.budget_exhausted = 'stale'
+
+        # a skipped first discovery leaves the scrape without any endpoints, rather than failing it
+        with patch('requests.Session.get') as mock_get, patch('builtins.print'):
+            metrics = {metric.name: metric for metric in exp.collect()}
+        mock_get.assert_not_called()
+        self.assertNotIn('test_case_metric', metrics)
+        self.assertIsNone(exp._endpoints_fetched_at)
+
+    def test__parse_timestamp(self):
+
+        self.assertEqual(ddf_exporter._parse_timestamp('Jan 15 2019 12:07:00'), 1547554020.0)
+        self.assertEqual(ddf_exporter._parse_timestamp('2019-01-15T12:07:00'), 1547554020.0)
+        self.assertEqual(ddf_exporter._parse_timestamp(1547554020), 1547554020.0)
+        self.assertEqual(ddf_exporter._parse_timestamp(1547554020000), 1547554020.0)
+        self.assertEqual(ddf_exporter._parse_timestamp('1547554020'), 1547554020.0)
+        self.assertIsNone(ddf_exporter._parse_timestamp('yesterday'))
+        self.assertIsNone(ddf_exporter._parse_timestamp(None))
+
+        # formatted dates are in DDF_TIMEZONE, which is UTC by default
+        for name, expected in (('UTC', 1547554020.0), ('+02:00', 1547546820.0), ('-0530', 1547573820.0),
+                               ('UTC+1', 1547550420.0)):
+            exp = self._collector_with_env('DDF_TIMEZONE', name)
+            self.assertEqual(ddf_exporter._parse_timestamp('Jan 15 2019 12:07:00', exp.ddf_timezone), expected)
+            # epoch timestamps are the same in every timezone
+            self.assertEqual(ddf_exporter._parse_timestamp(1547554020, exp.ddf_timezone), 1547554020.0)
+
+        with self.assertRaises(ValueError):
+            self._collector_with_env('DDF_TIMEZONE', 'Europe/Berlin')
+
+        # the datapoints' timestamps are read in it
+        exp = self._collector_with_env('DDF_TIMEZONE', '+02:00')
+        with patch.object(ddf_exporter.DDFCollector, '_make_request',
+                          return_value={'data': [{'value': 1.0, 'timestamp': 'Jan 15 2019 12:07:00'}]}):
+            exp.populate_and_fetch_metrics({'metric': 'metric'}, self.metric_prefix)
+        self.assertEqual(exp.endpoint_states['metric'].high_water, 1547546820.0)
+
+    def test_parse_target(self):
+
+        self.assertEqual(ddf_exporter.parse_target('https://ddf:8993'), ('https://ddf', '8993'))
+        self.assertEqual(ddf_exporter.parse_target('http://ddf:8181'), ('http://ddf', '8181'))
+        self.assertEqual(ddf_exporter.parse_target('ddf.example.com'), ('https://ddf.example.com', '8993'))
+        self.assertEqual(ddf_exporter.parse_target('http://[::1]:8181'), ('http://[::1]', '8181'))
+        self.assertRaises(ValueError, ddf_exporter.parse_target, 'https://:8993')
+
+
+    def test_target_pool(self):
+
+        pool = ddf_exporter.TargetPool()
+
+        # each target gets its own collector, which is kept between probes
+        collector_a = pool.get('https://ddf-a:8993')
+        self.assertIs(pool.get('ddf-a'), collector_a)
+        self.assertIsNot(pool.get('https://ddf-b:8993'), collector_a)
+        self.assertEqual(collector_a.host, 'https://ddf-a')
+        self.assertEqual(collector_a.host_port, '8993')
+
+        # but they share the workers and the request limit
+        self.assertIs(collector_a._executor, pool.executor)
+        self.assertIs(collector_a._request_slots, pool.request_slots)
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as targets_file:
+            json.dump(['https://ddf-a:8993', {'target': 'https://ddf-c:8993', 'site_name': 'Site C'}], targets_file)
+
+        try:
+            collectors = pool.load_targets(targets_file.name)
+        finally:
+            os.remove(targets_file.name)
+
+        self.assertIs(collectors[0], collector_a)
+        self.assertEqual(collectors[1].host, 'https://ddf-c')
+        self.assertEqual(collectors[1].sitename, 'Site C')
+
+    def test_target_pool_probes(self):
+
+        old_max, old_targets = os.getenv('PROBE_MAX_TARGETS'), os.getenv('PROBE_TARGETS')
+        self._set_env_var('PROBE_MAX_TARGETS', '2')
+        self._set_env_var('PROBE_TARGETS', r'https://ddf-.*')
+        try:
+            pool = ddf_exporter.TargetPool()
+        finally:
+            self._reset_env_var('PROBE_MAX_TARGETS', previous_value=old_max)
+            self._reset_env_var('PROBE_TARGETS', previous_value=old_targets)
+        evicted = []
+        pool.add_eviction_listener(evicted.append)
+
+        # targets outside of PROBE_TARGETS are turned away
+        with self.assertRaises(ValueError):
+            pool.probe('https://elsewhere:8993')
+
+        # probed targets are kept between probes, up to PROBE_MAX_TARGETS of them
+        configured = pool.get('https://ddf-a:8993')
+        self.assertIs(pool.probe('https://ddf-a:8993'), configured)
+        collector_b = pool.probe('https://ddf-b:8993')
+        self.assertIs(pool.probe('https://ddf-b:8993'), collector_b)
+        collector_c = pool.probe('https://ddf-c:8993')
+        collector_c._instruments_for('metric').duration.observe(0.5)
+        collector_c._wire_bytes.inc(100)
+        ddf_exporter._REQUEST_ERRORS.labels(collector_c.target, 'metric', 'timeout').inc()
+        self.assertEqual(prometheus_client.REGISTRY.get_sample_value(
+            'ddf_exporter_response_wire_bytes_total', {'target': collector_c.target}), 100)
+        pool.probe('https://ddf-b:8993')
+        pool.probe('https://ddf-d:8993')
+
+        # the least recently probed goes first, and configured targets are never dropped
+        self.assertListEqual(evicted, [collector_c])
+        self.assertTrue(collector_c._stop_polling.is_set())
+
+        # along with the exporter's own metrics about it
+        target_samples = [sample for family in prometheus_client.REGISTRY.collect() for sample in family.samples
+                          if sample.labels.get('target') == collector_c.target]
+        self.assertListEqual(target_samples, [])
+        self.assertIs(pool.probe('https://ddf-a:8993'), configured)
+        self.assertIs(pool.probe('https://ddf-b:8993'), collector_b)
+
+        # as are those left idle
+        pool.probe_idle_timeout = 0
+        pool.evict_idle()
+        self.assertEqual(len(evicted), 3)
+        self.assertIn(collector_b, evicted)
+        self.assertIs(pool.get('https://ddf-a:8993'), configured)
+
+    def test_sharding(self):
+
+        # every shard gets a share, and adding a shard only moves keys onto the new one
+        keys = ['https://ddf-{}:8993'.format(i) for i in range(200)]
+        three_shards = [ddf_exporter.shard_owner(key, 3) for key in keys]
+        four_shards = [ddf_exporter.shard_owner(key, 4) for key in keys]
+        self.assertSetEqual(set(three_shards), {0, 1, 2})
+        self.assertSetEqual(set(four_shards), {0, 1, 2, 3})
+        for before, after in zip(three_shards, four_shards):
+            self.assertIn(after, (before, 3))
+
+        old_count, old_index = os.getenv('SHARD_COUNT'), os.getenv('SHARD_INDEX')
+        targets = ['https://ddf-{}:8993'.format(i) for i in range(10)]
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as targets_file:
+            json.dump(targets + [{'target': 'https://ddf-big:8993', 'shard_endpoints': True}], targets_file)
+
+        try:
+            os.environ['SHARD_COUNT'] = '2'
+            replicas = []
+            for index in range(2):
+                os.environ['SHARD_INDEX'] = str(index)
+                replicas.append(ddf_exporter.TargetPool().load_targets(targets_file.name))
+
+            # the targets are split between the replicas
+            hosts = [{collector.host for collector in collectors} for collectors in replicas]
+            self.assertSetEqual(hosts[0] & hosts[1], {'https://ddf-big'})
+            self.assertSetEqual(hosts[0] | hosts[1], {'https://ddf-{}'.format(i) for i in range(10)} |
+                                {'https://ddf-big'})
+
+            # while the big target's endpoints are split instead
+            big = [collectors[-1] for collectors in replicas]
+            self.assertEqual([collector.endpoint_shard for collector in big], [(0, 2), (1, 2)])
+            self.assertIsNone(replicas[0][0].endpoint_shard)
+            endpoints = {'metric_{}'.format(i): 'metric{}'.format(i) for i in range(20)}
+            shares = [set(collector._endpoints_from_index(endpoints)) for collector in big]
+            self.assertFalse(shares[0] & shares[1])
+            self.assertSetEqual(shares[0] | shares[1], set(endpoints))
+
+            os.environ['SHARD_INDEX'] = '2'
+            self.assertRaises(ValueError, ddf_exporter.TargetPool)
+        finally:
+            os.remove(targets_file.name)
+            self._reset_env_var('SHARD_COUNT', previous_value=old_count)
+            self._reset_env_var('SHARD_INDEX', previous_value=old_index)
+
+
+    def test_fleet_collector(self):
+
+        pool = ddf_exporter.TargetPool()
+        collectors = [pool.get('https://ddf-a:8993'), pool.get('https://ddf-b:8993')]
+
+        def scrape(collector):
+            gauge = prometheus_client.core.GaugeMetricFamily('test_case_metric', 'metric',
+                                                             labels=collector.labels.keys())
+            gauge.add_metric(list(collector.labels.values()), 1.0)
+            return [gauge]
+
+        with patch.object(ddf_exporter.DDFCollector, 'scrape', autospec=True, side_effect=scrape):
+            metrics = list(ddf_exporter.FleetCollector(collectors).collect())
+
+        # the same metric from each target is exposed as one family with a series per target
+        self.assertEqual(len(metrics), 1)
+        self.assertListEqual([sample.labels['host'] for sample in metrics[0].samples],
+                             ['https://ddf-a', 'https://ddf-b'])
+
+
+    def test_exporter_server_probe(self):
+
+        pool = ddf_exporter.TargetPool()
+        server = ddf_exporter.start_exporter_server(0, pool, registry=prometheus_client.CollectorRegistry(),
+                                                    addr='127.0.0.1')
+        base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+        def scrape(collector):
+            gauge = prometheus_client.core.GaugeMetricFamily('test_case_metric', 'metric',
+                                                             labels=collector.labels.keys())
+            gauge.add_metric(list(collector.labels.values()), 1.0)
+            return [gauge]
+
+        try:
+            with patch.object(ddf_exporter.DDFCollector, 'scrape', autospec=True, side_effect=scrape):
+                with urllib.request.urlopen(base_url + '/probe?target=https://ddf-a:8993') as response:
+                    body = response.read().decode('utf-8')
+
+            self.assertIn('test_case_metric{host="https://ddf-a",hostname="ddf-a",sitename="ddf-a"} 1.0', body)
+
+            # a collection that fails is answered with a 500, rather than a dropped connection
+            with patch.object(ddf_exporter.DDFCollector, 'scrape', side_effect=RuntimeError('broken')), \
+                    patch('builtins.print'):
+                with self.assertRaises(urllib.error.HTTPError) as context:
+                    urllib.request.urlopen(base_url + '/probe?target=https://ddf-b:8993')
+            self.assertEqual(context.exception.code, 500)
+            self.assertIn('broken', context.exception.read().decode('utf-8'))
+
+            # a probe needs a target
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(base_url + '/probe')
+            self.assertEqual(context.exception.code, 400)
+
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(base_url + '/unknown')
+            self.assertEqual(context.exception.code, 404)
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    class SlowCollector:
+
+        def __init__(self):
+            self.calls = 0
+
+        def collect(self):
+            self.calls += 1
+            time.sleep(0.2)
+            gauge = prometheus_client.core.GaugeMetricFamily('test_case_metric', 'metric')
+            gauge.add_metric([], self.calls)
+            yield gauge
+
+
+    def test_exposition_cache(self):
+
+        collector = self.SlowCollector()
+        registry = prometheus_client.CollectorRegistry(auto_describe=False)
+        registry.register(collector)
+        cache = ddf_exporter.ExpositionCache(registry)
+
+        # concurrent scrapes share a single collection
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get())) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(collector.calls, 1)
+        self.assertEqual(len(set(id(rendered) for rendered in results)), 1)
+        self.assertIn(b'test_case_metric 1.0', results[0].plain)
+        self.assertEqual(gzip.decompress(results[0].gzipped), results[0].plain)
+
+        # without a ttl, the next scrape collects again, and nothing is kept
+        self.assertIn(b'test_case_metric 2.0', cache.get().plain)
+        self.assertEqual(len(cache._rendered), 0)
+
+        # with a ttl, rendered output is reused until it expires
+        cache.ttl = 60
+        rendered = cache.get()
+        self.assertIs(cache.get(), rendered)
+        self.assertEqual(collector.calls, 3)
+
+        # OpenMetrics is rendered separately
+        rendered = cache.get('application/openmetrics-text; version=1.0.0')
+        self.assertTrue(rendered.content_type.startswith('application/openmetrics-text'))
+        self.assertTrue(rendered.plain.endswith(b'# EOF\n'))
+
+        # only the most recently used selections are kept
+        cache.max_rendered = 3
+        collector.collect = lambda: iter(())
+        for pattern in ('a', 'b', 'c'):
+            cache.get(selection=(pattern,))
+        cache.get(selection=('a',))
+        cache.get(selection=('d',))
+        self.assertEqual([selection for _, selection in cache._rendered], [('c',), ('a',), ('d',)])
+        del collector.collect
+        cache.max_rendered = 32
+
+        # when polling, a new snapshot makes the output out of date
+        cache.ttl = 0
+        cache.poll_interval = 30
+        rendered = cache.get()
+        self.assertIs(cache.get(), rendered)
+        ddf_exporter._snapshot_generation = next(ddf_exporter._SNAPSHOT_GENERATIONS)
+        self.assertIsNot(cache.get(), rendered)
+
+        # and so does a failed poll, as the snapshot's age has moved on even though it was kept
+        exp = ddf_exporter.DDFCollector()
+        exp._publish_snapshot((prometheus_client.core.GaugeMetricFamily('test_case_other', 'other', value=1.0),),
+                              succeeded=True)
+        rendered = cache.get()
+        exp._publish_snapshot((), succeeded=False)
+        self.assertIsNot(cache.get(), rendered)
+
+        # or a poll that is taking longer than the poll interval
+        rendered = cache.get()
+        with patch('time.monotonic', return_value=time.monotonic() + 30):
+            self.assertIsNot(cache.get(), rendered)
+
+    class FakeDDFHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        connections = set()
+
+        def do_GET(self):
+            type(self).connections.add(self.client_address)
+
+            if self.path == '/services/internal/metrics/':
+                body = json.dumps({'testMetric': {'name': 'testMetric'}}).encode('utf-8')
+            elif self.path.startswith('/services/internal/metrics/testMetric.json?dateOffset='):
+                body = json.dumps({'data': [{'timestamp': int(time.time() * 1000), 'value': 42.0}]}).encode('utf-8')
+            elif self.path == '/moved':
+                self.send_response(302)
+                self.send_header('Location', '/services/internal/metrics/')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            elif self.path == '/empty':
+                # no Content-Length, and the connection is kept open
+                self.send_response(204)
+                self.end_headers()
+                return
+            elif self.path.startswith('/services/internal/metrics/truncatedMetric.json'):
+                self.send_response(200)
+                self.send_header('Content-Length', '100')
+                self.end_headers()
+                self.wfile.write(b'{"data": [')
+                self.close_connection = True
+                return
+            else:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body)
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            self.wfile.write(b'%x\r\n%s\r\n0\r\n\r\n' % (len(body), body))
+
+        def log_message(self, format, *args):
+            pass
+
+
+    def _start_fake_ddf(self):
+        server = ddf_exporter.ExporterHTTPServer(('127.0.0.1', 0), self.FakeDDFHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server.server_address[1]
+
+    def test_async_http_client(self):
+
+        port = self._start_fake_ddf()
+        self.FakeDDFHandler.connections.clear()
+        client = ddf_exporter_async.AsyncHTTPClient(False, read_timeout=5)
+
+        async def fetch():
+            index = await client.get('http://127.0.0.1:{}/services/internal/metrics/'.format(port))
+            missing = await client.get('http://127.0.0.1:{}/unknown'.format(port))
+            moved = await client.get('http://127.0.0.1:{}/moved'.format(port))
+            empty = await client.get('http://127.0.0.1:{}/empty'.format(port))
+            return index, missing, moved, empty
+
+        loop = asyncio.new_event_loop()
+        try:
+            started = time.monotonic()
+            index, missing, moved, empty = loop.run_until_complete(fetch())
+            client.close()
+        finally:
+            loop.close()
+
+        # a response that never has a body isn't waited on until the read timeout
+        self.assertEqual(empty.status_code, 204)
+        self.assertEqual(empty.content, b'')
+        self.assertLess(time.monotonic() - started, 4)
+
+        # chunked and gzipped responses are decoded
+        self.assertEqual(index.status_code, 200)
+        self.assertEqual(index.json(), {'testMetric': {'name': 'testMetric'}})
+        self.assertEqual(index.wire_bytes, len(gzip.compress(index.content)))
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual(missing.content, b'')
+
+        # redirects are followed
+        self.assertEqual(moved.status_code, 200)
+        self.assertEqual(moved.json(), index.json())
+
+        # every request went over the same connection
+        self.assertEqual(len(self.FakeDDFHandler.connections), 1)
+
+        # a body cut short counts as a connection error, as it does with requests
+        os.environ['SECURE'] = "False"
+        collector = ddf_exporter_async.AsyncDDFCollector(host='http://127.0.0.1', host_port=str(port))
+        collector.metric_endpoints['truncated_metric'] = 'truncatedMetric'
+        errors = {'target': collector.target, 'endpoint': 'truncated_metric', 'type': 'connection'}
+        before = prometheus_client.REGISTRY.get_sample_value('ddf_exporter_request_errors_total', errors) or 0
+        loop = asyncio.new_event_loop()
+        try:
+            with patch('builtins.print'):
+                self.assertEqual(loop.run_until_complete(collector._make_request_async('truncated_metric')), {})
+            collector.close()
+        finally:
+            loop.close()
+        self.assertEqual(prometheus_client.REGISTRY.get_sample_value('ddf_exporter_request_errors_total', errors),
+                         before + 1)
+
+    def test_compressed_transfer(self):
+
+        os.environ['SECURE'] = "False"
+        old_compression = os.getenv('HTTP_COMPRESSION')
+        port = self._start_fake_ddf()
+        self.FakeDDFHandler.connections.clear()
+        registry = prometheus_client.REGISTRY
+        target_labels = {'target': 'http://127.0.0.1:{}'.format(port)}
+        index_body = json.dumps({'testMetric': {'name': 'testMetric'}}).encode('utf-8')
+
+        def wire_bytes():
+            return registry.get_sample_value('ddf_exporter_response_wire_bytes_total', target_labels) or 0
+
+        try:
+            # gzipped responses are counted as they arrived, and decompressed as they are read
+            exp = ddf_exporter.DDFCollector(host='http://127.0.0.1', host_port=str(port))
+            self.assertEqual(exp.session.headers['Accept-Encoding'], 'gzip, deflate')
+            self.assertEqual(exp._make_request('', offset=None), {'testMetric': {'name': 'testMetric'}})
+            self.assertEqual(wire_bytes(), len(gzip.compress(index_body)))
+            self.assertEqual(registry.get_sample_value('ddf_exporter_response_bytes_total',
+                                                       dict(target_labels, endpoint='')), len(index_body))
+
+            exp.stream_json = "True"
+            exp.metric_endpoints['test_metric'] = 'testMetric'
+            data_points = list(exp._make_request('test_metric')['data'])
+            self.assertEqual([data_point['value'] for data_point in data_points], [42.0])
+            self.assertGreater(wire_bytes(), len(gzip.compress(index_body)))
+
+            # the connection is still reused
+            self.assertEqual(len(self.FakeDDFHandler.connections), 1)
+
+            # without compression, the bytes on the wire are the body itself
+            os.environ['HTTP_COMPRESSION'] = "False"
+            before = wire_bytes()
+            exp = ddf_exporter.DDFCollector(host='http://127.0.0.1', host_port=str(port))
+            exp._make_request('', offset=None)
+            self.assertEqual(wire_bytes() - before, len(index_body))
+
+            client = ddf_exporter_async.AsyncHTTPClient(False, compression=False)
+            loop = asyncio.new_event_loop()
+            try:
+                index = loop.run_until_complete(client.get('http://127.0.0.1:{}/services/internal/metrics/'
+                                                           .format(port)))
+                client.close()
+            finally:
+                loop.close()
+            self.assertEqual(index.content, index_body)
+            self.assertEqual(index.wire_bytes, len(index_body))
+        finally:
+            self._reset_env_var('HTTP_COMPRESSION', previous_value=old_compression)
+
+        # the exposition is sent gzipped unless the scraper turns it down
+        rendered = ddf_exporter.RenderedExposition(content_type='text/plain', plain=b'a' * 100, gzipped=b'g' * 10,
+                                                   rendered_at=0, generation=0)
+        uncompressed = registry.get_sample_value('ddf_exporter_exposition_uncompressed_bytes_total') or 0
+        self.assertEqual(rendered.output_for('gzip'), (b'g' * 10, 'gzip'))
+        self.assertEqual(rendered.output_for('deflate, gzip;q=0.5'), (b'g' * 10, 'gzip'))
+        self.assertEqual(rendered.output_for('gzip;q=0, identity'), (b'a' * 100, None))
+        self.assertEqual(rendered.output_for(None), (b'a' * 100, None))
+        self.assertEqual(registry.get_sample_value('ddf_exporter_exposition_uncompressed_bytes_total') - uncompressed,
+                         400)
+
+    def test_async_exporter(self):
+
+        os.environ['SECURE'] = "False"
+        port = self._start_fake_ddf()
+
+        path = os.path.join(tempfile.mkdtemp(), 'state.json')
+        pool = ddf_exporter.TargetPool(collector_class=ddf_exporter_async.AsyncDDFCollector, start_polling=False)
+        collector = ddf_exporter_async.AsyncDDFCollector(host='http://127.0.0.1', host_port=str(port),
+                                                   state_store=ddf_exporter.StateStore(path))
+        registry = prometheus_client.CollectorRegistry()
+        exporter = ddf_exporter_async.AsyncExporter(pool, [collector], registry=registry)
+        client = ddf_exporter_async.AsyncHTTPClient(False, keep_alive=False)
+
+        class BrokenCollector:
+            def collect(self):
+                raise RuntimeError('broken')
+
+        async def scrape():
+            server = await exporter.start(0, '127.0.0.1')
+            base_url = 'http://127.0.0.1:{}'.format(server.sockets[0].getsockname()[1])
+            try:
+                responses = (await client.get(base_url + '/metrics'), await client.get(base_url + '/probe'),
+                             await client.get(base_url + '/unknown'),
+                             await client.get(base_url + '/-/healthy?collect[]=('),
+                             await client.get(base_url + '/metrics?collect[]=('))
+                registry.register(BrokenCollector())
+                with patch('builtins.print'):
+                    return responses + (await client.get(base_url + '/metrics'),)
+            finally:
+                await exporter.shutdown()
+
+        loop = asyncio.new_event_loop()
+        try:
+            metrics, probe, unknown, healthy, bad_selection, broken = loop.run_until_complete(scrape())
+        finally:
+            loop.close()
+
+        self.assertEqual(metrics.status_code, 200)
+        self.assertIn(b'test_case_test_metric{host="http://127.0.0.1",hostname="127.0.0.1",sitename="127.0.0.1"} 42.0',
+                      metrics.content)
+        self.assertEqual(probe.status_code, 400)
+        self.assertEqual(unknown.status_code, 404)
+
+        # collect[] is only read by the paths that collect
+        self.assertEqual(healthy.status_code, 200)
+        self.assertEqual(bad_selection.status_code, 400)
+
+        # the state is saved off the event loop
+        self.assertTrue(os.path.exists(path))
+
+        # output that can't be generated is answered with a 500
+        self.assertEqual(broken.status_code, 500)
+        self.assertIn(b'broken', broken.content)
+
+        # requests that have to go through a proxy are made with requests instead
+        old_proxy = os.getenv('HTTP_PROXY')
+        self._set_env_var('HTTP_PROXY', 'http://proxy.example.com:3128')
+        try:
+            proxied = ddf_exporter_async.AsyncDDFCollector(host='http://ddf.example.com', host_port='8993')
+        finally:
+            self._reset_env_var('HTTP_PROXY', previous_value=old_proxy)
+
+        # and takes one of the same request slots as every other request
+        async def make_request():
+            proxied.async_request_slots = asyncio.Semaphore(1)
+            return await proxied._make_request_async('', offset=None)
+
+        held = []
+        loop = asyncio.new_event_loop()
+        try:
+            with patch.object(ddf_exporter.DDFCollector, '_make_request',
+                              side_effect=lambda *args: held.append(proxied.async_request_slots.locked()) or
+                              {'data': []}) as mock_request:
+                self.assertEqual(loop.run_until_complete(make_request()), {'data': []})
+        finally:
+            loop.close()
+        mock_request.assert_called_once_with('', None, None, False)
+        self.assertListEqual(held, [True])
+        self.assertFalse(proxied.async_request_slots.locked())
+        self.assertIsNone(proxied._request_slots)
+
+    def test_warm_up(self):
+
+        os.environ['SECURE'] = "False"
+        port = self._start_fake_ddf()
+
+        # registering the collector doesn't collect from it
+        with patch.object(ddf_exporter.DDFCollector, 'collect') as mock_collect:
+            collector = ddf_exporter.DDFCollector(host='http://127.0.0.1', host_port=str(port))
+            prometheus_client.CollectorRegistry().register(collector)
+        mock_collect.assert_not_called()
+
+        ready = threading.Event()
+        ddf_exporter.warm_up([collector], ready)
+
+        self.assertTrue(ready.is_set())
+        self.assertDictEqual(collector.metric_endpoints, {'test_metric': 'testMetric'})
+        self.assertEqual(collector.endpoint_states['test_metric'].last_value, 42.0)
+
+        # the exporter is still marked as ready when a target can't be warmed up
+        ready = threading.Event()
+        with patch.object(ddf_exporter.DDFCollector, 'scrape', side_effect=FileNotFoundError('no cert')):
+            ddf_exporter.warm_up([collector], ready)
+        self.assertTrue(ready.is_set())
+
+    def test_state_store(self):
+
+        os.environ['SECURE'] = "False"
+        port = self._start_fake_ddf()
+        path = os.path.join(tempfile.mkdtemp(), 'state.json')
+
+        store = ddf_exporter.StateStore(path)
+        collector = ddf_exporter.DDFCollector(host='http://127.0.0.1', host_port=str(port), state_store=store)
+        collector.scrape()
+
+        # the first collection is saved straight away
+        with open(path) as state_file:
+            saved = json.load(state_file)
+        self.assertEqual(saved['version'], ddf_exporter.StateStore.VERSION)
+        self.assertDictEqual(saved['targets'][collector.target]['endpoints'], {'test_metric': 'testMetric'})
+
+        # after a restart the endpoints, values and fetch window carry on from where they were
+        old_poll_interval = os.getenv('POLL_INTERVAL')
+        self._set_env_var('POLL_INTERVAL', '30')
+        try:
+            restored = ddf_exporter.DDFCollector(host='http://127.0.0.1', host_port=str(port),
+                                                 state_store=ddf_exporter.StateStore(path))
+        finally:
+            self._reset_env_var('POLL_INTERVAL', previous_value=old_poll_interval)
+
+        self.assertDictEqual(restored.metric_endpoints, {'test_metric': 'testMetric'})
+        self.assertIsNotNone(restored._endpoints_fetched_at)
+        state = restored.endpoint_states['test_metric']
+        self.assertEqual(state.last_value, 42.0)
+        self.assertEqual(state.high_water, collector.endpoint_states['test_metric'].high_water)
+        self.assertLess(restored._next_offset(state, time.monotonic()), restored.date_offset)
+
+        # and when polling, the restored values are served before the first poll
+        metrics = {metric.name: metric for metric in restored.collect()}
+        self.assertEqual(metrics['test_case_test_metric'].samples[0].value, 42.0)
+
+        # an unreadable file is ignored
+        with open(path, 'w') as state_file:
+            state_file.write('{')
+        self.assertDictEqual(ddf_exporter.StateStore(path)._targets, {})
+
+        # on shutdown the state is saved straight away, without waiting for requests that are stuck
+        old_state_file = os.getenv('STATE_FILE')
+        self._set_env_var('STATE_FILE', path)
+        try:
+            pool = ddf_exporter.TargetPool()
+        finally:
+            self._reset_env_var('STATE_FILE', previous_value=old_state_file)
+        stuck = threading.Event()
+        pool.executor.submit(stuck.wait, 10)
+        os.remove(path)
+        started = time.monotonic()
+        pool.shutdown()
+        stuck.set()
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertTrue(os.path.exists(path))
+
+    def test_debug_endpoints(self):
+
+        old_debug = os.getenv('DEBUG_ENDPOINTS')
+        self._set_env_var('DEBUG_ENDPOINTS', 'True')
+        try:
+            server = ddf_exporter.start_exporter_server(0, ddf_exporter.TargetPool(),
+                                                        registry=prometheus_client.CollectorRegistry(),
+                                                        addr='127.0.0.1')
+        finally:
+            self._reset_env_var('DEBUG_ENDPOINTS', previous_value=old_debug)
+        base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+        self.addCleanup(tracemalloc.stop)
+
+        exp = ddf_exporter.DDFCollector()
+
+        def collect_soon():
+            time.sleep(0.2)
+            with patch.object(ddf_exporter.DDFCollector, 'get_available_endpoints', return_value={}):
+                exp.scrape()
+
+        try:
+            # the profile covers the next collection
+            collection = threading.Thread(target=collect_soon)
+            collection.start()
+            with urllib.request.urlopen(base_url + '/debug/profile?collections=1&timeout=10') as response:
+                body = response.read().decode('utf-8')
+            collection.join()
+            self.assertNotIn("didn't finish in time", body)
+            self.assertIn('collect_soon (test_ddf_exporter.py)', body)
+            self.assertListEqual(ddf_exporter._active_profiles, [])
+
+            with urllib.request.urlopen(base_url + '/debug/heap') as response:
+                self.assertIn(b'Started tracing', response.read())
+            with urllib.request.urlopen(base_url + '/debug/heap') as response:
+                self.assertIn(b'Largest allocations', response.read())
+
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(base_url + '/debug/profile?collections=many')
+            self.assertEqual(context.exception.code, 400)
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # without DEBUG_ENDPOINTS, there are no debug endpoints
+        server = ddf_exporter.start_exporter_server(0, ddf_exporter.TargetPool(),
+                                                    registry=prometheus_client.CollectorRegistry(),
+                                                    addr='127.0.0.1')
+        try:
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen('http://127.0.0.1:{}/debug/heap'.format(server.server_address[1]))
+            self.assertEqual(context.exception.code, 404)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_slow_collection_dump(self):
+
+        def slow_request(metric_name, offset=120, deadline=None):
+            time.sleep(0.05)
+            return {'data': [{'value': 1.0}]}
+
+        exp = ddf_exporter.DDFCollector()
+        exp.slow_collection_threshold = 0.01
+        exp.slow_collection_dir = tempfile.mkdtemp()
+
+        with patch.object(ddf_exporter.DDFCollector, 'get_available_endpoints', return_value={'slow_metric': 'slowMetric'}), \
+                patch.object(ddf_exporter.DDFCollector, '_make_request', side_effect=slow_request):
+            exp.scrape()
+
+        dumps = os.listdir(exp.slow_collection_dir)
+        self.assertEqual(len(dumps), 1)
+        with open(os.path.join(exp.slow_collection_dir, dumps[0])) as dump_file:
+            dump = dump_file.read()
+        self.assertIn('slow_metric', dump)
+        self.assertIn('slow_request (test_ddf_exporter.py)', dump)
+
+        # collections that overlap share one sampling thread, which stops once they have all finished
+        samplers = []
+        both_started = threading.Barrier(2)
+
+        def overlapping_request(metric_name, offset=120, deadline=None):
+            both_started.wait(5)
+            samplers.append(sum(thread.name == 'ddf-sampler' for thread in threading.enumerate()))
+            time.sleep(0.05)
+            return {'data': [{'value': 1.0}]}
+
+        other = ddf_exporter.DDFCollector()
+        other.slow_collection_threshold = 0.01
+        other.slow_collection_dir = tempfile.mkdtemp()
+        with patch.object(ddf_exporter.DDFCollector, 'get_available_endpoints', return_value={'slow_metric': 'slowMetric'}), \
+                patch.object(ddf_exporter.DDFCollector, '_make_request', side_effect=overlapping_request), \
+                patch('builtins.print'):
+            scrapes = [threading.Thread(target=collector.scrape) for collector in (exp, other)]
+            for scrape in scrapes:
+                scrape.start()
+            for scrape in scrapes:
+                scrape.join()
+
+        self.assertListEqual(samplers, [1, 1])
+        self.assertFalse(any(thread.name == 'ddf-sampler' for thread in threading.enumerate()))
+        self.assertEqual(len(os.listdir(other.slow_collection_dir)), 1)
+
+    def test_exporter_server_ready(self):
+
+        ready = threading.Event()
+        server = ddf_exporter.start_exporter_server(0, ddf_exporter.TargetPool(),
+                                                    registry=prometheus_client.CollectorRegistry(),
+                                                    addr='127.0.0.1', ready=ready)
+        base_url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+        try:
+            with urllib.request.urlopen(base_url + '/-/healthy') as response:
+                self.assertEqual(response.status, 200)
+
+            # collect[] is only read by the paths that collect
+            with urllib.request.urlopen(base_url + '/-/healthy?collect[]=(') as response:
+                self.assertEqual(response.status, 200)
+            for path in ('/metrics?collect[]=(', '/probe?target=ddf.example.com&collect[]=('):
+                with self.assertRaises(urllib.error.HTTPError) as context:
+                    urllib.request.urlopen(base_url + path)
+                self.assertEqual(context.exception.code, 400)
+
+            with self.assertRaises(urllib.error.HTTPError) as context:
+                urllib.request.urlopen(base_url + '/-/ready')
+            self.assertEqual(context.exception.code, 503)
+
+            ready.set()
+            with urllib.request.urlopen(base_url + '/-/ready') as response:
+                self.assertEqual(response.status, 200)
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
     def test__camel_to_snake_case(self):
 
         # test empty string
@@ -347,12 +1891,3 @@ class TestDdfExporter(unittest.TestCase):
         # test all caps string
         ans = ddf_exporter._camel_to_snake_case('consecutiveUPPERCase')
         self.assertEqual(ans, 'consecutive_upper_case')
-
-
-
-
-
-
-
-
-